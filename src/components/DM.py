@@ -1,6 +1,12 @@
 from src.utils.utils import *
-from src.utils.utils_model import generate
+from src.utils.utils_model import generate, PrefixCache
+from src.utils.json_grammar import JsonGrammar, dm_schema
+from src.utils.json_recovery import JsonRecovery
+from src.utils.cache import get_generation_cache
+from src.utils.scheduler import get_scheduler
+from src.utils.prompt import PromptAssembler
 from src.utils.logging import setup_logger
+from src.utils.tracing import tracer
 import json
 import os
 
@@ -12,32 +18,135 @@ class DM():
         self.template = cfg["TEMPLATES"].get(cfg["General"].get("model_name"))
         self.max_seq_length = cfg["General"].getint("max_seq_length")
         self.system_prompt = read_txt(os.path.join(self.path, cfg["DM"].get("prompt")))
+        self.max_new_tokens = cfg["DM"].getint("max_new_tokens", fallback=None)
 
         self.model = model
         self.tokenizer = tokenizer
         self.history = history
         self.logger = setup_logger(self.__class__.__name__, logging_level=logging_level)
-        
-    def query_model(self, input: str, db_results=None):
-        self.logger.info("Generating response from DM component...")
+
+        # Shared running batch of the model when continuous_batching is enabled
+        self.scheduler = get_scheduler(cfg, model, tokenizer)
+        self.prefix_cache = None
+        if cfg["General"].getboolean("prefix_cache", fallback=False):
+            self.prefix_cache = PrefixCache(model, tokenizer)
+            self.prefix_cache.add(self.template.split("{}")[0] + self.system_prompt)
+
+        # (intent, slot names) -> JsonGrammar of the action/parameter output
+        self.constrained_decoding = cfg["General"].getboolean("constrained_decoding", fallback=False)
+        self.grammars = {}
+
+        self.cache = get_generation_cache(cfg, "DM")
+        # Salvage and continuation of the broken outputs, retries of this stage
+        self.recovery = JsonRecovery.from_config(cfg, "DM")
+        self.assembler = PromptAssembler.from_config(cfg, "DM", tokenizer)
+        # Template and system prompt before the history, counted once
+        self.assembler.register("prompt", self.template.format(self.system_prompt + "\n", ""))
+        self.generation_params = {"max_seq_length": self.max_seq_length, "max_new_tokens": self.max_new_tokens, "constrained_decoding": self.constrained_decoding}
+
+    def get_grammar(self, dialogue_state: dict) -> JsonGrammar:
+        # The parameter is either the intent or one of the slots of the input dialogue state
+        intent = dialogue_state["intent"]
+        slots = tuple(dialogue_state.get("slots", {}).keys())
+        if (intent, slots) not in self.grammars:
+            self.grammars[(intent, slots)] = JsonGrammar(dm_schema(intent, list(slots)))
+        return self.grammars[(intent, slots)]
+
+    def grammar_for(self, input) -> JsonGrammar:
+        return self.get_grammar(input) if self.constrained_decoding and isinstance(input, dict) else None
+
+    def build_input(self, input, db_results=None) -> str:
         input = str(input)
         self.logger.debug(f"Input: {input}")
+        if db_results != None:
+            input = "DATABASE RESULTS:\n" + db_results + "\n" + input
+
         if self.history != None:
-            sp = self.system_prompt + "\n" + self.history.get_history()
-            self.logger.debug(f"History: {self.history.get_history()}")
+            # Keep the most recent messages that fit in the token budget
+            sp = self.system_prompt + "\n"
+            fitted = self.assembler.assemble(["prompt"], {"input": input}, [("history", self.history.get_messages(), "last", self.history.get_token_counts())])
+            sp = sp + "".join(fitted["history"])
+            self.logger.debug(f"History: {''.join(fitted['history'])}")
         else:
             sp = self.system_prompt
+
+        return self.template.format(sp, input)
+
+    def parse_response(self, response: str):
+        # The first complete JSON value of the response, the text around it is ignored
+        return self.recovery.parse(response)
+
+    def cache_key(self, input, input_text: str) -> str:
+        if self.cache == None:
+            return None
+        return self.cache.make_key("DM", self.system_prompt, input_text, self.generation_params)
+
+    @tracer.traced("DM.query_model")
+    def query_model(self, input: str, db_results=None):
+        self.logger.info("Generating response from DM component...")
+        grammar = self.grammar_for(input)
+        input_text = self.build_input(input, db_results)
+
+        key = self.cache_key(input, input_text)
+        cached = self.cache.get("DM", key) if key != None else None
+        tracer.current().set("cache_hit", cached != None)
+        if cached != None:
+            output = cached
+        else:
+            inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
+            output = generate(self.model, inputs, self.tokenizer, self.max_seq_length, prefix_cache=self.prefix_cache, max_new_tokens=self.max_new_tokens, stop_on_json=True, grammar=grammar, scheduler=self.scheduler, recovery=self.recovery)
         
-        if db_results != None:
-            input = "DATABASE RESULTS:\n" + db_results + "\n" + input
-            
-        input_text = self.template.format(sp, input)
-        inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
-        response = generate(self.model, inputs, self.tokenizer, self.max_seq_length)
-        
-        try:
-            response = json.loads(response)
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Error parsing response as JSON: {e}")
-            response = None
-        return response
\ No newline at end of file
+        response = self.parse_response(output)
+        # Only outputs that can be parsed are cached, otherwise a retry would get the same output
+        if response != None and cached == None and key != None:
+            self.cache.put("DM", key, output)
+        return response
+
+class RuleDM():
+    """
+    Dialogue manager applying the rules of the DM prompt directly on the dialogue state:
+    buying_car is confirmed when 2 or more slots are filled, the other intents when all
+    their slots are filled, otherwise the first null slot is requested.
+    """
+    def __init__(self, cfg: dict, model=None, tokenizer=None, history=None, logging_level="DEBUG"):
+        self.logger = setup_logger(self.__class__.__name__, logging_level=logging_level)
+
+    @tracer.traced("RuleDM.query_model")
+    def query_model(self, input: dict, db_results=None):
+        self.logger.info("Applying the DM rules...")
+        if isinstance(input, str):
+            try:
+                input = json.loads(input)
+            except json.JSONDecodeError as e:
+                self.logger.error(f"Error parsing dialogue state as JSON: {e}")
+                return None
+        self.logger.debug(f"Input: {input}")
+
+        intent = input["intent"]
+        slots = input.get("slots", {})
+        # The NLU may also return the string "null" or an empty string for a missing value
+        null_slots = [slot for slot, value in slots.items() if value is None or (isinstance(value, str) and value.strip() in ("null", ""))]
+        filled_slots = len(slots) - len(null_slots)
+
+        if intent == "buying_car":
+            confirmed = filled_slots >= 2
+        else:
+            confirmed = len(null_slots) == 0
+
+        if confirmed:
+            return {"action": "confirmation", "parameter": intent}
+        return {"action": "request_info", "parameter": null_slots[0]}
+
+
+def get_dm(cfg: dict, model, tokenizer, history=None, logging_level="DEBUG", policy: str = None):
+    """
+    Instantiate the DM policy selected in config.ini: "llm" (default) or "rule".
+    """
+    policy = policy if policy != None else cfg["DM"].get("policy", fallback="llm")
+    match policy:
+        case "llm":
+            return DM(cfg=cfg, model=model, tokenizer=tokenizer, history=history, logging_level=logging_level)
+        case "rule":
+            return RuleDM(cfg=cfg, model=model, tokenizer=tokenizer, history=history, logging_level=logging_level)
+        case _:
+            raise ValueError(f"Unknown DM policy: {policy}")
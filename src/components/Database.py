@@ -1,29 +1,38 @@
 from src.utils.logging import setup_logger
+from src.utils.storage import get_storage
+from src.utils.tracing import tracer
+from src.utils.slot_extractor import SlotExtractor
+from src.components.StateTracker import get_intent_slots
 import json
 import os
 import re
 
 class Database():
-    def __init__(self, cfg: dict):
+    def __init__(self, cfg: dict, records: list = None):
         # Path project
         self.path = cfg["Settings"].get("path")
         self.path_database = os.path.join(self.path, cfg["DB"].get("path"))
         self.logger = setup_logger(self.__class__.__name__)
-        self.database = self.load_database()
+        # JSON inventory (memory-mapped columnar cache) or SQLite file, selected by backend in [DB].
+        # The records can also be given directly, e.g. by the benchmarks
+        self.storage = get_storage(cfg, records=records, logger=self.logger)
         self.fields = self.get_fields()
+        # Relaxation of the constraints when a search has no result
+        self.max_relaxed = cfg["DB"].getint("max_relaxed", fallback=2)
+        self.top_k = cfg["DB"].getint("top_k", fallback=5)
+        # Gazetteer of the values of the inventory, used by the NLU for the simple messages
+        self.slot_extractor = None
+        if cfg.has_section("NLU") and cfg["NLU"].getboolean("slot_extractor", fallback=False):
+            self.slot_extractor = SlotExtractor.from_storage(self.storage, get_intent_slots())
 
     def load_database(self):
-        with open(self.path_database) as f:
-            data = json.load(f)
-        return data
-    
+        """
+        All the cars of the inventory, with the canonical field names.
+        """
+        return self.storage.all_cars()
+
     def get_fields(self):
-        fields = set()
-        # Ensure the database is not empty before attempting to access its first element
-        if self.database:
-            sample_car = self.database[0]
-            fields.update(sample_car.keys())  # Add all keys (fields) to the set
-        return list(fields)
+        return list(self.storage.fields)
 
     def clean_action(self, action: str):
         match = re.match(r'(\w+)\(([^)]*)\)', action)
@@ -62,69 +71,46 @@ class Database():
 
         return action_name, fields_values
 
+    @tracer.traced("Database.find_cars_for_purchase")
     def find_cars_for_purchase(self, slots: dict):
         self.logger.info("Finding cars for purchase...")
-        result = []
-        for car in self.database:
-            match = True
-            for field, value in slots.items():
-                if value is None:
-                    continue  # Skip None values in slots
+        return str(self.storage.find_cars(slots))
 
-                car_db_field = car.get(field)
+    @tracer.traced("Database.find_cars_relaxed")
+    def find_cars_relaxed(self, slots: dict):
+        """
+        Cars matching all the slots or, if there are none, the top_k nearest cars ranked
+        by the importance of the slots they violate (see JsonStorage.find_cars_relaxed).
+        Returns the list of cars and the list of relaxed slots, from the least important.
+        """
+        self.logger.info("Finding cars for purchase with relaxed constraints...")
+        cars, relaxed = self.storage.find_cars_relaxed(slots, self.max_relaxed, self.top_k)
+        tracer.current().set("results", len(cars))
+        tracer.current().set("relaxed", relaxed)
+        return cars, relaxed
 
-                if car_db_field is None: # If the car does not have the field, it's not a match for that field
-                    match = False
-                    break
-                
-                # Type conversions and comparisons
-                if field == "budget":
-                    try:
-                        car_budget = float(car_db_field)
-                        target_budget = float(value)
-                        if car_budget > target_budget:
-                            match = False
-                            break
-                    except (ValueError, TypeError):
-                        self.logger.warning(f"Could not convert budget for car_id: {car.get('car_id')} or target value: {value}")
-                        match = False
-                        break
-                elif field == "year":
-                    try:
-                        car_year = int(car_db_field)
-                        target_year = int(value)
-                        if car_year < target_year: # Assuming 'year' means car year should be >= target year
-                            match = False
-                            break
-                    except (ValueError, TypeError):
-                        self.logger.warning(f"Could not convert year for car_id: {car.get('car_id')} or target value: {value}")
-                        match = False
-                        break
-                else:
-                    # Case-insensitive comparison for string fields
-                    if isinstance(car_db_field, str) and isinstance(value, str):
-                        if car_db_field.lower() != value.lower():
-                            match = False
-                            break
-                    elif car_db_field != value:
-                        match = False
-                        break
-            if match:
-                result.append(car)
-        return str(result)
+    def compact_rows(self, cars: list, slots: dict) -> list:
+        """
+        Compact JSON of the top_k first cars with only the fields that identify them
+        and the ones requested in the slots.
+        """
+        fields = [field for field in self.fields if field in ("car_id", "brand", "model", "year", "budget") or slots.get(field) != None]
+        return [json.dumps({field: car.get(field) for field in fields}, separators=(",", ":")) for car in cars[:self.top_k]]
 
+    @tracer.traced("Database.find_car_by_id")
     def find_car_by_id(self, car_id: str):
         self.logger.info(f"Finding car with ID: {car_id}...")
         try:
             target_id = int(car_id)
-            for car in self.database:
-                if car.get("car_id") == target_id:
-                    return car
-            return "None" # Return "None" if car not found, to be consistent with string output
         except (ValueError, TypeError):
             self.logger.error(f"Invalid car_id provided: {car_id}")
             return "None"
+        car = self.storage.find_car(target_id)
+        if car is None:
+            return "None" # Return "None" if car not found, to be consistent with string output
+        return car
 
+    @tracer.traced("Database.get_car_info")
     def get_car_info(self, nlu_response: dict):
         self.logger.info("Getting car information from the database...")
         slots = nlu_response['slots']
@@ -132,16 +118,16 @@ class Database():
         if not car_id:
             self.logger.error("No 'car_id' found in the response.")
             return "None"
-        for car in self.database:
-            if car["car_id"] == car_id:
-                if slots["info_type"] in car.keys():
-                    car_info = f"{car['brand']} {car['model']} {slots['info_type']}: {car[slots['info_type']]}"
-                    return car_info
-                else:
-                    self.logger.error(f"Info type '{slots['info_type']}' not found for car_id {car_id}.")
-                    return "None"
-        self.logger.error(f"Car with ID {car_id} not found in the database.")
-        return "None"
+        car = self.storage.find_car(car_id)
+        if car is None:
+            self.logger.error(f"Car with ID {car_id} not found in the database.")
+            return "None"
+        if slots["info_type"] in car.keys():
+            car_info = f"{car['brand']} {car['model']} {slots['info_type']}: {car[slots['info_type']]}"
+            return car_info
+        else:
+            self.logger.error(f"Info type '{slots['info_type']}' not found for car_id {car_id}.")
+            return "None"
         
     
     def query_database(self, intent_data: dict):
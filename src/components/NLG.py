@@ -1,6 +1,10 @@
 from src.utils.utils import *
 from src.utils.logging import setup_logger
-from src.utils.utils_model import generate
+from src.utils.tracing import tracer
+from src.utils.utils_model import generate, get_assistant, PrefixCache
+from src.utils.cache import get_generation_cache
+from src.utils.scheduler import get_scheduler
+from src.utils.prompt import PromptAssembler
 import os
 
 class NLG():
@@ -21,12 +25,43 @@ class NLG():
         self.system_prompt["out_of_domain"] = read_txt(os.path.join(self.path, cfg["NLG"].get("prompt_out_of_domain")))
         self.system_prompt["no_results_found"] = read_txt(os.path.join(self.path, cfg["NLG"].get("prompt_no_results_found")))
         self.system_prompt["combine_responses"] = read_txt(os.path.join(self.path, cfg["NLG"].get("prompt_combine_responses")))
+        self.max_new_tokens = cfg["NLG"].getint("max_new_tokens", fallback=None)
         
         self.model = model
         self.tokenizer = tokenizer
         self.history = history
         self.logger = setup_logger(self.__class__.__name__, logging_level=logging_level)
 
+        # Shared running batch of the model when continuous_batching is enabled
+        self.scheduler = get_scheduler(cfg, model, tokenizer)
+        # Draft model proposing the tokens of the long responses, verified by the model
+        self.assistant = get_assistant(cfg, "NLG")
+        self.prefix_cache = None
+        if cfg["General"].getboolean("prefix_cache", fallback=False):
+            self.prefix_cache = PrefixCache(model, tokenizer)
+            for system_prompt in self.system_prompt.values():
+                self.prefix_cache.add(self.template.split("{}")[0] + system_prompt)
+
+        self.cache = get_generation_cache(cfg, "NLG")
+        self.assembler = PromptAssembler.from_config(cfg, "NLG", tokenizer)
+        # Template and system prompt of each action, counted once
+        for name, system_prompt in self.system_prompt.items():
+            self.assembler.register(name, self.template.format(system_prompt, ""))
+        self.generation_params = {"max_seq_length": self.max_seq_length, "max_new_tokens": self.max_new_tokens}
+
+    def generate_response(self, system_prompt: str, user_input: str) -> str:
+        input_text = self.template.format(system_prompt, user_input)
+        key = self.cache.make_key("NLG", system_prompt, input_text, self.generation_params) if self.cache != None else None
+        response = self.cache.get("NLG", key) if key != None else None
+        tracer.current().set("cache_hit", response != None)
+        if response == None:
+            inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
+            response = generate(self.model, inputs, self.tokenizer, self.max_seq_length, prefix_cache=self.prefix_cache, max_new_tokens=self.max_new_tokens, scheduler=self.scheduler, assistant=self.assistant)
+            if key != None:
+                self.cache.put("NLG", key, response)
+        #* STRIP RESPONSE
+        return response.strip()
+
     def combine_system_prompt(self, dm_response: str, data: str):
         combined_response = {
             "DM Response": dm_response,
@@ -34,33 +69,46 @@ class NLG():
         }
         return combined_response
 
-    def query_model(self, input: str, data: str = None, nlu_response: str = None):
+    def format_results(self, rows: list, total: int, data: str = None) -> str:
+        results = f"Database results: [{', '.join(rows)}]"
+        if len(rows) < total:
+            results += f" (showing {len(rows)} of {total})"
+        return results if data == None else results + "\n" + data
+
+    @tracer.traced("NLG.query_model")
+    def query_model(self, input: str, data: str = None, nlu_response: str = None, db_results: dict = None):
+        """
+        db_results: {"rows": compact rows of the cars, best first, "total": number of cars found}.
+        The rows and the history are shortened to fit the token budget of the NLG,
+        the rows keep priority over the oldest messages.
+        """
         self.logger.info("Generating response from NLG component...")
         # * Check if input is a list in order to combine responses
         if isinstance(input, list):
-            input_text = self.template.format(self.system_prompt["combine_responses"], input)
-            inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
-            response = generate(self.model, inputs, self.tokenizer, self.max_seq_length)
-            #* STRIP RESPONSE
-            response = response.strip()
-            return response
-        
-        if data != None:
-            combined_response = self.combine_system_prompt(input, data)
-        else:
-            combined_response = {"DM Response": input}
+            tracer.current().set("combine", len(input))
+            return self.generate_response(self.system_prompt["combine_responses"], input)
+
+        prompt_name = input["parameter"] if input["action"] == "confirmation" else input["action"]
+        system_prompt = self.system_prompt[prompt_name]
+        rows = db_results["rows"] if db_results != None else []
+        messages = self.history.get_messages() if self.history != None else []
+
+        def build(rows: list, messages: list) -> str:
+            results_data = self.format_results(rows, db_results["total"], data) if db_results != None else data
+            if results_data != None:
+                combined_response = self.combine_system_prompt(input, results_data)
+            else:
+                combined_response = {"DM Response": input}
 
-        if nlu_response != None:
-            combined_response["NLU Response"] = nlu_response
+            if nlu_response != None:
+                combined_response["NLU Response"] = nlu_response
 
+            if self.history != None:
+                combined_response = str(combined_response) + "\n" + "".join(messages)
+            return combined_response
+
+        fitted = self.assembler.assemble([prompt_name], {"input": str(build([], []))}, [("database", rows, "first"), ("history", messages, "last", self.history.get_token_counts() if self.history != None else None)])
         if self.history != None:
-            combined_response = str(combined_response) + "\n" + self.history.get_history()
-            self.logger.debug(f"History: {self.history.get_history()}")
-        
-        input_text = self.template.format(self.system_prompt[input["parameter"] if input["action"] == "confirmation" else input["action"]], combined_response)
-        inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
-        response = generate(self.model, inputs, self.tokenizer, self.max_seq_length)
-        #* STRIP RESPONSE
-        response = response.strip()
-        return response
+            self.logger.debug(f"History: {''.join(fitted['history'])}")
+        return self.generate_response(system_prompt, build(fitted["database"], fitted["history"]))
     
\ No newline at end of file
@@ -1,8 +1,17 @@
 from src.utils.utils import *
-from src.utils.utils_model import generate
+from src.utils.utils_model import generate, generate_batch, PrefixCache
+from src.utils.json_grammar import JsonGrammar, nlu_schema, pre_nlu_schema
+from src.utils.json_recovery import JsonRecovery
+from src.utils.cache import get_generation_cache
+from src.utils.scheduler import get_scheduler
+from src.utils.prompt import PromptAssembler
+from src.utils.intent_classifier import IntentClassifier
+from src.utils.slot_extractor import SlotExtractor
+from src.components.StateTracker import get_intent_slots
 from src.utils.logging import setup_logger
-import json
+from src.utils.tracing import tracer
 import os
+import time
 
 
 class PRE_NLU():
@@ -13,35 +22,97 @@ class PRE_NLU():
         self.template = cfg["TEMPLATES"].get(cfg["General"].get("model_name"))
         self.max_seq_length = cfg["General"].getint("max_seq_length")
         self.system_prompt = read_txt(os.path.join(self.path, cfg["PRE_NLU"].get("prompt")))
+        self.max_new_tokens = cfg["PRE_NLU"].getint("max_new_tokens", fallback=None)
 
         self.model = model
         self.tokenizer = tokenizer
         self.history = history
         self.logger = setup_logger(self.__class__.__name__, logging_level=logging_level)
 
-    def query_model(self, user_input: str):
-        self.logger.info("Generating response from PRE_NLU component...")
-        
+        # Shared running batch of the model when continuous_batching is enabled
+        self.scheduler = get_scheduler(cfg, model, tokenizer)
+        self.prefix_cache = None
+        if cfg["General"].getboolean("prefix_cache", fallback=False):
+            self.prefix_cache = PrefixCache(model, tokenizer)
+            self.prefix_cache.add(self.template.split("{}")[0] + self.system_prompt)
+
+        # Constrain the output to a JSON array of {"intent", "text"} with the known intents
+        self.grammar = None
+        if cfg["General"].getboolean("constrained_decoding", fallback=False):
+            self.grammar = JsonGrammar(pre_nlu_schema(list(get_intent_slots().keys())))
+
+        self.cache = get_generation_cache(cfg, "PRE_NLU")
+        # Salvage and continuation of the broken outputs, retries of this stage
+        self.recovery = JsonRecovery.from_config(cfg, "PRE_NLU")
+        self.assembler = PromptAssembler.from_config(cfg, "PRE_NLU", tokenizer)
+        # Template and system prompt before the history, counted once
+        self.assembler.register("prompt", self.template.format(self.system_prompt + "\n\nHistory:\n", ""))
+        # Local classifier answering the confident single intent messages without the LLM
+        self.fast_path = IntentClassifier.from_config(cfg)
+        self.generation_params = {"max_seq_length": self.max_seq_length, "max_new_tokens": self.max_new_tokens, "constrained_decoding": self.grammar != None}
+
+    def build_input(self, user_input: str, history=None) -> str:
+        """
+        history: history of the session, by default the one given at construction.
+        """
+        history = history if history != None else self.history
+
         sp = self.system_prompt
 
-        if self.history != None:
-            sp = sp + "\n\nHistory:\n" + self.history.get_history()
-            self.logger.debug(f"History: {self.history.get_history()}")
-        else:
-            sp = sp
+        if history != None:
+            # Keep the most recent messages that fit in the token budget
+            sp = sp + "\n\nHistory:\n"
+            fitted = self.assembler.assemble(["prompt"], {"input": user_input}, [("history", history.get_messages(), "last", history.get_token_counts())])
+            sp = sp + "".join(fitted["history"])
+            self.logger.debug(f"History: {''.join(fitted['history'])}")
 
-        input_text = self.template.format(sp, user_input)
-        inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
-        response = generate(self.model, inputs, self.tokenizer, self.max_seq_length)
-        try:
-            response = json.loads(response)
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Error parsing response as JSON: {e}")
-            response = None
+        return self.template.format(sp, user_input)
+
+    def parse_response(self, response: str):
+        # The first complete JSON value of the response, the text around it is ignored
+        return self.recovery.parse(response)
+
+    def cache_key(self, user_input: str, input_text: str) -> str:
+        if self.cache == None:
+            return None
+        return self.cache.make_key("PRE_NLU", self.system_prompt, input_text, self.generation_params)
+
+    def grammar_for(self, user_input: str) -> JsonGrammar:
+        return self.grammar
+
+    @tracer.traced("PRE_NLU.query_model")
+    def query_model(self, user_input: str, history=None):
+        """
+        history: history of the session, by default the one given at construction.
+        """
+        if self.fast_path != None:
+            response = self.fast_path.predict(user_input)
+            tracer.current().set("fast_path", response != None)
+            if response != None:
+                self.logger.debug(f"Fast path: {response}")
+                return response
+        start = time.perf_counter()
+        self.logger.info("Generating response from PRE_NLU component...")
+        input_text = self.build_input(user_input, history)
+
+        key = self.cache_key(user_input, input_text)
+        cached = self.cache.get("PRE_NLU", key) if key != None else None
+        tracer.current().set("cache_hit", cached != None)
+        if cached != None:
+            output = cached
+        else:
+            inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
+            output = generate(self.model, inputs, self.tokenizer, self.max_seq_length, prefix_cache=self.prefix_cache, max_new_tokens=self.max_new_tokens, stop_on_json=True, grammar=self.grammar, scheduler=self.scheduler, recovery=self.recovery)
+        response = self.parse_response(output)
+        # Only outputs that can be parsed are cached, otherwise a retry would get the same output
+        if response != None and cached == None and key != None:
+            self.cache.put("PRE_NLU", key, output)
+        if self.fast_path != None:
+            self.fast_path.record_fallback(time.perf_counter() - start)
         return response
 
 class NLU():
-    def __init__(self, cfg: dict, model, tokenizer, history=None, logging_level="DEBUG"):
+    def __init__(self, cfg: dict, model, tokenizer, history=None, logging_level="DEBUG", extractor=None):
         # Path project
         self.path = cfg["Settings"].get("path")
 
@@ -55,28 +126,150 @@ class NLU():
         self.system_prompt["give_feedback"] = read_txt(os.path.join(self.path, cfg["NLU"].get("prompt_give_feedback")))
         self.system_prompt["book_appointment"] = read_txt(os.path.join(self.path, cfg["NLU"].get("prompt_book_appointment")))
         self.system_prompt["out_of_domain"] = read_txt(os.path.join(self.path, cfg["NLU"].get("prompt_out_of_domain")))
+        self.max_new_tokens = cfg["NLU"].getint("max_new_tokens", fallback=None)
 
         self.model = model
         self.tokenizer = tokenizer
         self.history = history
         self.logger = setup_logger(self.__class__.__name__, logging_level=logging_level)
 
-    def query_model(self, user_input: dict):
-        self.logger.info("Generating response from NLU component...")
+        # Shared running batch of the model when continuous_batching is enabled
+        self.scheduler = get_scheduler(cfg, model, tokenizer)
+        self.prefix_cache = None
+        if cfg["General"].getboolean("prefix_cache", fallback=False):
+            self.prefix_cache = PrefixCache(model, tokenizer)
+            for system_prompt in self.system_prompt.values():
+                self.prefix_cache.add(self.template.split("{}")[0] + system_prompt)
+
+        # Constrain the output of each intent to its slots, as defined by the state trackers
+        self.grammars = None
+        if cfg["General"].getboolean("constrained_decoding", fallback=False):
+            self.grammars = {intent: JsonGrammar(nlu_schema(intent, slots)) for intent, slots in get_intent_slots().items()}
+
+        self.cache = get_generation_cache(cfg, "NLU")
+        # Salvage and continuation of the broken outputs, retries of this stage
+        self.recovery = JsonRecovery.from_config(cfg, "NLU")
+        self.assembler = PromptAssembler.from_config(cfg, "NLU", tokenizer)
+        # Template and system prompt of each intent before the history, counted once
+        for intent, system_prompt in self.system_prompt.items():
+            self.assembler.register(intent, self.template.format(system_prompt + "\n\nHistory:\n", ""))
+        # SlotExtractor of the Database answering the simple messages without the LLM, or None
+        self.extractor = extractor
+        self.generation_params = {"max_seq_length": self.max_seq_length, "max_new_tokens": self.max_new_tokens, "constrained_decoding": self.grammars != None}
+
+    def build_input(self, user_input: dict, history=None) -> str:
         system_prompt = self.system_prompt[user_input["intent"]]
+        history = history if history != None else self.history
 
-        if self.history != None:
-            sp = system_prompt + "\n\nHistory:\n" + self.history.get_history()
-            self.logger.debug(f"History: {self.history.get_history()}")
+        if history != None:
+            # Keep the most recent messages that fit in the token budget
+            sp = system_prompt + "\n\nHistory:\n"
+            fitted = self.assembler.assemble([user_input["intent"]], {"input": user_input["text"]}, [("history", history.get_messages(), "last", history.get_token_counts())])
+            sp = sp + "".join(fitted["history"])
+            self.logger.debug(f"History: {''.join(fitted['history'])}")
         else:
             sp = system_prompt
-        input_text = self.template.format(sp, user_input["text"])
+        return self.template.format(sp, user_input["text"])
+
+    def parse_response(self, response: str):
+        # The first complete JSON value of the response, the text around it is ignored
+        return self.recovery.parse(response)
+
+    def cache_key(self, user_input: dict, input_text: str) -> str:
+        if self.cache == None:
+            return None
+        return self.cache.make_key("NLU", self.system_prompt[user_input["intent"]], input_text, self.generation_params)
+
+    def grammar_for(self, user_input: dict) -> JsonGrammar:
+        return self.grammars[user_input["intent"]] if self.grammars != None else None
+
+    def extract(self, user_input: dict) -> tuple:
+        """
+        (response, slots): the response of the SlotExtractor if it explains the whole message,
+        otherwise None and the slots it found, to complete the response of the LLM.
+        """
+        if self.extractor == None:
+            return None, None
+        slots, complete = self.extractor.extract(user_input["intent"], user_input["text"])
+        tracer.current().set("extracted", complete)
+        if complete:
+            self.logger.debug(f"Slots extracted without the LLM: {slots}")
+            return {"intent": user_input["intent"], "slots": slots}, None
+        return None, slots
+
+    @tracer.traced("NLU.query_model")
+    def query_model(self, user_input: dict, history=None):
+        response, extracted = self.extract(user_input)
+        if response != None:
+            return response
+        return self.query_llm(user_input, history, extracted)
+
+    def query_llm(self, user_input: dict, history=None, extracted: dict = None, input_text: str = None, key: str = None):
+        """
+        Response of the LLM, its null slots completed with the extracted ones. With the
+        input_text built by the caller, the cache key is the one of the caller too and
+        the cache is not looked up again.
+        """
+        self.logger.info("Generating response from NLU component...")
+        if input_text == None:
+            input_text = self.build_input(user_input, history)
+            key = self.cache_key(user_input, input_text)
+            cached = self.cache.get("NLU", key) if key != None else None
+            tracer.current().set("cache_hit", cached != None)
+            if cached != None:
+                return SlotExtractor.fill(self.parse_response(cached), extracted)
+
         inputs = self.tokenizer(input_text, return_tensors="pt").to(self.model.device)
-        response = generate(self.model, inputs, self.tokenizer, self.max_seq_length)
-        # Try to parse the response as JSON
-        try:
-            response = json.loads(response)
-        except json.JSONDecodeError as e:
-            self.logger.error(f"Error parsing response as JSON: {e}")
-            response = None
-        return response
+        grammar = self.grammar_for(user_input)
+        output = generate(self.model, inputs, self.tokenizer, self.max_seq_length, prefix_cache=self.prefix_cache, max_new_tokens=self.max_new_tokens, stop_on_json=True, grammar=grammar, scheduler=self.scheduler, recovery=self.recovery)
+        response = self.parse_response(output)
+        # Only outputs that can be parsed are cached, otherwise a retry would get the same output
+        if response != None and key != None:
+            self.cache.put("NLU", key, output)
+        return SlotExtractor.fill(response, extracted)
+
+    @tracer.traced("NLU.query_batch")
+    def query_batch(self, segments: list, max_retries: int = None, history=None) -> list:
+        """
+        Run the NLU on all the PRE_NLU segments with a single left-padded generate call.
+        Only the segments whose response could not be parsed are generated again,
+        until all of them are parsed or max_retries attempts are done (None = no limit).
+        Returns one parsed response (or None) per segment, in the same order.
+        """
+        self.logger.info(f"Generating batched response from NLU component for {len(segments)} segments...")
+        # The segments explained by the SlotExtractor are answered without the LLM
+        results = [self.extract(segment) for segment in segments]
+        responses = [response for response, _ in results]
+        extracted = [slots for _, slots in results]
+        tracer.current().set("extracted", sum(response != None for response in responses))
+        input_texts = [self.build_input(segment, history) if responses[i] == None else None for i, segment in enumerate(segments)]
+        keys = [self.cache_key(segment, input_text) if input_text != None else None for segment, input_text in zip(segments, input_texts)]
+        if self.cache != None:
+            for i, key in enumerate(keys):
+                cached = self.cache.get("NLU", key) if key != None else None
+                if cached != None:
+                    responses[i] = SlotExtractor.fill(self.parse_response(cached), extracted[i])
+        tracer.current().set("segments", len(segments))
+        tracer.current().set("cache_hits", sum(key != None and response != None for key, response in zip(keys, responses)))
+        pending = [i for i in range(len(segments)) if responses[i] == None]
+        attempts = 0
+        while len(pending) > 0 and (max_retries == None or attempts < max_retries):
+            if attempts > 0:
+                for _ in pending:
+                    self.recovery.record_retry()
+            if len(pending) == 1:
+                # A single sequence does not need padding and can reuse the prefix cache
+                i = pending[0]
+                responses[i] = self.query_llm(segments[i], history, extracted[i], input_text=input_texts[i], key=keys[i])
+            else:
+                inputs = self.tokenizer([input_texts[i] for i in pending], return_tensors="pt", padding=True).to(self.model.device)
+                grammars = [self.grammar_for(segments[i]) for i in pending] if self.grammars != None else None
+                outputs = generate_batch(self.model, inputs, self.tokenizer, self.max_seq_length, max_new_tokens=self.max_new_tokens, stop_on_json=True, grammars=grammars, scheduler=self.scheduler)
+                for i, output in zip(pending, outputs):
+                    responses[i] = SlotExtractor.fill(self.parse_response(output), extracted[i])
+                    if responses[i] != None and keys[i] != None:
+                        self.cache.put("NLU", keys[i], output)
+            pending = [i for i in pending if responses[i] == None]
+            attempts += 1
+        tracer.current().set("attempts", attempts)
+        return responses
@@ -0,0 +1,335 @@
+from src.components.NLU import NLU, PRE_NLU
+from src.components.DM import get_dm
+from src.components.NLG import NLG
+from src.components.Database import Database
+from src.components.StateTracker import *
+from src.utils.utils_model import get_model, get_tokenizer, generate
+from src.utils.scheduler import get_scheduler
+from src.utils.history import History
+from src.utils import snapshot
+from src.utils.logging import setup_logger
+from src.utils.tracing import tracer
+from src.utils.stage_graph import StageGraph, StageExecutor, MODEL_LANE, CPU_LANE
+import uuid
+import time
+import threading
+
+
+class Session():
+    """
+    State of one conversation: its history and its state trackers (intent -> tracker).
+    """
+    def __init__(self, session_id: str = None, initial_message: str = None, history: History = None):
+        self.session_id = session_id if session_id != None else uuid.uuid4().hex
+        self.history = history if history != None else History()
+        self.trackers = {}
+        self.turns = 0
+        if initial_message != None:
+            self.history.add_to_history(sender="System", msg=initial_message)
+
+    def snapshot(self) -> bytes:
+        """
+        Binary snapshot of the session, to resume it with restore() in another process.
+        """
+        trackers = [tracker.get_state() for tracker in self.trackers.values()]
+        return snapshot.dumps((self.session_id, self.turns, trackers, self.history.get_state()))
+
+    @classmethod
+    def restore(cls, data: bytes, history: History = None):
+        """
+        Session of a snapshot. history is an empty history with the window settings and the
+        tokenizer of the pipeline, the messages and the token ids of the window are restored in it.
+        """
+        session_id, turns, trackers, history_state = snapshot.loads(data)
+        session = cls(session_id, history=history)
+        session.turns = turns
+        for intent, values, extra in trackers:
+            tracker = get_state_tracker(intent, values, extra)
+            if tracker == None or len(values) != len(tracker.SLOTS) or not isinstance(extra, dict):
+                raise ValueError(f"Invalid state of intent {intent} in the snapshot")
+            session.trackers[intent] = tracker
+        session.history.set_state(history_state)
+        return session
+
+
+class Pipeline():
+    def __init__(self, config, model=None, tokenizer=None):
+        # Startup times in seconds since the creation of the pipeline
+        self.started = time.perf_counter()
+        self.startup = {}
+        self.config = config
+        self.initial_message = self.config["General"].get("initial_message")
+        # With constrained decoding the outputs are valid JSON by construction,
+        # the retries only bound the unconstrained mode. The stages with a JsonRecovery
+        # use their own max_retries, this one is the default
+        self.max_retries = self.config["General"].getint("max_retries", fallback=3)
+        self.logger = setup_logger(self.__class__.__name__, logging_level="DEBUG", color_debug="DEBUG_MAIN")
+        self.warmup_tokens = self.config["General"].getint("warmup_tokens", fallback=0)
+        self.model_ready = threading.Event()
+        self.components_ready = threading.Event()
+        self.model_error = None
+        tracer.configure(config)
+        # Runs the stages of the turns, overlapping the database lookups with the generations
+        self.stage_executor = StageExecutor.from_config(config)
+        # The model can be given directly, e.g. to share it with other pipelines
+        lazy = model is None and self.config["General"].getboolean("lazy_loading", fallback=False)
+        if model is None and not lazy:
+            model, tokenizer = get_model(config)
+        elif lazy:
+            # The weights load in the background while the database, the prompts and the
+            # grammars are prepared, the model is given to the components when it is ready
+            tokenizer = get_tokenizer(config)
+        self.model, self.tokenizer = model, tokenizer
+        if lazy:
+            threading.Thread(target=self.load_model, name="model-loader", daemon=True).start()
+        self.define_components()
+        self.components_ready.set()
+        if not lazy:
+            self.model_ready.set()
+        self.startup["components"] = time.perf_counter() - self.started
+
+    def define_components(self):
+        # The components are shared by all the sessions, the history is given at each call
+        self.database = Database(self.config)
+        self.pre_nlu = PRE_NLU(cfg=self.config, model=self.model, tokenizer=self.tokenizer, logging_level="ERROR")
+        self.nlu = NLU(cfg=self.config, model=self.model, tokenizer=self.tokenizer, logging_level="ERROR", extractor=self.database.slot_extractor)
+        self.dm = get_dm(cfg=self.config, model=self.model, tokenizer=self.tokenizer, logging_level="ERROR")
+        self.nlg = NLG(cfg=self.config, model=self.model, tokenizer=self.tokenizer, logging_level="ERROR")
+        # Running batch shared by the components, None without continuous_batching
+        self.scheduler = get_scheduler(self.config, self.model, self.tokenizer)
+
+    def load_model(self):
+        try:
+            model, _ = get_model(self.config, tokenizer=self.tokenizer)
+            self.startup["model_loaded"] = time.perf_counter() - self.started
+            self.components_ready.wait()
+            self.set_model(model)
+            self.warmup()
+            self.startup["model_ready"] = time.perf_counter() - self.started
+            self.logger.info(f"Model ready after {self.startup['model_ready']:.1f} s")
+        except Exception as e:
+            self.logger.error(f"The model could not be loaded: {e}")
+            self.model_error = e
+        finally:
+            self.model_ready.set()
+
+    def set_model(self, model):
+        # Give the loaded model to the components built without it
+        self.model = model
+        for component in [self.pre_nlu, self.nlu, self.dm, self.nlg]:
+            if not hasattr(component, "model"):
+                continue
+            component.model = model
+            if component.prefix_cache != None:
+                component.prefix_cache.model = model
+            component.scheduler = get_scheduler(self.config, model, self.tokenizer)
+        self.scheduler = get_scheduler(self.config, model, self.tokenizer)
+
+    def warmup(self):
+        """
+        Compute the KV caches of the system prompts and run a short generation, so that
+        the first turn does not pay for the first kernels and allocations.
+        """
+        for component in [self.pre_nlu, self.nlu, self.dm, self.nlg]:
+            if getattr(component, "prefix_cache", None) != None:
+                component.prefix_cache.warmup()
+        if self.warmup_tokens > 0:
+            inputs = self.tokenizer(self.initial_message, return_tensors="pt").to(self.model.device)
+            generate(self.model, inputs, self.tokenizer, self.config["General"].getint("max_seq_length"), max_new_tokens=self.warmup_tokens)
+
+    def wait_model(self):
+        if not self.model_ready.is_set():
+            self.logger.info("Waiting for the model to be loaded...")
+        self.model_ready.wait()
+        if self.model_error != None:
+            raise self.model_error
+
+    def update_state_tracker(self, session, nlu_response):
+        # Check the intent and create or update the corresponding state tracker
+        intent = nlu_response["intent"]
+        if not isinstance(intent, str) or intent not in STATE_TRACKERS:
+            # Without constrained decoding the NLU can return any intent: the turn is answered
+            # as out of domain instead of stopping the process (and the server with it)
+            self.logger.error(f"Intent {intent} not recognized, handled as out_of_domain")
+            intent = "out_of_domain"
+            nlu_response = {"intent": intent, "slots": {}}
+        state_tracker = session.trackers.get(intent)
+        if state_tracker == None:
+            self.logger.info(f"Creating new state tracker for intent: {intent}")
+            # Instantiate the state tracker if it doesn't already exist
+            state_tracker = get_state_tracker(intent)
+            session.trackers[intent] = state_tracker
+        state_tracker.update_dialogue_state(nlu_response)
+        return state_tracker.get_dialogue_state()
+
+    def query_with_retries(self, query, *args, **kwargs):
+        # Generate again only while the output cannot be parsed, at most max_retries times
+        recovery = getattr(query.__self__, "recovery", None)
+        max_retries = recovery.max_retries if recovery != None else self.max_retries
+        with tracer.span(f"{query.__self__.__class__.__name__}.retries") as span:
+            for attempt in range(1, max_retries + 1):
+                span.set("attempts", attempt)
+                if attempt > 1 and recovery != None:
+                    recovery.record_retry()
+                response = query(*args, **kwargs)
+                if response != None:
+                    return response
+        return None
+
+    def new_session(self, session_id: str = None) -> Session:
+        return Session(session_id, initial_message=self.initial_message, history=History.from_config(self.config, self.tokenizer))
+
+    def restore_session(self, data: bytes) -> Session:
+        """
+        Session of a snapshot taken by Session.snapshot(), possibly in another process.
+        """
+        return Session.restore(data, history=History.from_config(self.config, self.tokenizer))
+
+    def process_turn(self, session: Session, user_input: str) -> str:
+        """
+        Answer one message of a session, updating its history and state trackers.
+        """
+        self.wait_model()
+        session.turns += 1
+        # Root span of the turn, every component call of the turn is nested in it
+        with tracer.span("turn", session_id=session.session_id, turn=session.turns):
+            return self.answer_turn(session, user_input)
+
+    def answer_turn(self, session: Session, user_input: str) -> str:
+        pre_nlu_response = self.query_with_retries(self.pre_nlu.query_model, user_input, history=session.history)
+        if pre_nlu_response == None:
+            self.logger.error("PRE_NLU output could not be parsed, handling the message as out of domain")
+            pre_nlu_response = [{"intent": "out_of_domain", "text": user_input}]
+
+        self.logger.debug(f"PRE_NLU Response: {pre_nlu_response}")
+
+        results = self.stage_executor.run(self.turn_graph(session, pre_nlu_response))
+        nlg_responses = [results[f"nlg_{i}"] for i in range(len(pre_nlu_response))]
+        nlg_response = results["combine"] if "combine" in results else nlg_responses[0]
+
+        # Update the history with the user input
+        session.history.add_to_history(sender="User", msg=user_input)
+        # Update the history with the system response
+        session.history.add_to_history(sender="System", msg=nlg_response)
+        return nlg_response
+
+    def turn_graph(self, session: Session, pre_nlu_response: list) -> StageGraph:
+        """
+        Stages of a turn: the NLU of all the segments at once, then for each segment the state
+        update, the DM, the database lookups and the NLG, and the NLG combining the responses.
+        The state of a segment is updated after the DM of the previous one, which can remove a
+        tracker, so the trackers change in the order of the segments. The database lookups and the
+        state of the next segment run while the model generates.
+        """
+        model_lane = lambda component: MODEL_LANE if hasattr(component, "model") else CPU_LANE
+        graph = StageGraph()
+        # Run the NLU on all the segments at once, only the failed ones are retried
+        graph.add("nlu", lambda results: self.nlu.query_batch(pre_nlu_response, max_retries=self.nlu.recovery.max_retries, history=session.history), lane=MODEL_LANE)
+        previous_dm = None
+        for i, elem in enumerate(pre_nlu_response):
+            graph.add(f"state_{i}", lambda results, i=i, elem=elem: self.state_stage(session, elem, results["nlu"][i]), deps=["nlu", previous_dm], kind="state")
+            previous_dm = graph.add(f"dm_{i}", lambda results, i=i: self.dm_stage(session, results[f"state_{i}"]), deps=[f"state_{i}"], lane=model_lane(self.dm), kind="dm")
+            graph.add(f"database_{i}", lambda results, i=i: self.database_stage(results[f"state_{i}"], results[f"dm_{i}"]), deps=[f"state_{i}", f"dm_{i}"], kind="database")
+            graph.add(f"nlg_{i}", lambda results, i=i: self.nlg_stage(results[f"state_{i}"], *results[f"database_{i}"]), deps=[f"state_{i}", f"database_{i}"], lane=MODEL_LANE, kind="nlg")
+        if len(pre_nlu_response) > 1:
+            nlg_stages = [f"nlg_{i}" for i in range(len(pre_nlu_response))]
+            graph.add("combine", lambda results: self.nlg.query_model(input=[results[name] for name in nlg_stages]), deps=nlg_stages, lane=MODEL_LANE)
+        return graph
+
+    def state_stage(self, session: Session, elem: dict, nlu_response: dict) -> dict:
+        if nlu_response == None:
+            self.logger.error(f"NLU output could not be parsed for {elem}, no slot is updated")
+            nlu_response = {"intent": elem["intent"], "slots": {}}
+        self.logger.debug(f"NLU Response: {nlu_response}")
+        # Update the state tracker
+        json = self.update_state_tracker(session, nlu_response)
+
+        self.logger.debug(f"Dialogue State: {json}")
+        return json
+
+    def dm_stage(self, session: Session, json: dict) -> dict:
+        dm_response = self.query_with_retries(self.dm.query_model, json)
+        if dm_response == None:
+            self.logger.error("DM output could not be parsed, answering as out of domain")
+            dm_response = {"action": "out_of_domain", "parameter": "out_of_domain"}
+
+        self.logger.debug(f"DM Response: {dm_response}")
+
+        # Remove from the state tracker the state if the action is confirmation
+        if dm_response["action"] == "confirmation":
+            if session.trackers.pop(dm_response["parameter"], None) != None:
+                self.logger.info(f"State tracker of {dm_response['parameter']} removed")
+            else:
+                self.logger.debug(f"No state tracker of {dm_response['parameter']} in the session")
+        return dm_response
+
+    def database_stage(self, json: dict, dm_response: dict) -> tuple:
+        """
+        (dm_response, data, db_results) given to the NLG, the action becomes no_results_found
+        when the database has nothing for a confirmed intent.
+        """
+        dm_response = dict(dm_response)
+        data = None
+        db_results = None
+        if dm_response["action"] == "confirmation" and dm_response["parameter"] == "get_car_info":
+            results = self.database.get_car_info(json)
+            self.logger.debug(f"Get car info result: {results}")
+            if results == "None":
+                dm_response["action"] = "no_results_found"
+            else:
+                data = f"{results}"
+        if dm_response["action"] == "confirmation" and dm_response["parameter"] == "negotiate_price":
+            results = self.database.find_car_by_id(json["slots"]["car_id"])
+            self.logger.debug(f"Negotiate price result: {results}")
+            if results == "None":
+                dm_response["action"] = "no_results_found"
+            else:
+                data = f"\nCar: {results['brand']} {results['model']}\nUser price: {json['slots']['proposed_price']}\nSystem price: {results['budget']-results['negotiable'][1] if results['negotiable'][0]=='Yes' else results['budget']}\n"
+        if dm_response["action"] == "confirmation" and dm_response["parameter"] == "buying_car":
+            self.logger.debug(f"Current dialogue state: {json}")
+            # Exact matches, or the nearest cars and the constraints relaxed to find them
+            results, constraints_relaxed = self.database.find_cars_relaxed(json["slots"])
+            self.logger.debug(f"Database Results: {results}")
+            for slot in constraints_relaxed:
+                self.logger.info("Constraint relaxed: " + slot)
+            # Only the top rows with the relevant fields are given to the NLG
+            db_results = {"rows": self.database.compact_rows(results, json["slots"]), "total": len(results)}
+            if len(constraints_relaxed) > 0:
+                data = f"Constraints relaxed: {', '.join(constraints_relaxed)}"
+            if len(results) == 0:
+                dm_response["action"] = "no_results_found"
+
+        if dm_response["parameter"] == "booking_appointment":
+            data += f"Current date: 01/06/2025, Time: 10:00 AM" 
+        if dm_response["action"] == "confirmation" and dm_response["parameter"] == "order_car":
+            results = self.database.find_car_by_id(json["slots"]["car_id"])
+            self.logger.debug(f"Order car result: {results}")
+            if results == "None":
+                dm_response["action"] = "no_results_found"
+            else:
+                data = f"Car ordered: {results}"
+        return dm_response, data, db_results
+
+    def nlg_stage(self, json: dict, dm_response: dict, data: str, db_results: dict) -> str:
+        nlg_response = self.nlg.query_model(input=dm_response, data=data, nlu_response=json, db_results=db_results)
+        self.logger.debug(f"NLG Response: {nlg_response}")
+        return nlg_response
+
+    def run(self):
+        session = self.new_session()
+        self.logger.info(f"System: {self.initial_message}")
+        self.startup["first_prompt"] = time.perf_counter() - self.started
+        self.logger.info(f"Ready for the first message after {self.startup['first_prompt']:.1f} s")
+
+        user_input = ""
+
+        while user_input != "exit":
+            user_input = input("User: ")
+            if user_input == "exit":
+                self.logger.info("Exiting the conversation...")
+                break
+            nlg_response = self.process_turn(session, user_input)
+            self.logger.info(f"Carllama: {nlg_response}")
+            if "first_response" not in self.startup:
+                self.startup["first_response"] = time.perf_counter() - self.started
+                self.logger.info(f"First response after {self.startup['first_response']:.1f} s since startup")
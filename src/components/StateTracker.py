@@ -1,173 +1,124 @@
-from abc import ABC, abstractmethod
-from copy import deepcopy
 from src.utils.logging import setup_logger
 
-class DialogueStateTracker(ABC):
-    def __init__(self):
-        self.dialogue_state = {}
+class DialogueStateTracker():
+    """
+    Dialogue state of one intent. The values of the slots are kept in a list following
+    the order of SLOTS, the dict {"intent", "slots"} read by the DM and the NLG is built
+    by get_dialogue_state(). Slots returned by the NLU but unknown to the intent are kept
+    in extra, after the ones of SLOTS.
+    """
+    __slots__ = ("values", "extra")
+    INTENT = None
+    SLOTS = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Slot name -> position in values, and a logger shared by the trackers of the intent
+        cls.INDEX = {slot: i for i, slot in enumerate(cls.SLOTS)}
+        cls.logger = setup_logger(cls.__name__)
+
+    def __init__(self, values: list = None, extra: dict = None):
+        self.values = list(values) if values != None else [None] * len(self.SLOTS)
+        self.extra = dict(extra) if extra != None else {}
 
     def get_dialogue_state(self):
         """
         Returns the current dialogue state.
         """
-        return self.dialogue_state
+        slots = dict(zip(self.SLOTS, self.values))
+        slots.update(self.extra)
+        return {"intent": self.INTENT, "slots": slots}
 
     def update_dialogue_state(self, nlu_response: dict):
         """
-        Updates the dialogue state with the cleaned NLU response.
-        """
-        self.logger.debug(f"Dialogue state before update: {self.dialogue_state}")
-        self.dialogue_state = DialogueStateTracker.update(self.dialogue_state, DialogueStateTracker.clean_response(nlu_response))
-        self.logger.debug(f"Dialogue state after update: {self.dialogue_state}")
-    
-    @staticmethod
-    def clean_response(response: dict) -> dict:
-        final_dict = deepcopy(response)
-        for key, value in response.items():
-            if value == None:
-                del final_dict[key]
-            elif isinstance(value, dict):
-                cleaned_dict = DialogueStateTracker.clean_response(deepcopy(value))
-                if len(cleaned_dict) == 0:
-                    del final_dict[key]
-                else:
-                    final_dict[key] = cleaned_dict
-        return final_dict
-    
-    @staticmethod
-    def update(ds: dict, nlu_response: dict) -> dict:
-        for key, value in nlu_response.items():
-            if value is None or value == 'null':
-                ds[key] = None
-                continue
-            # If the value is a dictionary, merge recursively
-            if isinstance(value, dict):
-                if key not in ds or not isinstance(ds[key], dict):
-                    ds[key] = {}
-                ds[key] = DialogueStateTracker.update(ds[key], value)
-            else:
-                # For non-dict values, overwrite directly
-                ds[key] = value
-        return ds
+        Updates the dialogue state with the slots of the NLU response: None keeps the
+        current value, "null" clears it. Slots unknown to the intent are merged in extra
+        with the same rules.
+        """
+        slots = nlu_response.get("slots")
+        if not isinstance(slots, dict):
+            return
+        for slot, value in slots.items():
+            i = self.INDEX.get(slot)
+            if i == None:
+                if value == "null":
+                    self.extra[slot] = None
+                elif value != None:
+                    self.extra[slot] = value
+            elif value == "null":
+                self.values[i] = None
+            elif value != None:
+                self.values[i] = value
+        self.logger.debug(f"Dialogue state after update: {self.values} {self.extra}")
+
+    def get_state(self) -> tuple:
+        # (intent, slot values, unknown slots), the form saved in the session snapshots
+        return (self.INTENT, list(self.values), dict(self.extra))
 
 
 class BuyingStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the BuyingStateTracker with a default dialogue state.
-        """
-        super().__init__()
-
-        self.dialogue_state = {
-            "intent": "buying_car",
-            "slots": {
-                "car_type": None,
-                "budget": None,
-                "brand": None,
-                "model": None,
-                "year": None,
-                "fuel_type": None,
-                "transmission": None
-            }
-        }
-        self.logger = setup_logger(self.__class__.__name__)
+    __slots__ = ()
+    INTENT = "buying_car"
+    SLOTS = ("car_type", "budget", "brand", "model", "year", "fuel_type", "transmission")
 
 
 class GettingInfoStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the GettingInfoStateTracker with a default dialogue state.
-        """
-        super().__init__()
+    __slots__ = ()
+    INTENT = "get_car_info"
+    SLOTS = ("car_id", "info_type")
 
-        self.dialogue_state = {
-            "intent": "get_car_info",
-            "slots": {
-                "car_id": None,
-                "info_type": None
-            }
-        }
-        self.logger = setup_logger(self.__class__.__name__)
 
 class NegotiatePriceStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the NegotiatePriceStateTracker with a default dialogue state.
-        """
-        super().__init__()
+    __slots__ = ()
+    INTENT = "negotiate_price"
+    SLOTS = ("car_id", "proposed_price")
 
-        self.dialogue_state = {
-            "intent": "negotiate_price",
-            "slots": {
-                "car_id": None,
-                "proposed_price": None
-            }
-        }
-        self.logger = setup_logger(self.__class__.__name__)
 
 class OrderCarStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the OrderCarStateTracker with a default dialogue state.
-        """
-        super().__init__()
-
-        self.dialogue_state = {
-            "intent": "order_car",
-            "slots": {
-                "car_id": None,
-                "price": None,
-                "name": None,
-                "surname": None,
-                "id": None,
-            } 
-        }
-        self.logger = setup_logger(self.__class__.__name__)
+    __slots__ = ()
+    INTENT = "order_car"
+    SLOTS = ("car_id", "price", "name", "surname", "id")
+
 
 class BookAppointmentStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the BookAppointmentStateTracker with a default dialogue state.
-        """
-        super().__init__()
-
-        self.dialogue_state = {
-            "intent": "book_appointment",
-            "slots": {
-                "date": None,
-                "time": None,
-                "name": None,
-                "surname": None,
-                "id": None,
-            }
-        }
-        self.logger = setup_logger(self.__class__.__name__)
+    __slots__ = ()
+    INTENT = "book_appointment"
+    SLOTS = ("date", "time", "name", "surname", "id")
+
 
 class GiveFeedbackStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the GiveFeedbackStateTracker with a default dialogue state.
-        """
-        super().__init__()
+    __slots__ = ()
+    INTENT = "give_feedback"
+    SLOTS = ("rating", "comments")
 
-        self.dialogue_state = {
-            "intent": "give_feedback",
-            "slots": {
-                "rating": None,
-                "comments": None,
-            }
-        }
-        self.logger = setup_logger(self.__class__.__name__)
 
 class OutOfDomainStateTracker(DialogueStateTracker):
-    def __init__(self):
-        """
-        Initializes the OutOfDomainStateTracker with a default dialogue state.
-        """
-        super().__init__()
-
-        self.dialogue_state = {
-            "intent": "out_of_domain",
-            "slots": {}
-        }
-        self.logger = setup_logger(self.__class__.__name__)
\ No newline at end of file
+    __slots__ = ()
+    INTENT = "out_of_domain"
+    SLOTS = ()
+
+
+# Intent -> state tracker class
+STATE_TRACKERS = {
+    "buying_car": BuyingStateTracker,
+    "get_car_info": GettingInfoStateTracker,
+    "negotiate_price": NegotiatePriceStateTracker,
+    "order_car": OrderCarStateTracker,
+    "give_feedback": GiveFeedbackStateTracker,
+    "book_appointment": BookAppointmentStateTracker,
+    "out_of_domain": OutOfDomainStateTracker,
+}
+
+def get_state_tracker(intent: str, values: list = None, extra: dict = None) -> DialogueStateTracker:
+    """
+    New state tracker of the intent, with the given slot values and unknown slots.
+    None for an unknown intent.
+    """
+    tracker = STATE_TRACKERS.get(intent)
+    return tracker(values, extra) if tracker != None else None
+
+def get_intent_slots() -> dict:
+    """
+    Returns the slot names of each intent.
+    """
+    return {intent: list(tracker.SLOTS) for intent, tracker in STATE_TRACKERS.items()}
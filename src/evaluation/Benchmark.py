@@ -0,0 +1,640 @@
+import json
+import time
+import os
+import sys
+import random
+import tempfile
+import tracemalloc
+import configparser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+from statistics import mean
+from src.utils.logging import setup_logger
+from src.components.NLU import NLU, PRE_NLU
+from src.components.DM import DM, get_dm
+from src.components.NLG import NLG
+from src.components.Database import Database
+from src.components.Pipeline import Pipeline, Session
+from src.components.StateTracker import get_intent_slots, get_state_tracker
+from src.utils.history import History
+from src.utils.column_store import ColumnStore, load_columns
+from src.utils.storage import JsonStorage, SQLiteStorage
+from src.utils.utils_model import get_model, load_model, model_memory, get_assistant, AssistedDecoding
+from src.utils.stub_model import get_stub_model
+
+
+class GenerationCounter():
+    """
+    Count the prompt and generated tokens of the model.generate calls made inside a with block.
+    """
+    def __init__(self, model):
+        self.model = model
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+
+    def __enter__(self):
+        generate = self.model.generate
+
+        def counting_generate(input_ids, *args, **kwargs):
+            output = generate(input_ids, *args, **kwargs)
+            attention_mask = kwargs.get("attention_mask")
+            self.prompt_tokens += int(attention_mask.sum()) if attention_mask is not None else input_ids.numel()
+            self.generated_tokens += (output.shape[1] - input_ids.shape[1]) * output.shape[0]
+            return output
+
+        self.model.generate = counting_generate
+        return self
+
+    def __exit__(self, *args):
+        # Back to the generate method of the class
+        del self.model.generate
+
+
+class Benchmark():
+    def __init__(self, cfg: dict, model=None, tokenizer=None):
+        self.cfg = cfg
+        self.model = model
+        self.tokenizer = tokenizer
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+    def load_json(self, path: str):
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def get_model(self):
+        # The model is only needed by the benchmarks that generate text
+        if self.model is None:
+            self.model, self.tokenizer = get_model(self.cfg)
+        return self.model, self.tokenizer
+
+    def time_to_first_token(self, input_text: str, prefix_cache=None) -> float:
+        model, tokenizer = self.get_model()
+        inputs = tokenizer(input_text, return_tensors="pt").to(model.device)
+        start = time.perf_counter()
+        past_key_values = prefix_cache.lookup(inputs.input_ids) if prefix_cache != None else None
+        with torch.no_grad():
+            model.generate(
+                inputs.input_ids,
+                attention_mask=inputs.attention_mask,
+                max_new_tokens=1,
+                pad_token_id=tokenizer.eos_token_id,
+                past_key_values=past_key_values,
+            )
+        return time.perf_counter() - start
+
+    def benchmark_prefix_cache(self, repetitions: int = 3):
+        """
+        Measure the time to first token of every component with and without the
+        KV cache of the static system prompt.
+        """
+        model, tokenizer = self.get_model()
+        pre_nlu = PRE_NLU(cfg=self.cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        nlu = NLU(cfg=self.cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        dm = DM(cfg=self.cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        nlg = NLG(cfg=self.cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+
+        nlu_cases = self.load_json(self.cfg["EVALUATION"].get("nlu_test_cases"))
+        pre_nlu_cases = self.load_json(self.cfg["EVALUATION"].get("pre_nlu_test_cases"))
+
+        # (component name, component, system prompt, user input)
+        cases = []
+        for el in pre_nlu_cases[:repetitions]:
+            cases.append(("PRE_NLU", pre_nlu, pre_nlu.system_prompt, el["input"]))
+        for el in nlu_cases[:repetitions]:
+            cases.append(("NLU", nlu, nlu.system_prompt[el["input"]["intent"]], el["input"]["text"]))
+        for el in nlu_cases[:repetitions]:
+            cases.append(("DM", dm, dm.system_prompt, str(el["expected_output"])))
+        for el in nlu_cases[:repetitions]:
+            dm_response = {"action": "confirmation", "parameter": el["input"]["intent"]}
+            cases.append(("NLG", nlg, nlg.system_prompt[el["input"]["intent"]], str({"DM Response": dm_response, "NLU Response": el["expected_output"]})))
+
+        results = {}
+        for name, component, system_prompt, user_input in cases:
+            input_text = component.template.format(system_prompt, user_input)
+            prefix_cache = component.prefix_cache
+            if prefix_cache == None:
+                self.logger.error("Prefix cache disabled in config.ini, set prefix_cache=True in [General]")
+                return None
+            # Build the prefix cache outside of the measured region
+            prefix_cache.warmup()
+
+            without_cache = self.time_to_first_token(input_text)
+            with_cache = self.time_to_first_token(input_text, prefix_cache=prefix_cache)
+            results.setdefault(name, {"without_cache": [], "with_cache": []})
+            results[name]["without_cache"].append(without_cache)
+            results[name]["with_cache"].append(with_cache)
+
+        for name, times in results.items():
+            before = mean(times["without_cache"])
+            after = mean(times["with_cache"])
+            self.logger.info(f"{name}: time to first token {before * 1000:.1f} ms -> {after * 1000:.1f} ms ({before / after:.2f}x)")
+        return results
+
+    def synthetic_cars(self, size: int, seed: int = 0) -> list:
+        """
+        Generate size random cars with the fields and values of the configured dataset.
+        """
+        database = Database(self.cfg)
+        inventory = database.load_database()
+        values = {field: sorted({json.dumps(car[field]) for car in inventory}) for field in database.fields}
+        rng = random.Random(seed)
+        cars = []
+        for car_id in range(1, size + 1):
+            car = {field: json.loads(rng.choice(values[field])) for field in database.fields}
+            car["car_id"] = car_id
+            car["year"] = rng.randint(2015, 2025)
+            car["budget"] = round(rng.uniform(5000, 60000), 2)
+            cars.append(car)
+        return cars
+
+    @staticmethod
+    def linear_scan(cars: list, slots: dict) -> list:
+        # Reference implementation: the per-car scan that Database used before the column store
+        result = []
+        for car in cars:
+            match = True
+            for field, value in slots.items():
+                if value is None:
+                    continue
+                car_db_field = car.get(field)
+                if car_db_field is None:
+                    match = False
+                elif field == "budget":
+                    match = float(car_db_field) <= float(value)
+                elif field == "year":
+                    match = int(car_db_field) >= int(value)
+                elif isinstance(car_db_field, str) and isinstance(value, str):
+                    match = car_db_field.lower() == value.lower()
+                else:
+                    match = car_db_field == value
+                if not match:
+                    break
+            if match:
+                result.append(car)
+        return result
+
+    def benchmark_database(self, sizes: tuple = (10_000, 100_000, 1_000_000), repetitions: int = 5):
+        """
+        Compare the column store query engine of Database with a linear scan on synthetic inventories.
+        """
+        queries = [
+            {"brand": "bmw", "budget": "30000"},
+            {"car_type": "Family_car", "fuel_type": "Petrol", "transmission": "Automatic"},
+            {"year": "2022", "budget": "20000"},
+            {"brand": "Fiat", "model": "Panda", "year": "2020"},
+        ]
+        results = {}
+        for size in sizes:
+            cars = self.synthetic_cars(size)
+            start = time.perf_counter()
+            database = Database(self.cfg, records=cars)
+            build_time = time.perf_counter() - start
+
+            scan_times, indexed_times = [], []
+            for slots in queries:
+                for _ in range(repetitions):
+                    start = time.perf_counter()
+                    expected = self.linear_scan(cars, slots)
+                    scan_times.append(time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    ids = database.storage.filter_cars(slots)
+                    indexed_times.append(time.perf_counter() - start)
+                assert [car["car_id"] for car in expected] == [database.storage.store.value("car_id", i) for i in ids]
+
+            start = time.perf_counter()
+            for car_id in random.Random(size).sample(range(1, size + 1), 1000):
+                database.find_car_by_id(car_id)
+            lookup_time = (time.perf_counter() - start) / 1000
+
+            results[size] = {"build": build_time, "scan": mean(scan_times), "indexed": mean(indexed_times), "find_car_by_id": lookup_time}
+            self.logger.info(f"{size} cars: build {build_time:.2f} s, query {mean(scan_times) * 1000:.2f} ms (scan) -> {mean(indexed_times) * 1000:.3f} ms (indexed), find_car_by_id {lookup_time * 1e6:.1f} us")
+        return results
+
+    def benchmark_database_startup(self, size: int = 1_000_000):
+        """
+        Startup time and memory of a JSON inventory of size cars: json.load into an in-memory store,
+        compilation of the columnar cache, and memory-mapped loading of the compiled cache.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            source_path = os.path.join(directory, "inventory.json")
+            with open(source_path, "w") as f:
+                json.dump(self.synthetic_cars(size), f)
+
+            def measure(load):
+                start = time.perf_counter()
+                load()
+                elapsed = time.perf_counter() - start
+                # Peak memory allocated by a second load, traced separately as tracing slows it down
+                tracemalloc.start()
+                load()
+                memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                return elapsed, memory
+
+            def load_json():
+                with open(source_path) as f:
+                    return ColumnStore(json.load(f))
+
+            columns_path = os.path.join(directory, "columns")
+            results = {}
+            start = time.perf_counter()
+            load_columns(source_path, columns_path)
+            self.logger.info(f"{size} cars, compilation of the columnar cache: {time.perf_counter() - start:.2f} s")
+            for name, load in [("json", load_json), ("mmap", lambda: load_columns(source_path, columns_path))]:
+                elapsed, memory = measure(load)
+                results[name] = {"time": elapsed, "peak_memory": memory}
+                self.logger.info(f"{size} cars, {name} startup: {elapsed:.2f} s, peak {memory / 2**20:.1f} MiB allocated")
+        return results
+
+    def benchmark_storage(self, sizes: tuple = (100_000, 1_000_000), repetitions: int = 5, threads: int = 4):
+        """
+        Compare the JSON (column store) and SQLite storages on synthetic inventories:
+        exact and relaxed searches, car_id lookups, and the throughput of concurrent sessions.
+        """
+        queries = [
+            {"brand": "bmw", "budget": "30000"},
+            {"car_type": "Family_car", "fuel_type": "Petrol", "transmission": "Automatic"},
+            {"brand": "Fiat", "model": "Panda", "year": "2024", "budget": "6000"},
+        ]
+        max_relaxed = self.cfg["DB"].getint("max_relaxed", fallback=2)
+        top_k = self.cfg["DB"].getint("top_k", fallback=5)
+        results = {}
+        for size in sizes:
+            cars = self.synthetic_cars(size)
+            with tempfile.TemporaryDirectory() as directory:
+                start = time.perf_counter()
+                storages = {"json": JsonStorage(records=cars)}
+                build = {"json": time.perf_counter() - start}
+                start = time.perf_counter()
+                storages["sqlite"] = SQLiteStorage(os.path.join(directory, "inventory.sqlite"), pool_size=threads)
+                storages["sqlite"].insert_cars(cars)
+                build["sqlite"] = time.perf_counter() - start
+
+                def run_queries(storage):
+                    return [storage.find_cars_relaxed(slots, max_relaxed, top_k) for slots in queries]
+
+                answers = {}
+                results[size] = {}
+                for name, storage in storages.items():
+                    search_times = []
+                    for _ in range(repetitions):
+                        start = time.perf_counter()
+                        answers[name] = run_queries(storage)
+                        search_times.append((time.perf_counter() - start) / len(queries))
+
+                    start = time.perf_counter()
+                    for car_id in random.Random(size).sample(range(1, size + 1), 1000):
+                        storage.find_car(car_id)
+                    lookup_time = (time.perf_counter() - start) / 1000
+
+                    # Sessions querying concurrently
+                    start = time.perf_counter()
+                    with ThreadPoolExecutor(max_workers=threads) as executor:
+                        list(executor.map(lambda _: run_queries(storage), range(threads * repetitions)))
+                    throughput = threads * repetitions * len(queries) / (time.perf_counter() - start)
+
+                    results[size][name] = {"build": build[name], "search": mean(search_times), "find_car": lookup_time, "throughput": throughput}
+                    self.logger.info(f"{size} cars, {name}: build {build[name]:.2f} s, search {mean(search_times) * 1000:.2f} ms, find_car {lookup_time * 1e6:.1f} us, {throughput:.1f} searches/s with {threads} threads")
+
+                for (json_cars, json_relaxed), (sqlite_cars, sqlite_relaxed) in zip(answers["json"], answers["sqlite"]):
+                    assert [car["car_id"] for car in json_cars] == [car["car_id"] for car in sqlite_cars] and json_relaxed == sqlite_relaxed
+        return results
+
+    def stage_config(self) -> configparser.ConfigParser:
+        # Every call must reach the model: no generation cache, no shared batch, no intent classifier
+        # and no slot extractor
+        cfg = configparser.ConfigParser()
+        cfg.read_dict(self.cfg)
+        if cfg.has_section("CACHE"):
+            cfg["CACHE"]["enabled"] = "False"
+        cfg["General"]["continuous_batching"] = "False"
+        cfg["PRE_NLU"]["fast_path"] = "False"
+        cfg["NLU"]["slot_extractor"] = "False"
+        if not cfg.has_section("BENCHMARK"):
+            cfg["BENCHMARK"] = {}
+        return cfg
+
+    def benchmark_stages(self, repetitions: int = None, update_baseline: bool = False) -> dict:
+        """
+        Latency of PRE_NLU, NLU, DM, NLG, the Database search and a full Pipeline turn on the
+        CPU, with the model given to Benchmark or the one of [BENCHMARK] model (a deterministic
+        stub by default, see get_stub_model). Reports p50/p95/p99 latency, the prompt and
+        generated tokens per call and the peak memory allocated by Python objects, then
+        compares the latencies and prompt sizes with the stored baseline.
+        Returns {"stages": ..., "regressions": [...]}.
+        """
+        cfg = self.stage_config()
+        repetitions = repetitions if repetitions != None else cfg["BENCHMARK"].getint("repetitions", fallback=20)
+        tolerance = cfg["BENCHMARK"].getfloat("tolerance", fallback=0.25)
+        baseline_path = os.path.join(cfg["Settings"].get("path"), cfg["BENCHMARK"].get("baseline", fallback="src/evaluation/data/benchmark_baseline.json"))
+        baseline_key = cfg["BENCHMARK"].get("model", fallback="stub") if self.model is None else "custom"
+
+        if self.model is None:
+            self.model, self.tokenizer = get_stub_model(cfg)
+        model, tokenizer = self.model, self.tokenizer
+
+        pre_nlu = PRE_NLU(cfg=cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        nlu = NLU(cfg=cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        dm = get_dm(cfg=cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        nlg = NLG(cfg=cfg, model=model, tokenizer=tokenizer, logging_level="ERROR")
+        database = Database(cfg)
+        pipeline = Pipeline(cfg, model=model, tokenizer=tokenizer)
+
+        nlu_cases = self.load_json(cfg["EVALUATION"].get("nlu_test_cases"))
+        pre_nlu_cases = self.load_json(cfg["EVALUATION"].get("pre_nlu_test_cases"))
+        buying_slots = [el["expected_output"]["slots"] for el in nlu_cases if el["expected_output"]["intent"] == "buying_car"]
+
+        def nlg_turn(i: int):
+            el = nlu_cases[i % len(nlu_cases)]
+            return nlg.query_model({"action": "confirmation", "parameter": el["input"]["intent"]}, nlu_response=el["expected_output"])
+
+        # stage -> function of the repetition index, cycling through the test cases
+        stages = {
+            "PRE_NLU": lambda i: pre_nlu.query_model(pre_nlu_cases[i % len(pre_nlu_cases)]["input"]),
+            "NLU": lambda i: nlu.query_model(nlu_cases[i % len(nlu_cases)]["input"]),
+            "DM": lambda i: dm.query_model(nlu_cases[i % len(nlu_cases)]["expected_output"]),
+            "NLG": nlg_turn,
+            "Database": lambda i: database.find_cars_relaxed(buying_slots[i % len(buying_slots)]),
+            "Pipeline": lambda i: pipeline.process_turn(pipeline.new_session(), pre_nlu_cases[i % len(pre_nlu_cases)]["input"]),
+        }
+
+        results = {}
+        for name, run in stages.items():
+            # Untimed call building the prefix caches and grammars
+            run(0)
+            times = []
+            with GenerationCounter(model) as counter:
+                for i in range(repetitions):
+                    start = time.perf_counter()
+                    run(i)
+                    times.append(time.perf_counter() - start)
+            # Allocations traced in a separate call as tracing slows it down, tensors are not traced
+            tracemalloc.start()
+            run(0)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            p50, p95, p99 = np.percentile(times, [50, 95, 99])
+            results[name] = {
+                "p50": float(p50),
+                "p95": float(p95),
+                "p99": float(p99),
+                "prompt_tokens": counter.prompt_tokens / repetitions,
+                "generated_tokens": counter.generated_tokens / repetitions,
+                "peak_memory": peak,
+            }
+            self.logger.info(
+                f"{name}: p50 {p50 * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms, "
+                f"{results[name]['prompt_tokens']:.0f} prompt / {results[name]['generated_tokens']:.0f} generated tokens, "
+                f"peak {peak / 2**20:.2f} MiB allocated"
+            )
+
+        baselines = self.load_json(baseline_path) if os.path.exists(baseline_path) else {}
+        regressions = []
+        if baseline_key in baselines and not update_baseline:
+            for name, result in results.items():
+                base = baselines[baseline_key].get(name)
+                if base == None:
+                    continue
+                # The 1 ms of slack keeps the fastest stages from failing on timer noise
+                for metric in ["p50", "p95"]:
+                    limit = base[metric] * (1 + tolerance) + 0.001
+                    if result[metric] > limit:
+                        regressions.append(f"{name} {metric} {result[metric] * 1000:.2f} ms > {limit * 1000:.2f} ms")
+                if result["prompt_tokens"] > base["prompt_tokens"] * (1 + tolerance):
+                    regressions.append(f"{name} prompt tokens {result['prompt_tokens']:.0f} > {base['prompt_tokens'] * (1 + tolerance):.0f}")
+            for regression in regressions:
+                self.logger.error(f"Regression: {regression}")
+            if len(regressions) == 0:
+                self.logger.info(f"No regression beyond {tolerance * 100:.0f}% of the baseline {baseline_key}")
+        else:
+            baselines[baseline_key] = results
+            if os.path.dirname(baseline_path) != "":
+                os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+            with open(baseline_path, "w") as f:
+                json.dump(baselines, f, indent=2)
+            self.logger.info(f"Baseline {baseline_key} saved to {baseline_path}")
+        return {"stages": results, "regressions": regressions}
+
+
+    def benchmark_quantization(self, variants: tuple = (("bf16", "none"), ("fp32", "none"), ("fp32", "int8")), model_name: str = None, repetitions: int = 3, max_new_tokens: int = 64):
+        """
+        Decoding speed (tokens/s) and weight memory on the CPU of the model loaded with each
+        (dtype, quantization), on PRE_NLU prompts of the test cases. model_name defaults to
+        the configured model, it can also be the path of a local model.
+        """
+        model_name = model_name if model_name != None else self.cfg["MODELS"].get(self.cfg["General"].get("model_name"))
+        folder_model = os.path.join(self.cfg["Settings"].get("path"), self.cfg["General"].get("folder_model"))
+        cases = self.load_json(self.cfg["EVALUATION"].get("pre_nlu_test_cases"))[:repetitions]
+        results = {}
+        for dtype, quantization in variants:
+            start = time.perf_counter()
+            model, tokenizer = load_model(model_name, folder_model, dtype, device="cpu", quantization=quantization)
+            load_time = time.perf_counter() - start
+            pre_nlu = PRE_NLU(cfg=self.stage_config(), model=model, tokenizer=tokenizer, logging_level="ERROR")
+            generated, elapsed = 0, 0.0
+            for el in cases:
+                inputs = tokenizer(pre_nlu.build_input(el["input"]), return_tensors="pt")
+                start = time.perf_counter()
+                with torch.no_grad():
+                    # Fixed number of new tokens, so that every variant decodes the same amount
+                    output = model.generate(inputs.input_ids, attention_mask=inputs.attention_mask, max_new_tokens=max_new_tokens, min_new_tokens=max_new_tokens, pad_token_id=tokenizer.pad_token_id)
+                elapsed += time.perf_counter() - start
+                generated += output.shape[1] - inputs.input_ids.shape[1]
+            name = quantization if quantization != "none" else dtype
+            results[name] = {"tokens_per_second": generated / elapsed, "weights_memory": model_memory(model), "load_time": load_time}
+            self.logger.info(f"{name}: {results[name]['tokens_per_second']:.2f} tokens/s, {results[name]['weights_memory'] / 2**30:.2f} GiB of weights, loaded in {load_time:.1f} s")
+            del model, pre_nlu
+        return results
+
+    def benchmark_assisted_decoding(self, draft_model=None):
+        """
+        Turn latency of the recorded conversations ([EVALUATION] conversations) replayed through
+        the Pipeline with and without assisted decoding of the NLG, with the draft model of
+        [MODELS] (or the one given). Checks that the responses are identical and reports the
+        acceptance rate of the draft tokens.
+        """
+        cfg = self.stage_config()
+        model, tokenizer = self.get_model()
+        pipeline = Pipeline(cfg, model=model, tokenizer=tokenizer)
+        if draft_model != None:
+            assistant = AssistedDecoding(draft_model, "NLG")
+        else:
+            cfg["NLG"]["assisted_decoding"] = "True"
+            assistant = get_assistant(cfg, "NLG")
+        conversations = self.load_json(cfg["EVALUATION"].get("conversations"))
+
+        def replay() -> tuple:
+            responses, times = [], []
+            for conversation in conversations:
+                session = pipeline.new_session(conversation["id"])
+                for turn in conversation["turns"]:
+                    start = time.perf_counter()
+                    responses.append(pipeline.process_turn(session, turn))
+                    times.append(time.perf_counter() - start)
+            return responses, times
+
+        # Untimed turn building the prefix caches and grammars
+        pipeline.process_turn(pipeline.new_session(), conversations[0]["turns"][0])
+        pipeline.nlg.assistant = None
+        baseline_responses, baseline_times = replay()
+        pipeline.nlg.assistant = assistant
+        assisted_responses, assisted_times = replay()
+        pipeline.nlg.assistant = None
+
+        results = {
+            "turns": len(baseline_times),
+            "baseline_turn_latency": mean(baseline_times),
+            "assisted_turn_latency": mean(assisted_times),
+            "speedup": sum(baseline_times) / sum(assisted_times),
+            "identical": baseline_responses == assisted_responses,
+            **assistant.stats(),
+        }
+        self.logger.info(
+            f"{results['turns']} turns: {results['baseline_turn_latency']:.2f} s -> {results['assisted_turn_latency']:.2f} s per turn "
+            f"(x{results['speedup']:.2f}), acceptance rate {results['acceptance_rate'] * 100:.1f}%, "
+            f"{results['tokens_per_step']:.2f} NLG tokens per step"
+        )
+        if not results["identical"]:
+            self.logger.warning("Assisted decoding changed some responses, check that the model decodes greedily")
+        return results
+
+    def benchmark_stage_overlap(self):
+        """
+        Recorded conversations ([EVALUATION] conversations) replayed with the stages of each turn
+        run one after the other and overlapped. Checks that the responses are identical and
+        reports per kind of stage the time spent and the time on the critical path of the turns.
+        """
+        model, tokenizer = self.get_model()
+        conversations = self.load_json(self.cfg["EVALUATION"].get("conversations"))
+        results, responses = {}, {}
+        for overlap in [False, True]:
+            cfg = self.stage_config()
+            cfg["General"]["overlap_stages"] = str(overlap)
+            pipeline = Pipeline(cfg, model=model, tokenizer=tokenizer)
+            name = "overlapped" if overlap else "sequential"
+            responses[name] = []
+            for conversation in conversations:
+                session = pipeline.new_session(conversation["id"])
+                for turn in conversation["turns"]:
+                    responses[name].append(pipeline.process_turn(session, turn))
+            results[name] = pipeline.stage_executor.stats()
+            self.logger.info(
+                f"{name}: {results[name]['mean_wall_time']:.3f} s per turn, critical path {results[name]['mean_critical_path']:.3f} s, "
+                f"{results[name]['mean_stage_time']:.3f} s of stages"
+            )
+            for kind, stats in results[name]["stages"].items():
+                self.logger.info(f"{name}, {kind}: {stats['mean_time']:.3f} s per turn, {stats['mean_critical_time']:.3f} s on the critical path")
+        results["identical"] = responses["sequential"] == responses["overlapped"]
+        if not results["identical"]:
+            self.logger.warning("The overlapped stages changed some responses")
+        return results
+
+    def benchmark_json_recovery(self):
+        """
+        Recorded conversations ([EVALUATION] conversations) replayed without constrained decoding,
+        first regenerating every output that is not exactly JSON (no salvage, no continuation),
+        then with the salvage parser and the continuations of [PRE_NLU], [NLU] and [DM].
+        Reports the retries and the generated tokens thrown away by each stage.
+        """
+        model, tokenizer = self.get_model()
+        conversations = self.load_json(self.cfg["EVALUATION"].get("conversations"))
+        results = {}
+        for name in ["retries", "recovery"]:
+            cfg = self.stage_config()
+            cfg["General"]["constrained_decoding"] = "False"
+            if name == "retries":
+                for section in ["PRE_NLU", "NLU", "DM"]:
+                    cfg[section]["salvage"] = "False"
+                    cfg[section]["max_continuations"] = "0"
+            pipeline = Pipeline(cfg, model=model, tokenizer=tokenizer)
+            for conversation in conversations:
+                session = pipeline.new_session(conversation["id"])
+                for turn in conversation["turns"]:
+                    pipeline.process_turn(session, turn)
+            stages = {stage: component.recovery.stats() for stage, component in [("PRE_NLU", pipeline.pre_nlu), ("NLU", pipeline.nlu), ("DM", pipeline.dm)] if hasattr(component, "recovery")}
+            results[name] = {
+                "stages": stages,
+                "retries": sum(stats["retries"] for stats in stages.values()),
+                "wasted_tokens": sum(stats["wasted_tokens"] for stats in stages.values()),
+            }
+            for stage, stats in stages.items():
+                self.logger.info(f"{name}, {stage}: {stats}")
+            self.logger.info(f"{name}: {results[name]['retries']} retries, {results[name]['wasted_tokens']} generated tokens thrown away")
+        return results
+
+    def benchmark_startup(self, model_name: str = None, think_time: float = 0.0):
+        """
+        Time to the first prompt (the pipeline accepts a message) and to the first response
+        of a new Pipeline loading the model eagerly and lazily, the user sending the first
+        message think_time seconds after the prompt. model_name defaults to the configured
+        model, it can also be the path of a local model.
+        """
+        message = self.load_json(self.cfg["EVALUATION"].get("pre_nlu_test_cases"))[0]["input"]
+        results = {}
+        for lazy in [False, True]:
+            cfg = self.stage_config()
+            cfg["General"]["lazy_loading"] = str(lazy)
+            if model_name != None:
+                cfg["MODELS"][cfg["General"].get("model_name")] = model_name
+            start = time.perf_counter()
+            pipeline = Pipeline(cfg)
+            first_prompt = time.perf_counter() - start
+            session = pipeline.new_session()
+            time.sleep(think_time)
+            pipeline.process_turn(session, message)
+            first_response = time.perf_counter() - start
+            name = "lazy" if lazy else "eager"
+            results[name] = {"first_prompt": first_prompt, "first_response": first_response, "model_ready": pipeline.startup.get("model_ready", first_prompt)}
+            self.logger.info(f"{name}: first prompt after {first_prompt:.2f} s, model ready after {results[name]['model_ready']:.2f} s, first response after {first_response:.2f} s")
+            del pipeline
+        return results
+
+    def benchmark_session_snapshot(self, turns: int = 20, repetitions: int = 1000):
+        """
+        Size of the snapshot of a session of turns turns with a state tracker per intent, and
+        the time to take it, to restore it, and to rebuild the session by adding its messages again.
+        """
+        tokenizer = self.tokenizer if self.tokenizer != None else get_stub_model(self.stage_config())[1]
+        messages = [case["input"] for case in self.load_json(self.cfg["EVALUATION"].get("pre_nlu_test_cases"))]
+        session = Session(initial_message=self.cfg["General"].get("initial_message"), history=History.from_config(self.cfg, tokenizer))
+        for i in range(turns):
+            session.history.add_to_history(sender="User", msg=messages[i % len(messages)])
+            session.history.add_to_history(sender="System", msg=messages[(i + 1) % len(messages)])
+        for intent, slots in get_intent_slots().items():
+            session.trackers[intent] = get_state_tracker(intent, [f"{slot}_value" for slot in slots])
+
+        def measure(function) -> float:
+            start = time.perf_counter()
+            for _ in range(repetitions):
+                function()
+            return (time.perf_counter() - start) / repetitions
+
+        data = session.snapshot()
+        restored = Session.restore(data, History.from_config(self.cfg, tokenizer))
+        assert restored.history.get_history() == session.history.get_history()
+        assert [tracker.get_dialogue_state() for tracker in restored.trackers.values()] == [tracker.get_dialogue_state() for tracker in session.trackers.values()]
+
+        def rebuild():
+            history = History.from_config(self.cfg, tokenizer)
+            for sender, msg in zip(session.history.senders, session.history.msgs):
+                history.add_to_history(sender=sender, msg=msg)
+
+        results = {
+            "size": len(data),
+            "snapshot": measure(session.snapshot),
+            "restore": measure(lambda: Session.restore(data, History.from_config(self.cfg, tokenizer))),
+            "rebuild": measure(rebuild),
+        }
+        self.logger.info(f"{turns} turns, snapshot of {results['size']} bytes taken in {results['snapshot'] * 1e3:.3f} ms, restored in {results['restore'] * 1e3:.3f} ms, rebuilt from the messages in {results['rebuild'] * 1e3:.3f} ms")
+        return results
+
+if __name__ == "__main__":
+    # python -m src.evaluation.Benchmark [--update-baseline], CPU only and without network,
+    # exits with 1 when a stage regressed beyond the baseline
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    config["Settings"] = {"path": os.getcwd()}
+    results = Benchmark(cfg=config).benchmark_stages(update_baseline="--update-baseline" in sys.argv)
+    sys.exit(1 if len(results["regressions"]) > 0 else 0)
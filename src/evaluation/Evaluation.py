@@ -2,29 +2,194 @@ from sklearn.preprocessing import MultiLabelBinarizer
 from sklearn.metrics import classification_report
 from src.utils.logging import setup_logger
 from src.components.NLU import NLU, PRE_NLU
-from src.components.DM import DM
+from src.components.DM import get_dm
 from src.components.NLG import NLG
 from src.utils.history import History
-from src.utils.utils_model import get_model
+from src.utils.utils_model import get_model, generate_batch
+from src.utils.tracing import tracer
+from src.utils.intent_classifier import IntentClassifier, MULTI_INTENT, load_training_cases
+from src.utils.slot_extractor import SlotExtractor
+from src.components.Database import Database
+from src.components.StateTracker import get_intent_slots
+from sklearn.model_selection import StratifiedKFold
 from tqdm import tqdm
+from statistics import mean
+import configparser
+import copy
+import gc
+import hashlib
+import json
+import time
+import os
 
 
 class Evaluation():
-    def __init__(self, cfg: dict):
+    def __init__(self, cfg: dict, model=None, tokenizer=None):
         self.cfg = cfg
-        self.model, self.tokenizer = get_model(self.cfg)
+        # The model can be given, e.g. the one of a Pipeline, instead of loading another copy
+        if model is None:
+            model, tokenizer = get_model(self.cfg)
+        self.model, self.tokenizer = model, tokenizer
         self.logger = setup_logger(self.__class__.__name__)
-        self.history = History()
+        tracer.configure(self.cfg)
+        self.history = History.from_config(self.cfg, self.tokenizer)
+        self.batch_size = self.cfg["EVALUATION"].getint("batch_size", fallback=8)
+        self.max_retries = self.cfg["EVALUATION"].getint("max_retries", fallback=5)
+        self.checkpoint_dir = self.cfg["EVALUATION"].get("checkpoint_dir", fallback="cache/evaluation")
 
     def load_json(self, path: str):
-        import json
         with open(path, 'r') as file:
             return json.load(file)
 
-    def test_dm(self, is_history: bool = False):
-        dm = DM(cfg=self.cfg, model=self.model, tokenizer=self.tokenizer, history=self.history if is_history else None, logging_level="ERROR")
+    def load_case_history(self, el: dict, is_history: bool):
+        if is_history:
+            self.history.clear_history()
+            if "history" in el:
+                for msg in el["history"]:
+                    self.history.add_to_history(msg["sender"], msg["msg"])
+
+    def checkpoint_path(self, name: str, component, is_history: bool, test_cases: list) -> str:
+        """
+        JSONL file of the per-case results of a run, named after everything that changes
+        the outputs: component, prompts and template, generation parameters, model, history
+        and test cases.
+        """
+        identity = json.dumps([
+            component.__class__.__name__,
+            getattr(component, "system_prompt", None),
+            getattr(component, "template", None),
+            getattr(component, "generation_params", None),
+            self.cfg["General"].get("model_name"),
+            self.cfg["General"].get("dtype"),
+            self.cfg["General"].get("quantization", fallback="none"),
+            self.cfg["General"].getboolean("constrained_decoding", fallback=False),
+            is_history,
+            # The results are stored by case index, so they only apply to the same cases in the same order
+            test_cases,
+        ], sort_keys=True)
+        digest = hashlib.sha256(identity.encode()).hexdigest()[:16]
+        return os.path.join(self.checkpoint_dir, f"{name.lower()}_{digest}.jsonl")
+
+    def load_checkpoint(self, path: str) -> dict:
+        # case index -> {"case", "response", "attempts", "latency"}
+        done = {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Last line of an interrupted write
+                        continue
+                    done[record["case"]] = record
+        return done
+
+    def run_cases(self, name: str, component, test_cases: list, inputs: list, is_history: bool, batched: bool = False, resume: bool = True) -> tuple:
+        """
+        Responses of a component to the inputs of the test cases, with up to max_retries
+        generations for the outputs that cannot be parsed. Every finished case is appended
+        to a JSONL checkpoint, so that an interrupted run starts again from the first
+        missing case. In batched mode the prompts are grouped by token length and each
+        group is generated with a single generate call.
+        Returns (responses, stats) with stats the cases/s, retry rate and mean latency.
+        """
+        path = self.checkpoint_path(name, component, is_history, test_cases)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not resume and os.path.exists(path):
+            os.remove(path)
+        done = self.load_checkpoint(path)
+        pending = [i for i in range(len(test_cases)) if i not in done]
+        if len(done) > 0:
+            self.logger.info(f"{name}: resuming from {path}, {len(done)} of {len(test_cases)} cases already done")
+
+        loading_bar = tqdm(total=len(test_cases), initial=len(done), desc=f"Testing {name}", unit="test case")
+        start = time.perf_counter()
+        with open(path, "a") as checkpoint:
+            def save(i: int, response, attempts: int, latency: float):
+                done[i] = {"case": i, "response": response, "attempts": attempts, "latency": latency}
+                checkpoint.write(json.dumps(done[i]) + "\n")
+                checkpoint.flush()
+                loading_bar.update(1)
+
+            # Components without a model (rule based DM) have nothing to batch
+            if batched and getattr(component, "model", None) != None:
+                self.run_batched(name, component, test_cases, inputs, pending, is_history, save)
+            else:
+                for i in pending:
+                    self.load_case_history(test_cases[i], is_history)
+                    response, attempts = None, 0
+                    case_start = time.perf_counter()
+                    while response is None and attempts < self.max_retries:
+                        response = component.query_model(inputs[i])
+                        attempts += 1
+                    save(i, response, attempts, time.perf_counter() - case_start)
+        loading_bar.close()
+        elapsed = time.perf_counter() - start
+
+        records = [done[i] for i in range(len(test_cases))]
+        attempts = sum(record["attempts"] for record in records)
+        stats = {
+            # Only the cases generated in this run count for the throughput
+            "cases_per_second": len(pending) / elapsed if len(pending) > 0 and elapsed > 0 else None,
+            "retry_rate": (attempts - len(records)) / len(records) if len(records) > 0 else 0.0,
+            "mean_latency": mean(record["latency"] for record in records) if len(records) > 0 else 0.0,
+        }
+        return [record["response"] for record in records], stats
+
+    def run_batched(self, name: str, component, test_cases: list, inputs: list, pending: list, is_history: bool, save):
+        # The prompts are built once, the retries only generate again the unparsed outputs
+        texts, keys = {}, {}
+        for i in pending:
+            self.load_case_history(test_cases[i], is_history)
+            texts[i] = component.build_input(inputs[i])
+            keys[i] = component.cache_key(inputs[i], texts[i])
+        lengths = {i: len(self.tokenizer(texts[i]).input_ids) for i in pending}
+        latencies = {i: 0.0 for i in pending}
+        attempts = {i: 0 for i in pending}
+
+        for i in pending:
+            cached = component.cache.get(name, keys[i]) if keys[i] != None else None
+            response = component.parse_response(cached) if cached != None else None
+            if response != None:
+                attempts[i] = 1
+                save(i, response, 1, 0.0)
+        pending = [i for i in pending if attempts[i] == 0]
+
+        while len(pending) > 0:
+            # Similar lengths in the same batch keep the padding small
+            ordered = sorted(pending, key=lambda i: lengths[i])
+            failed = []
+            for b in range(0, len(ordered), self.batch_size):
+                batch = ordered[b : b + self.batch_size]
+                grammars = [component.grammar_for(inputs[i]) for i in batch]
+                batch_start = time.perf_counter()
+                encoded = self.tokenizer([texts[i] for i in batch], return_tensors="pt", padding=True).to(self.model.device)
+                outputs = generate_batch(
+                    self.model, encoded, self.tokenizer, component.max_seq_length, max_new_tokens=component.max_new_tokens,
+                    stop_on_json=True, grammars=grammars if None not in grammars else None, scheduler=component.scheduler,
+                )
+                batch_time = time.perf_counter() - batch_start
+                for i, output in zip(batch, outputs):
+                    attempts[i] += 1
+                    latencies[i] += batch_time
+                    response = component.parse_response(output)
+                    if response != None and keys[i] != None:
+                        component.cache.put(name, keys[i], output)
+                    if response != None or attempts[i] >= self.max_retries:
+                        save(i, response, attempts[i], latencies[i])
+                    else:
+                        failed.append(i)
+            pending = failed
+
+    def log_stats(self, name: str, stats: dict):
+        throughput = f"{stats['cases_per_second']:.2f} cases/s" if stats["cases_per_second"] != None else "no new cases"
+        self.logger.info(f"{name}: {throughput}, retry rate {stats['retry_rate']:.2f}, mean latency {stats['mean_latency'] * 1000:.0f} ms")
+
+    def test_dm(self, is_history: bool = False, policy: str = None, batched: bool = False, resume: bool = True):
+        dm = get_dm(cfg=self.cfg, model=self.model, tokenizer=self.tokenizer, history=self.history if is_history else None, logging_level="ERROR", policy=policy)
 
         test_cases = self.load_json(self.cfg["EVALUATION"].get("nlu_test_cases"))
+        responses, stats = self.run_cases("DM", dm, test_cases, [el["expected_output"] for el in test_cases], is_history, batched, resume)
 
         correct_actions = 0
         total_actions = 0
@@ -32,24 +197,9 @@ class Evaluation():
         correct_parameters = 0
         total_parameters = 0
 
-        loading_bar = tqdm(test_cases, desc="Testing DM", unit="test case")
-
-        for el in loading_bar:
+        for el, dm_response in zip(test_cases, responses):
             input = el["expected_output"]
 
-            if is_history:
-                self.history.clear_history()
-                if "history" in el:
-                    for msg in el["history"]:
-                        self.history.add_to_history(msg["sender"], msg["msg"])
-                        
-                        
-            dm_response = None
-            count = 5
-            while dm_response is None and count > 0:
-                dm_response = dm.query_model(input)
-                count -= 1
-
             if dm_response is None:
                 total_actions += 1
                 total_parameters += 1
@@ -91,36 +241,95 @@ class Evaluation():
                 else:
                     self.logger.error(f"DM response does not contain 'parameter': {dm_response} for input: {input}")
 
-            loading_bar.set_postfix({"Acc": f"{(correct_actions / total_actions) * 100:.2f}%", "Param Acc": f"{(correct_parameters / total_parameters) * 100:.2f}%"})
-
-    def test_nlu(self, is_history: bool = False):
-
+        results = {
+            "action_accuracy": correct_actions / total_actions,
+            "parameter_accuracy": correct_parameters / total_parameters,
+            **stats,
+        }
+        if getattr(dm, "cache", None) != None:
+            self.logger.info(f"Cache: {dm.cache.stats()}")
+        self.logger.info(f"DM {dm.__class__.__name__}: action accuracy {results['action_accuracy'] * 100:.2f}%, parameter accuracy {results['parameter_accuracy'] * 100:.2f}%, mean latency {results['mean_latency'] * 1000:.3f} ms")
+        self.log_stats(f"DM {dm.__class__.__name__}", stats)
+        return results
+
+    def compare_dm(self, is_history: bool = False):
+        """
+        Compare accuracy and latency of the LLM and rule based DM policies.
+        """
+        llm = self.test_dm(is_history=is_history, policy="llm")
+        rule = self.test_dm(is_history=is_history, policy="rule")
+        self.logger.info(f"Rule DM is {llm['mean_latency'] / rule['mean_latency']:.0f}x faster, action accuracy {llm['action_accuracy'] * 100:.2f}% -> {rule['action_accuracy'] * 100:.2f}%, parameter accuracy {llm['parameter_accuracy'] * 100:.2f}% -> {rule['parameter_accuracy'] * 100:.2f}%")
+        return {"llm": llm, "rule": rule}
+
+    def test_nlu(self, is_history: bool = False, batched: bool = False, resume: bool = True, slot_extractor: bool = False):
+        """
+        slot_extractor: also score the NLU with the SlotExtractor of the inventory in front
+        of the LLM and report the accuracy delta, the fraction of messages answered without
+        the LLM and the estimated latency saved.
+        """
+        # The LLM alone is evaluated, the extractor is applied to its responses afterwards
         nlu = NLU(cfg=self.cfg, model=self.model, tokenizer=self.tokenizer, history=self.history if is_history else None, logging_level="ERROR")
 
         test_cases = self.load_json(self.cfg["EVALUATION"].get("nlu_test_cases"))
-
+        responses, stats = self.run_cases("NLU", nlu, test_cases, [el["input"] for el in test_cases], is_history, batched, resume)
+
+        if nlu.cache != None:
+            self.logger.info(f"Cache: {nlu.cache.stats()}")
+
+        intent_accuracy, slot_accuracy = self.score_nlu(test_cases, responses)
+        results = {"intent_accuracy": intent_accuracy, "slot_accuracy": slot_accuracy, **stats}
+        self.logger.info(f"NLU: intent accuracy {results['intent_accuracy'] * 100:.2f}%, slot accuracy {results['slot_accuracy'] * 100:.2f}%")
+        self.log_stats("NLU", stats)
+
+        if slot_extractor:
+            extractor = SlotExtractor.from_storage(Database(self.cfg).storage, get_intent_slots())
+            extracted_responses = []
+            for el, response in zip(test_cases, responses):
+                slots, complete = extractor.extract(el["input"]["intent"], el["input"]["text"])
+                extracted_responses.append({"intent": el["input"]["intent"], "slots": slots} if complete else SlotExtractor.fill(copy.deepcopy(response), slots))
+            _, results["extractor_slot_accuracy"] = self.score_nlu(test_cases, extracted_responses, log=False)
+            results["extractor_skipped"] = extractor.stats()["skipped"]
+            results["extractor_latency"] = extractor.stats()["mean_extract_latency"]
+            results["latency_saved"] = extractor.hits * stats["mean_latency"] - extractor.extract_time
+            results["extractor_regressions"] = self.check_slot_extractor(extractor)
+            self.logger.info(
+                f"NLU slot extractor: {results['extractor_skipped'] * 100:.1f}% of the messages without the LLM, "
+                f"slot accuracy {results['extractor_slot_accuracy'] * 100:.2f}% "
+                f"({(results['extractor_slot_accuracy'] - results['slot_accuracy']) * 100:+.2f} points), "
+                f"{results['extractor_latency'] * 1000:.2f} ms per message, about {results['latency_saved']:.1f} s of generation saved"
+            )
+        return results
+
+    def check_slot_extractor(self, extractor: SlotExtractor) -> int:
+        """
+        Messages of slot_extractor_test_cases that the extractor must leave to the LLM (car
+        referred to by the history, relative constraints) or answer with the expected slots.
+        Returns the number of cases failed.
+        """
+        test_cases = self.load_json(self.cfg["EVALUATION"].get("slot_extractor_test_cases"))
+        failed = 0
+        for el in test_cases:
+            slots, complete = extractor.parse(el["input"]["intent"], el["input"]["text"])
+            expected = el["expected_output"]
+            if complete != expected["complete"] or any(slots.get(slot) != value for slot, value in expected["slots"].items()):
+                self.logger.error(f"Slot extractor case failed:\nInput: {el['input']}\nExpected: {expected}\nGot: {slots}, complete={complete}")
+                failed += 1
+        self.logger.info(f"NLU slot extractor: {len(test_cases) - failed}/{len(test_cases)} edge cases passed")
+        return failed
+
+    def score_nlu(self, test_cases: list, responses: list, log: bool = True) -> tuple:
+        """
+        (intent accuracy, slot accuracy) of the NLU responses.
+        """
         total_intent = 0
         correct_intent = 0
         total_slots = 0
         correct_slots = 0
         # cycle in the list of json test cases
-        loading_bar = tqdm(test_cases, desc="Testing NLU", unit="test case")
-        for el in loading_bar:
+        for el, nlu_response in zip(test_cases, responses):
             input = el["input"]
             expected_output = el["expected_output"]
 
-            if is_history:
-                self.history.clear_history()
-                if "history" in el:
-                    for msg in el["history"]:
-                        self.history.add_to_history(msg["sender"], msg["msg"])
-
-            nlu_response = None
-            count = 5
-            while nlu_response is None and count > 0:
-                nlu_response = nlu.query_model(input)
-                count -= 1
-
             if nlu_response != None:
                 # Check intent
                 if nlu_response["intent"] == expected_output["intent"]:
@@ -133,42 +342,79 @@ class Evaluation():
                         correct_slots += 1
                     total_slots += 1
             else:
-                self.logger.error(f"Test case failed:\nInput: {input}\nExpected: {expected_output}\nGot: {nlu_response}")
+                if log:
+                    self.logger.error(f"Test case failed:\nInput: {input}\nExpected: {expected_output}\nGot: {nlu_response}")
                 total_intent += 1
-            loading_bar.set_postfix({"Acc Intent": f"{(correct_intent / total_intent) * 100:.2f}%", "Acc Slots": f"{(correct_slots / total_slots) * 100:.2f}%"})
-
-    def test_pre_nlu(self, is_history: bool = False):
 
+        return correct_intent / total_intent, correct_slots / total_slots if total_slots > 0 else 0.0
+
+    def fast_path_responses(self, test_cases: list, responses: list, folds: int = 5) -> tuple:
+        """
+        Responses of PRE_NLU with the intent classifier in front of it, cross-validated:
+        each case is classified by a classifier trained on the other folds (and the other
+        training files), the confident ones replace the LLM response.
+        Returns (responses, number of cases short-circuited).
+        """
+        threshold = self.cfg["PRE_NLU"].getfloat("fast_path_threshold", fallback=0.7)
+        extra = load_training_cases(self.cfg, exclude=self.cfg["EVALUATION"].get("pre_nlu_test_cases"))
+        labels = [IntentClassifier.label(el) for el in test_cases]
+        responses = list(responses)
+        hits = 0
+        for train, test in StratifiedKFold(n_splits=folds, shuffle=True, random_state=0).split(test_cases, labels):
+            classifier = IntentClassifier(threshold).fit([test_cases[i] for i in train] + extra)
+            for i, (label, probability) in zip(test, classifier.classify([test_cases[i]["input"] for i in test])):
+                if label != MULTI_INTENT and probability >= threshold:
+                    responses[i] = [{"intent": label, "text": test_cases[i]["input"]}]
+                    hits += 1
+        return responses, hits
+
+    def test_pre_nlu(self, is_history: bool = False, batched: bool = False, resume: bool = True, fast_path: bool = False):
+        """
+        fast_path: also score the intent classifier fast path (cross-validated on the test
+        cases) and report the accuracy delta, the fraction of messages short-circuited and
+        the estimated latency saved.
+        """
         pre_nlu = PRE_NLU(cfg=self.cfg, model=self.model, tokenizer=self.tokenizer, history=self.history if is_history else None, logging_level="ERROR")
+        # The classifier is trained on the test cases, the LLM alone is evaluated here
+        pre_nlu.fast_path = None
         test_cases = self.load_json(self.cfg["EVALUATION"].get("pre_nlu_test_cases"))
+        responses, stats = self.run_cases("PRE_NLU", pre_nlu, test_cases, [el["input"] for el in test_cases], is_history, batched, resume)
+        if pre_nlu.cache != None:
+            self.logger.info(f"Cache: {pre_nlu.cache.stats()}")
+        results = {"intent_accuracy": self.score_pre_nlu(test_cases, responses), **stats}
+        self.logger.info(f"PRE_NLU: intent accuracy {results['intent_accuracy'] * 100:.2f}%")
+        self.log_stats("PRE_NLU", stats)
+
+        if fast_path:
+            fast_responses, hits = self.fast_path_responses(test_cases, responses)
+            results["fast_path_accuracy"] = self.score_pre_nlu(test_cases, fast_responses, report=False)
+            results["short_circuited"] = hits / len(test_cases)
+            results["latency_saved"] = hits * stats["mean_latency"]
+            self.logger.info(
+                f"PRE_NLU fast path: {results['short_circuited'] * 100:.1f}% of the messages short-circuited, "
+                f"intent accuracy {results['fast_path_accuracy'] * 100:.2f}% "
+                f"({(results['fast_path_accuracy'] - results['intent_accuracy']) * 100:+.2f} points), "
+                f"about {results['latency_saved']:.1f} s of generation saved"
+            )
+        return results
+
+    def score_pre_nlu(self, test_cases: list, responses: list, report: bool = True) -> float:
 
         y_true = []
         y_pred = []
         total_intents = 0
         correct_intents = 0
 
-        loading_bar = tqdm(test_cases, desc="Testing PRE_NLU", unit="test case")
-        for el in loading_bar:
+        for el, pre_nlu_response in zip(test_cases, responses):
             input = el["input"]
             expected_output = el["expected_output"]
 
-            if is_history:
-                self.history.clear_history()
-                if "history" in el:
-                    for msg in el["history"]:
-                        self.history.add_to_history(msg["sender"], msg["msg"])
-
-            pre_nlu_response = None
-            count = 5
-            while pre_nlu_response is None and count > 0:
-                pre_nlu_response = pre_nlu.query_model(input)
-                count -= 1
-
             expected_intents = [elem["intent"] for elem in expected_output]
 
             if pre_nlu_response is None:
                 predicted_intents = []
-                self.logger.warning(f"Model returned None:\nInput: {input}\nExpected: {expected_intents}")
+                if report:
+                    self.logger.warning(f"Model returned None:\nInput: {input}\nExpected: {expected_intents}")
             else:
                 predicted_intents = [elem["intent"] for elem in pre_nlu_response]
 
@@ -181,8 +427,6 @@ class Evaluation():
                     correct_intents += 1
                     predicted_intents.remove(intent)
 
-            loading_bar.set_postfix({"Acc Intents": f"{(correct_intents / total_intents) * 100:.2f}%"})
-
         # Initialize MultiLabelBinarizer and fit it to all unique intents
         mlb = MultiLabelBinarizer(classes=["buying_car", "negotiate_price", "order_car", "get_car_info", "give_feedback", "book_appointment", "out_of_domain"])
         mlb.fit([])
@@ -192,6 +436,63 @@ class Evaluation():
         y_pred_binary = mlb.transform(y_pred)
 
         # Get the classification report
-        report = classification_report(y_true_binary, y_pred_binary, target_names=mlb.classes_)
-
-        print(report)
\ No newline at end of file
+        if report:
+            print(classification_report(y_true_binary, y_pred_binary, target_names=mlb.classes_))
+
+        return correct_intents / total_intents
+
+    def compare_prompts(self, component: str = "NLU", folders: tuple = ("prompts_base", "prompts_examples"), is_history: bool = False):
+        """
+        Batched evaluation of a component (PRE_NLU, NLU or DM) with the prompts of each folder.
+        """
+        tests = {"PRE_NLU": "test_pre_nlu", "NLU": "test_nlu", "DM": "test_dm"}
+        cfg = self.cfg
+        results = {}
+        for folder in folders:
+            # Same configuration with the prompt files taken from folder
+            self.cfg = configparser.ConfigParser()
+            self.cfg.read_dict(cfg)
+            for section in ["PRE_NLU", "NLU", "DM", "NLG"]:
+                for key, value in self.cfg[section].items():
+                    if key.startswith("prompt"):
+                        self.cfg[section][key] = os.path.join(folder, os.path.basename(value))
+            try:
+                if component == "DM":
+                    results[folder] = self.test_dm(is_history=is_history, policy="llm", batched=True)
+                else:
+                    results[folder] = getattr(self, tests[component])(is_history=is_history, batched=True)
+            finally:
+                self.cfg = cfg
+        for folder, result in results.items():
+            self.logger.info(f"{component} with {folder}: " + ", ".join(f"{key} {value:.3f}" for key, value in result.items() if value != None))
+        return results
+
+    def compare_quantization(self, variants: tuple = (("bf16", "none"), ("fp32", "none"), ("fp32", "int8")), is_history: bool = False):
+        """
+        Batched NLU and PRE_NLU accuracy of the model loaded on the CPU with each (dtype, quantization).
+        """
+        # The config and the model of the Evaluation are restored once the variants are tested
+        cfg, model, tokenizer = self.cfg, self.model, self.tokenizer
+        results = {}
+        try:
+            for dtype, quantization in variants:
+                self.cfg = configparser.ConfigParser()
+                self.cfg.read_dict(cfg)
+                self.cfg["General"]["device"] = "cpu"
+                self.cfg["General"]["dtype"] = dtype
+                self.cfg["General"]["quantization"] = quantization
+                # Only one variant in memory at a time
+                self.model = None
+                gc.collect()
+                self.model, self.tokenizer = get_model(self.cfg)
+                name = quantization if quantization != "none" else dtype
+                results[name] = {
+                    "NLU": self.test_nlu(is_history=is_history, batched=True),
+                    "PRE_NLU": self.test_pre_nlu(is_history=is_history, batched=True),
+                }
+        finally:
+            self.cfg, self.model, self.tokenizer = cfg, model, tokenizer
+            gc.collect()
+        for name, result in results.items():
+            self.logger.info(f"{name}: NLU intent {result['NLU']['intent_accuracy'] * 100:.2f}%, slots {result['NLU']['slot_accuracy'] * 100:.2f}%, PRE_NLU intents {result['PRE_NLU']['intent_accuracy'] * 100:.2f}%")
+        return results
@@ -0,0 +1,103 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import configparser
+from statistics import mean, quantiles
+from src.utils.logging import setup_logger
+
+DEFAULT_MESSAGES = [
+    "Hi, I would like to buy a family car",
+    "My budget is 20000 euros and I prefer an automatic transmission",
+    "Can you tell me the fuel type of the car with id 3?",
+]
+
+
+class LoadGenerator():
+    """
+    Open sessions concurrently on a running ChatServer and send them the same messages,
+    each session on its own keep-alive HTTP connection. Reports the sessions completed per
+    second and the latency of the turns.
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 8000, sessions: int = 20, concurrency: int = 8, messages: list = None):
+        self.host = host
+        self.port = port
+        self.sessions = sessions
+        self.concurrency = concurrency
+        self.messages = messages if messages != None else DEFAULT_MESSAGES
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+    async def request(self, reader, writer, method: str, path: str, content: dict = None) -> tuple:
+        body = json.dumps(content).encode() if content != None else b""
+        writer.write((
+            f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+        ).encode() + body)
+        await writer.drain()
+        head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1")
+        status = int(head.split(" ", 2)[1])
+        length = 0
+        for line in head.split("\r\n")[1:]:
+            if line.lower().startswith("content-length:"):
+                length = int(line.split(":", 1)[1])
+        return status, json.loads(await reader.readexactly(length)) if length > 0 else {}
+
+    async def run_session(self, latencies: list, rejected: list):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            status, content = await self.request(reader, writer, "POST", "/sessions")
+            if status != 201:
+                rejected.append(status)
+                return
+            path = f"/sessions/{content['session_id']}"
+            for message in self.messages:
+                start = time.perf_counter()
+                status, _ = await self.request(reader, writer, "POST", path + "/messages", {"text": message})
+                if status == 200:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    rejected.append(status)
+            await self.request(reader, writer, "DELETE", path)
+        finally:
+            writer.close()
+
+    async def run(self) -> dict:
+        latencies, rejected = [], []
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def limited():
+            async with semaphore:
+                await self.run_session(latencies, rejected)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[limited() for _ in range(self.sessions)])
+        elapsed = time.perf_counter() - start
+
+        results = {
+            "sessions_per_second": self.sessions / elapsed,
+            "turns": len(latencies),
+            "rejected": len(rejected),
+            "mean_latency": mean(latencies) if len(latencies) > 0 else None,
+            # quantiles needs two points at least
+            "p95_latency": quantiles(latencies, n=20)[18] if len(latencies) > 1 else (latencies[0] if len(latencies) == 1 else None),
+        }
+        self.logger.info(
+            f"{self.sessions} sessions ({self.concurrency} concurrent) in {elapsed:.2f} s: {results['sessions_per_second']:.2f} sessions/s, "
+            f"{results['turns']} turns, {results['rejected']} rejected"
+            + (f", latency mean {results['mean_latency'] * 1000:.0f} ms, p95 {results['p95_latency'] * 1000:.0f} ms" if len(latencies) > 0 else "")
+        )
+        return results
+
+
+if __name__ == "__main__":
+    # python -m src.server.LoadGenerator [sessions] [concurrency], against the server of config.ini
+    config = configparser.ConfigParser()
+    config.read(os.path.join(os.getcwd(), "config.ini"))
+    generator = LoadGenerator(
+        host=config["SERVER"].get("host", fallback="127.0.0.1"),
+        port=config["SERVER"].getint("port", fallback=8000),
+        sessions=int(sys.argv[1]) if len(sys.argv) > 1 else 20,
+        concurrency=int(sys.argv[2]) if len(sys.argv) > 2 else 8,
+    )
+    asyncio.run(generator.run())
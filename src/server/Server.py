@@ -0,0 +1,290 @@
+import json
+import base64
+import struct
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from src.components.Pipeline import Pipeline
+from src.utils.logging import setup_logger
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 409: "Conflict", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class InferenceWorker():
+    """
+    Dedicated threads running the turns. Without continuous batching there is a single
+    thread, so that the shared model is never used by two generations at once; with it
+    several turns run together and their generations share the batch of the scheduler.
+    The turns wait in a bounded queue, a turn submitted when it is full is rejected
+    with asyncio.QueueFull.
+    """
+    def __init__(self, pipeline: Pipeline, queue_size: int, workers: int = 1):
+        self.pipeline = pipeline
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+
+    async def submit(self, session, user_input: str) -> str:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((session, user_input, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            session, user_input, future = await self.queue.get()
+            try:
+                response = await loop.run_in_executor(self.executor, self.pipeline.process_turn, session, user_input)
+                if not future.cancelled():
+                    future.set_result(response)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self.queue.task_done()
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """
+    Read one HTTP/1.1 request, None when the connection is closed.
+    Returns (method, path, headers with lowercase names, body). Raises ValueError on a
+    malformed request line or Content-Length, asyncio.LimitOverrunError on a header block
+    larger than the limit of the reader (64 KiB).
+    """
+    try:
+        head = await reader.readuntil(b"\r\n\r\n")
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    lines = head.decode("latin-1").split("\r\n")
+    request_line = lines[0].split(" ", 2)
+    if len(request_line) != 3:
+        raise ValueError(f"Malformed request line {lines[0][:100]!r}")
+    method, path, _ = request_line
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length < 0:
+        raise ValueError(f"Negative Content-Length {length}")
+    body = await reader.readexactly(length) if length > 0 else b""
+    return method, path, headers, body
+
+
+def http_response(status: int, content: dict, keep_alive: bool = True) -> bytes:
+    body = json.dumps(content).encode()
+    head = (
+        f"HTTP/1.1 {status} {STATUS_TEXT.get(status, '')}\r\n"
+        f"Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+    )
+    if status == 503:
+        head += "Retry-After: 1\r\n"
+    return (head + "\r\n").encode() + body
+
+
+async def read_frame(reader: asyncio.StreamReader):
+    # (opcode, payload) of a WebSocket frame, the frames sent by a client are always masked
+    first, second = await reader.readexactly(2)
+    opcode = first & 0x0F
+    length = second & 0x7F
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    mask = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if mask != None:
+        payload = bytes(byte ^ mask[i % 4] for i, byte in enumerate(payload))
+    return opcode, payload
+
+
+def websocket_frame(opcode: int, payload: bytes) -> bytes:
+    if len(payload) < 126:
+        header = struct.pack("!BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 2**16:
+        header = struct.pack("!BBH", 0x80 | opcode, 126, len(payload))
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, 127, len(payload))
+    return header + payload
+
+
+class ChatServer():
+    """
+    asyncio HTTP and WebSocket front end serving several sessions with one Pipeline,
+    i.e. one model, tokenizer and Database. Each session keeps its own history and state trackers.
+
+    HTTP (JSON bodies):
+        POST   /sessions                  -> {"session_id", "message"}
+        POST   /sessions/<id>/messages    {"text"} -> {"response"}
+        DELETE /sessions/<id>
+        GET    /health                    -> {"sessions", "queued"}
+        GET    /metrics                   -> tokens/s and queue delays of the batch scheduler
+    WebSocket /ws: a session per connection, every text message is answered with {"response"}.
+    """
+    def __init__(self, config, pipeline: Pipeline = None):
+        self.config = config
+        self.host = config["SERVER"].get("host", fallback="127.0.0.1")
+        self.port = config["SERVER"].getint("port", fallback=8000)
+        self.queue_size = config["SERVER"].getint("queue_size", fallback=32)
+        self.max_sessions = config["SERVER"].getint("max_sessions", fallback=1000)
+        self.pipeline = pipeline if pipeline != None else Pipeline(config)
+        # Turns run concurrently only when their generations go through the scheduler
+        # (with lazy_loading the scheduler only exists once the model is loaded)
+        batching = config["General"].getboolean("continuous_batching", fallback=False)
+        self.workers = config["SERVER"].getint("workers", fallback=8) if batching else 1
+        self.sessions = {}
+        # Session id -> lock held during its turns: a session answers its messages in order,
+        # only the turns of different sessions share the batch
+        self.session_locks = {}
+        self.worker = None
+        self.worker_tasks = []
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+    async def start(self) -> asyncio.AbstractServer:
+        self.worker = InferenceWorker(self.pipeline, self.queue_size, self.workers)
+        self.worker_tasks = [asyncio.create_task(self.worker.run()) for _ in range(self.workers)]
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.logger.info(f"Serving on http://{self.host}:{self.port}")
+        return server
+
+    async def serve(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    def create_session(self):
+        if len(self.sessions) >= self.max_sessions:
+            return None
+        session = self.pipeline.new_session()
+        self.sessions[session.session_id] = session
+        return session
+
+    def restore_session(self, data: str) -> tuple:
+        # (status, content) of a POST /sessions with {"snapshot": "<base64>"}
+        if len(self.sessions) >= self.max_sessions:
+            return 503, {"error": "Too many sessions"}
+        try:
+            session = self.pipeline.restore_session(base64.b64decode(data, validate=True))
+        except Exception as e:
+            return 400, {"error": f"Invalid snapshot: {e}"}
+        if session.session_id in self.sessions:
+            return 409, {"error": f"Session {session.session_id} already exists"}
+        self.sessions[session.session_id] = session
+        return 201, {"session_id": session.session_id, "turns": session.turns}
+
+    async def answer(self, session, user_input: str) -> tuple:
+        # (status, content) of a turn
+        lock = self.session_locks.setdefault(session.session_id, asyncio.Lock())
+        try:
+            async with lock:
+                response = await self.worker.submit(session, user_input)
+        except asyncio.QueueFull:
+            return 503, {"error": "Too many pending requests"}
+        except Exception as e:
+            self.logger.error(f"Error in session {session.session_id}: {e}")
+            return 500, {"error": str(e)}
+        return 200, {"response": response}
+
+    async def route(self, method: str, path: str, body: bytes) -> tuple:
+        parts = [part for part in path.split("?")[0].split("/") if part != ""]
+        if parts == ["health"] and method == "GET":
+            return 200, {"sessions": len(self.sessions), "queued": self.worker.queue.qsize()}
+        if parts == ["metrics"] and method == "GET":
+            if self.pipeline.scheduler == None:
+                return 404, {"error": "continuous_batching is disabled"}
+            return 200, self.pipeline.scheduler.metrics()
+        if parts == ["sessions"] and method == "POST":
+            try:
+                content = json.loads(body) if len(body.strip()) > 0 else {}
+            except json.JSONDecodeError:
+                return 400, {"error": "The body must be empty or JSON"}
+            if isinstance(content, dict) and "snapshot" in content:
+                return self.restore_session(content["snapshot"])
+            session = self.create_session()
+            if session == None:
+                return 503, {"error": "Too many sessions"}
+            return 201, {"session_id": session.session_id, "message": self.pipeline.initial_message}
+        if len(parts) >= 2 and parts[0] == "sessions":
+            session = self.sessions.get(parts[1])
+            if session == None:
+                return 404, {"error": f"Unknown session {parts[1]}"}
+            if len(parts) == 2 and method == "DELETE":
+                del self.sessions[parts[1]]
+                self.session_locks.pop(parts[1], None)
+                return 200, {"session_id": parts[1]}
+            if parts[2:] == ["snapshot"] and method == "GET":
+                return 200, {"session_id": parts[1], "snapshot": base64.b64encode(session.snapshot()).decode()}
+            if parts[2:] == ["messages"] and method == "POST":
+                try:
+                    user_input = json.loads(body)["text"]
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    return 400, {"error": 'The body must be {"text": "..."}'}
+                return await self.answer(session, user_input)
+            return 405, {"error": f"{method} not allowed on {path}"}
+        return 404, {"error": f"Unknown path {path}"}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except (ValueError, asyncio.LimitOverrunError) as e:
+                    # The rest of the stream cannot be framed, answer and close the connection
+                    writer.write(http_response(400, {"error": f"Malformed request: {e}"}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request == None:
+                    break
+                method, path, headers, body = request
+                if headers.get("upgrade", "").lower() == "websocket":
+                    if "sec-websocket-key" not in headers:
+                        writer.write(http_response(400, {"error": "Missing Sec-WebSocket-Key"}, keep_alive=False))
+                        await writer.drain()
+                        break
+                    await self.handle_websocket(reader, writer, headers)
+                    break
+                status, content = await self.route(method, path, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(http_response(status, content, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_websocket(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, headers: dict):
+        accept = base64.b64encode(hashlib.sha1((headers["sec-websocket-key"] + WEBSOCKET_GUID).encode()).digest()).decode()
+        writer.write((
+            "HTTP/1.1 101 Switching Protocols\r\n"
+            "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n"
+        ).encode())
+        session = self.create_session()
+        if session == None:
+            writer.write(websocket_frame(0x1, json.dumps({"error": "Too many sessions"}).encode()) + websocket_frame(0x8, b""))
+            await writer.drain()
+            return
+        writer.write(websocket_frame(0x1, json.dumps({"session_id": session.session_id, "message": self.pipeline.initial_message}).encode()))
+        await writer.drain()
+        try:
+            while True:
+                opcode, payload = await read_frame(reader)
+                if opcode == 0x8:
+                    writer.write(websocket_frame(0x8, b""))
+                    break
+                if opcode == 0x9:
+                    writer.write(websocket_frame(0xA, payload))
+                elif opcode == 0x1:
+                    _, content = await self.answer(session, payload.decode())
+                    writer.write(websocket_frame(0x1, json.dumps(content).encode()))
+                await writer.drain()
+        finally:
+            self.sessions.pop(session.session_id, None)
+            self.session_locks.pop(session.session_id, None)
@@ -0,0 +1,109 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+from src.utils.logging import setup_logger
+
+
+class GenerationCache():
+    """
+    Cache of the model outputs of each component, keyed by a hash of the prompt file content,
+    the model name and dtype, the full rendered input and the generation parameters.
+    The most recent entries are kept in an in-memory LRU, all of them in an SQLite file.
+    """
+    def __init__(self, path: str, max_size: int, model_name: str, dtype: str):
+        self.path = path
+        self.max_size = max_size
+        self.model_name = model_name
+        self.dtype = dtype
+        self.memory = OrderedDict()
+        # component -> {"hits": int, "misses": int}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, component TEXT, value TEXT)")
+        self.connection.commit()
+
+    def make_key(self, component: str, prompt: str, input_text: str, params: dict) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        content = json.dumps([component, prompt_hash, self.model_name, self.dtype, input_text, params], sort_keys=True)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def count(self, component: str, counter: str):
+        self.counters.setdefault(component, {"hits": 0, "misses": 0})
+        self.counters[component][counter] += 1
+
+    def get(self, component: str, key: str):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.count(component, "hits")
+                return self.memory[key]
+            row = self.connection.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row == None:
+                self.count(component, "misses")
+                return None
+            self.count(component, "hits")
+            self.add_to_memory(key, row[0])
+            return row[0]
+
+    def put(self, component: str, key: str, value: str):
+        with self.lock:
+            self.add_to_memory(key, value)
+            self.connection.execute("INSERT OR REPLACE INTO cache (key, component, value) VALUES (?, ?, ?)", (key, component, value))
+            self.connection.commit()
+
+    def add_to_memory(self, key: str, value: str):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def invalidate(self, component: str = None):
+        """
+        Remove the entries of a component, or all of them if component is None.
+        """
+        with self.lock:
+            if component == None:
+                self.connection.execute("DELETE FROM cache")
+                self.memory.clear()
+            else:
+                keys = [row[0] for row in self.connection.execute("SELECT key FROM cache WHERE component = ?", (component,))]
+                self.connection.execute("DELETE FROM cache WHERE component = ?", (component,))
+                for key in keys:
+                    self.memory.pop(key, None)
+            self.connection.commit()
+        self.logger.info(f"Cache invalidated for {component if component != None else 'all components'}")
+
+    def stats(self) -> dict:
+        return {component: dict(counters) for component, counters in self.counters.items()}
+
+
+# path -> GenerationCache shared by all the components
+caches = {}
+
+def get_generation_cache(cfg: dict, component: str):
+    """
+    Return the cache shared by all the components, or None if the cache is disabled
+    in [CACHE] or bypassed by the component (cache=False in its section).
+    """
+    if not cfg.has_section("CACHE") or not cfg["CACHE"].getboolean("enabled", fallback=False):
+        return None
+    if not cfg[component].getboolean("cache", fallback=True):
+        return None
+    path = os.path.join(cfg["Settings"].get("path"), cfg["CACHE"].get("path"))
+    if path not in caches:
+        caches[path] = GenerationCache(
+            path=path,
+            max_size=cfg["CACHE"].getint("max_size", fallback=1024),
+            model_name=cfg["MODELS"].get(cfg["General"].get("model_name")),
+            # int8 weights give different outputs than the dtype they are loaded from
+            dtype=cfg["General"].get("dtype") if cfg["General"].get("quantization", fallback="none") == "none" else cfg["General"].get("quantization"),
+        )
+    return caches[path]
@@ -0,0 +1,268 @@
+import os
+import re
+import json
+import numpy as np
+
+# Version of the on-disk format, a cache written with another version is rebuilt
+FORMAT_VERSION = 1
+
+# Field names of the known inventory schemas that differ from the canonical ones,
+# the other names are converted to snake case ("Fuel Type" -> "fuel_type")
+FIELD_ALIASES = {
+    "CarID": "car_id",
+    "Make": "brand",
+    "Price": "budget",
+}
+
+
+def match_key(value):
+    """
+    Key used to compare values: strings are compared case-insensitively,
+    the other values by equality.
+    """
+    if isinstance(value, str):
+        return ("str", value.lower())
+    if isinstance(value, (list, dict)):
+        return ("json", json.dumps(value, sort_keys=True))
+    return ("value", value)
+
+
+def is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def canonical_field(field: str) -> str:
+    if field in FIELD_ALIASES:
+        return FIELD_ALIASES[field]
+    return re.sub(r"[^a-z0-9]+", "_", field.strip().lower()).strip("_")
+
+
+def canonical_records(records: list) -> list:
+    """
+    Rename the fields of the records to the canonical schema.
+    """
+    names = {}
+    canonical = []
+    for record in records:
+        for field in record.keys():
+            if field not in names:
+                names[field] = canonical_field(field)
+        canonical.append({names[field]: value for field, value in record.items()})
+    return canonical
+
+
+class ColumnStore():
+    """
+    Column oriented copy of a list of records. Numeric fields are stored as float64
+    NumPy arrays (NaN when missing), the other fields as int32 codes into the table
+    of their distinct values (-1 when missing), with an inverted index from the
+    lowercased value to the sorted ids of the rows holding it.
+    """
+    def __init__(self, records: list):
+        self.size = len(records)
+        # Fields in the order of first appearance
+        self.fields = list(dict.fromkeys(field for record in records for field in record.keys()))
+        # field -> (values, True if all the values are int)
+        self.numeric = {}
+        # field -> (codes, table of the distinct values)
+        self.categorical = {}
+        # field -> {match key: sorted row ids}
+        self.index = {}
+        # field -> numeric view of a categorical field, built on demand
+        self.numeric_views = {}
+        # field -> (row ids sorted by value, sorted values) of a numeric field, built on demand
+        self.sorted_numeric = {}
+
+        for field in self.fields:
+            values = [record.get(field) for record in records]
+            present = [value for value in values if value is not None]
+            if len(present) > 0 and all(is_number(value) for value in present):
+                column = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+                self.numeric[field] = (column, all(isinstance(value, int) for value in present))
+            else:
+                self.add_categorical(field, values)
+
+    def add_categorical(self, field: str, values: list):
+        table = []
+        # Strings are their own key, the other values are json encoded (lists are not hashable)
+        codes_of = {}
+        codes = np.empty(len(values), dtype=np.int32)
+        for i, value in enumerate(values):
+            if value is None:
+                codes[i] = -1
+                continue
+            encoded = value if isinstance(value, str) else ("json", json.dumps(value, sort_keys=True))
+            if encoded not in codes_of:
+                codes_of[encoded] = len(table)
+                table.append(value)
+            codes[i] = codes_of[encoded]
+        self.categorical[field] = (codes, table)
+        self.index[field] = self.build_index(codes, table)
+
+    @staticmethod
+    def index_arrays(codes: np.ndarray, size: int) -> tuple:
+        # A stable sort keeps the rows of each code in ascending order,
+        # the rows of code c are order[bounds[c]:bounds[c + 1]]
+        order = np.argsort(codes, kind="stable")
+        bounds = np.searchsorted(codes[order], np.arange(size + 1))
+        return order, bounds
+
+    @classmethod
+    def build_index(cls, codes: np.ndarray, table: list) -> dict:
+        return cls.index_from_arrays(*cls.index_arrays(codes, len(table)), table)
+
+    @staticmethod
+    def index_from_arrays(order: np.ndarray, bounds: np.ndarray, table: list) -> dict:
+        index = {}
+        for code, value in enumerate(table):
+            index.setdefault(match_key(value), []).append(order[bounds[code]:bounds[code + 1]])
+        # Values differing only by case share the same key
+        return {key: parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts)) for key, parts in index.items()}
+
+    def lookup(self, field: str, value) -> np.ndarray:
+        """
+        Sorted ids of the rows whose field is equal to value (case-insensitive for strings).
+        """
+        if field in self.categorical:
+            return self.index[field].get(match_key(value), np.empty(0, dtype=np.int64))
+        if field in self.numeric and is_number(value):
+            if field not in self.sorted_numeric:
+                column = self.numeric[field][0]
+                order = np.argsort(column, kind="stable")
+                self.sorted_numeric[field] = (order, column[order])
+            order, values = self.sorted_numeric[field]
+            # Equal values keep the ascending order of their rows thanks to the stable sort
+            start = np.searchsorted(values, value, side="left")
+            end = np.searchsorted(values, value, side="right")
+            return order[start:end]
+        return np.empty(0, dtype=np.int64)
+
+    def numeric_view(self, field: str) -> np.ndarray:
+        """
+        Values of a field as float64, NaN where missing or not convertible to a number.
+        """
+        if field in self.numeric:
+            return self.numeric[field][0]
+        if field not in self.numeric_views:
+            codes, table = self.categorical[field]
+            converted = []
+            for value in table:
+                try:
+                    converted.append(float(value))
+                except (ValueError, TypeError):
+                    converted.append(np.nan)
+            # The extra NaN at the end is selected by the missing code -1
+            converted = np.array(converted + [np.nan], dtype=np.float64)
+            self.numeric_views[field] = converted[codes]
+        return self.numeric_views[field]
+
+    def value(self, field: str, row: int):
+        if field in self.numeric:
+            column, is_int = self.numeric[field]
+            value = column[row]
+            if np.isnan(value):
+                return None
+            return int(value) if is_int else float(value)
+        codes, table = self.categorical[field]
+        code = codes[row]
+        return table[code] if code >= 0 else None
+
+    def column_values(self, field: str) -> list:
+        """
+        All the values of a field, as Python objects.
+        """
+        if field in self.numeric:
+            column, is_int = self.numeric[field]
+            return [None if np.isnan(value) else (int(value) if is_int else value) for value in column.tolist()]
+        codes, table = self.categorical[field]
+        return [table[code] if code >= 0 else None for code in codes.tolist()]
+
+    def row(self, row: int) -> dict:
+        """
+        Rebuild the record stored at a row.
+        """
+        return {field: self.value(field, row) for field in self.fields}
+
+    def rows(self, ids) -> list:
+        return [self.row(i) for i in ids]
+
+    # ---------- persistence ----------
+
+    def save(self, directory: str, source: dict):
+        """
+        Write the columns as .npy files and the tables in meta.json, with the
+        description of the source file used to detect when it changes.
+        """
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, "meta.json")
+        # Without meta.json a partially written cache is never loaded
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        meta = {"version": FORMAT_VERSION, "source": source, "size": self.size, "fields": self.fields, "numeric": {}, "categorical": {}}
+        for i, field in enumerate(self.fields):
+            if field in self.numeric:
+                column, is_int = self.numeric[field]
+                np.save(os.path.join(directory, f"column_{i}.npy"), column)
+                meta["numeric"][field] = is_int
+            else:
+                codes, table = self.categorical[field]
+                order, bounds = self.index_arrays(codes, len(table))
+                np.save(os.path.join(directory, f"column_{i}.npy"), codes)
+                np.save(os.path.join(directory, f"order_{i}.npy"), order)
+                np.save(os.path.join(directory, f"bounds_{i}.npy"), bounds)
+                meta["categorical"][field] = table
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    @staticmethod
+    def read_meta(directory: str):
+        meta_path = os.path.join(directory, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta if meta.get("version") == FORMAT_VERSION else None
+
+    @classmethod
+    def load(cls, directory: str, meta: dict, mmap: bool = True):
+        """
+        Open a saved store, the arrays are memory-mapped unless mmap is False.
+        """
+        mmap_mode = "r" if mmap else None
+        store = cls([])
+        store.size = meta["size"]
+        store.fields = meta["fields"]
+        for i, field in enumerate(store.fields):
+            column = np.load(os.path.join(directory, f"column_{i}.npy"), mmap_mode=mmap_mode)
+            if field in meta["numeric"]:
+                store.numeric[field] = (column, meta["numeric"][field])
+            else:
+                table = meta["categorical"][field]
+                order = np.load(os.path.join(directory, f"order_{i}.npy"), mmap_mode=mmap_mode)
+                bounds = np.load(os.path.join(directory, f"bounds_{i}.npy"))
+                store.categorical[field] = (column, table)
+                store.index[field] = cls.index_from_arrays(order, bounds, table)
+        return store
+
+
+def source_signature(path: str) -> dict:
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def load_columns(source_path: str, directory: str, logger=None) -> ColumnStore:
+    """
+    Memory-map the columnar cache of a JSON inventory, compiling it first if it is
+    missing or if the JSON file changed since it was written.
+    """
+    source = source_signature(source_path)
+    meta = ColumnStore.read_meta(directory)
+    if meta != None and meta["source"] == source:
+        return ColumnStore.load(directory, meta)
+    if logger != None:
+        logger.info(f"Compiling {source_path} into the columnar cache {directory}...")
+    with open(source_path) as f:
+        records = canonical_records(json.load(f))
+    ColumnStore(records).save(directory, source)
+    return ColumnStore.load(directory, ColumnStore.read_meta(directory))
@@ -1,18 +1,45 @@
+from array import array
+from collections import deque
 from src.utils.logging import setup_logger
 
 class History:
-    def __init__(self):
+    """
+    Rolling window of the most recent messages of a conversation, kept rendered and
+    tokenized as messages are added. With a tokenizer and max_tokens the window holds
+    the most recent messages fitting in max_tokens (a single longer message is truncated),
+    otherwise the last max_messages messages.
+    """
+    def __init__(self, tokenizer=None, max_tokens: int = None, max_messages: int = None):
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens if tokenizer != None else None
+        self.max_messages = max_messages if max_messages != None or self.max_tokens != None else 5
         self.senders = []
         self.msgs = []
+        # Window: formatted lines, their token ids, total tokens and rendered text
+        self.lines = deque()
+        self.line_ids = deque()
+        self.window_tokens = 0
+        self.rendered = ""
 
         self.logger = setup_logger(self.__class__.__name__)
 
+    @classmethod
+    def from_config(cls, cfg: dict, tokenizer=None):
+        """
+        Window of history_max_tokens tokens ([General]), by default the last 5 messages.
+        """
+        return cls(tokenizer, max_tokens=cfg["General"].getint("history_max_tokens", fallback=None))
+
     def clear_history(self):
         """
         Clear the history of messages.
         """
         self.senders = []
         self.msgs = []
+        self.lines.clear()
+        self.line_ids.clear()
+        self.window_tokens = 0
+        self.rendered = ""
 
     def add_to_history(self, sender: str, msg: str):
         sender = sender.lower()
@@ -22,16 +49,59 @@ class History:
         else:
             self.senders.append(sender)
             self.msgs.append(msg)
-    
+            self.add_line(f"{sender.capitalize()}: {msg}\n")
+
+    def add_line(self, line: str):
+        ids = self.tokenizer(line, add_special_tokens=False).input_ids if self.tokenizer != None else []
+        if self.max_tokens != None and len(ids) > self.max_tokens:
+            # Keep the beginning of a message longer than the whole window
+            ids = ids[: max(1, self.max_tokens - 1)]
+            line = self.tokenizer.decode(ids) + "\n"
+            ids = ids + self.tokenizer("\n", add_special_tokens=False).input_ids[-1:]
+            self.logger.debug(f"Message truncated to {len(ids)} tokens")
+        self.lines.append(line)
+        self.line_ids.append(ids)
+        self.window_tokens += len(ids)
+
+        # Evict the oldest messages beyond the budget
+        while len(self.lines) > 1 and (
+            (self.max_tokens != None and self.window_tokens > self.max_tokens)
+            or (self.max_messages != None and len(self.lines) > self.max_messages)
+        ):
+            self.lines.popleft()
+            self.window_tokens -= len(self.line_ids.popleft())
+        self.rendered = "".join(self.lines)
+
+    def get_state(self) -> tuple:
+        """
+        The messages and the window with its token ids, so that a restored history is not tokenized again.
+        """
+        line_ids = [array("i", ids).tobytes() for ids in self.line_ids]
+        return (self.senders, self.msgs, list(self.lines), line_ids, self.window_tokens)
+
+    def set_state(self, state: tuple):
+        senders, msgs, lines, line_ids, window_tokens = state
+        self.senders = list(senders)
+        self.msgs = list(msgs)
+        self.lines = deque(lines)
+        self.line_ids = deque(array("i", ids).tolist() for ids in line_ids)
+        self.window_tokens = window_tokens
+        self.rendered = "".join(self.lines)
+
+    def get_messages(self):
+        """
+        The messages of the window, one formatted line each.
+        """
+        return list(self.lines)
+
+    def get_token_counts(self):
+        """
+        Number of tokens of each message of the window, None without a tokenizer.
+        """
+        return [len(ids) for ids in self.line_ids] if self.tokenizer != None else None
+
+    def get_token_ids(self):
+        return [token_id for ids in self.line_ids for token_id in ids]
+
     def get_history(self):
-        history = ""
-        if len(self.senders) == 0:
-            history = ""
-        else:
-            history = ""
-            # Only show the last 5 messages
-            for i in range(max(0, len(self.senders) - 5), len(self.senders)):
-                history += f"{self.senders[i].capitalize()}: {self.msgs[i]}\n" 
-                    
-        return history
-    
\ No newline at end of file
+        return self.rendered
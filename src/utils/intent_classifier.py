@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+from sklearn.pipeline import make_pipeline, make_union
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from src.utils.logging import setup_logger
+
+# Label of the messages with several intents, always left to the LLM
+MULTI_INTENT = "multi_intent"
+
+
+class IntentClassifier():
+    """
+    Fast path of PRE_NLU: TF-IDF of the word 1-2 grams and character 2-5 grams of the
+    message and a logistic regression, trained on the PRE_NLU and NLU test cases. Messages with
+    several intents are a class of their own. predict() returns the PRE_NLU output
+    [{"intent", "text"}] when the best single intent reaches the threshold, otherwise None
+    and the message goes through the LLM.
+    """
+    def __init__(self, threshold: float = 0.7):
+        self.threshold = threshold
+        self.pipeline = make_pipeline(
+            make_union(
+                TfidfVectorizer(analyzer="word", ngram_range=(1, 2), sublinear_tf=True),
+                TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 5), sublinear_tf=True),
+            ),
+            LogisticRegression(C=10.0, max_iter=1000),
+        )
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+        # Messages answered by the classifier, by the LLM and the time spent in each
+        self.hits = 0
+        self.misses = 0
+        self.classify_time = 0.0
+        self.fallback_time = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        """
+        Classifier trained on the files of fast_path_data ([PRE_NLU], by default the PRE_NLU
+        and NLU test cases), or None if fast_path is disabled.
+        """
+        if not cfg["PRE_NLU"].getboolean("fast_path", fallback=False):
+            return None
+        return cls(threshold=cfg["PRE_NLU"].getfloat("fast_path_threshold", fallback=0.7)).fit(load_training_cases(cfg))
+
+    @staticmethod
+    def label(case: dict) -> str:
+        intents = {elem["intent"] for elem in case["expected_output"]}
+        return intents.pop() if len(intents) == 1 else MULTI_INTENT
+
+    def fit(self, cases: list):
+        """
+        cases: in the format of the PRE_NLU test cases, {"input", "expected_output": [{"intent", "text"}, ...]}.
+        """
+        self.pipeline.fit([case["input"] for case in cases], [self.label(case) for case in cases])
+        self.logger.info(f"Trained on {len(cases)} messages, {len(self.pipeline.classes_)} classes")
+        return self
+
+    def classify(self, texts: list) -> list:
+        # (label, probability) of the most likely class of each text
+        probabilities = self.pipeline.predict_proba(texts)
+        best = probabilities.argmax(axis=1)
+        return [(str(self.pipeline.classes_[i]), float(p)) for i, p in zip(best, probabilities[np.arange(len(texts)), best])]
+
+    def predict(self, text: str):
+        start = time.perf_counter()
+        label, probability = self.classify([text])[0]
+        elapsed = time.perf_counter() - start
+        confident = label != MULTI_INTENT and probability >= self.threshold
+        with self.lock:
+            self.classify_time += elapsed
+            if confident:
+                self.hits += 1
+            else:
+                self.misses += 1
+        self.logger.debug(f"{label} ({probability:.2f}) for: {text}")
+        return [{"intent": label, "text": text}] if confident else None
+
+    def record_fallback(self, latency: float):
+        # Latency of a message answered by the LLM, to estimate the time saved by the hits
+        with self.lock:
+            self.fallback_time += latency
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        mean_fallback = self.fallback_time / self.misses if self.misses > 0 else 0.0
+        return {
+            "short_circuited": self.hits / total if total > 0 else 0.0,
+            "messages": total,
+            "mean_classify_latency": self.classify_time / total if total > 0 else 0.0,
+            # Every hit would otherwise have cost a mean LLM call
+            "latency_saved": self.hits * mean_fallback - self.classify_time,
+        }
+
+
+def load_training_cases(cfg: dict, exclude: str = None) -> list:
+    """
+    Messages of the comma separated files of fast_path_data, except exclude, as PRE_NLU
+    test cases. The NLU test cases ({"input": {"intent", "text"}}) are single intent messages.
+    """
+    paths = cfg["PRE_NLU"].get("fast_path_data", fallback=f"{cfg['EVALUATION'].get('pre_nlu_test_cases')},{cfg['EVALUATION'].get('nlu_test_cases')}")
+    cases = []
+    for path in paths.split(","):
+        if path.strip() == exclude:
+            continue
+        with open(os.path.join(cfg["Settings"].get("path"), path.strip()), "r") as f:
+            for el in json.load(f):
+                if isinstance(el["input"], dict):
+                    el = {"input": el["input"]["text"], "expected_output": [el["input"]]}
+                cases.append(el)
+    return cases
@@ -0,0 +1,207 @@
+import json
+
+# A JSON schema is described with tuples:
+#   ("const", value)              -> exactly the JSON string value
+#   ("enum", [values])            -> one of the JSON string values
+#   ("string",)                   -> any JSON string (without escapes or control characters)
+#   ("nullable_string",)          -> null or any JSON string
+#   ("object", [(key, schema)])   -> object with exactly these keys, in this order
+#   ("array", schema)             -> non-empty array of elements matching the schema
+#   ("branch", [(text, schema)])  -> one of the raw texts followed by its own schema
+#                                     (used to make a value depend on the previous one)
+
+
+def nlu_schema(intent: str, slots: list) -> tuple:
+    """
+    {"intent": "<intent>", "slots": {"<slot>": null | "value", ...}}
+    """
+    return ("object", [
+        ("intent", ("const", intent)),
+        ("slots", ("object", [(slot, ("nullable_string",)) for slot in slots])),
+    ])
+
+
+def pre_nlu_schema(intents: list) -> tuple:
+    """
+    [{"intent": "<intent>", "text": "segment"}, ...]
+    """
+    return ("array", ("object", [
+        ("intent", ("enum", intents)),
+        ("text", ("string",)),
+    ]))
+
+
+def dm_schema(intent: str, slots: list) -> tuple:
+    """
+    {"action": "confirmation", "parameter": "<intent>"} or {"action": "request_info", "parameter": "<slot>"}
+    """
+    # The parameter depends on the action, so the "parameter" key is part of each branch
+    alternatives = [('"confirmation", "parameter": ', ("const", intent))]
+    if len(slots) > 0:
+        alternatives.append(('"request_info", "parameter": ', ("enum", slots)))
+    return ("object", [("action", ("branch", alternatives))])
+
+
+class JsonGrammar():
+    """
+    Character level automaton accepting the canonical serialization of a schema,
+    i.e. the one produced by json.dumps with the default separators.
+    A state is an immutable (pc, data) tuple, step returns None on a rejected character.
+    """
+    def __init__(self, schema: tuple):
+        self.ops = []
+        self.compile(schema)
+        self.ops = self.remove_empty_literals(self.ops)
+        self.initial_state = self.normalize((0, 0))
+
+    # ---------- compilation ----------
+
+    def emit(self, op) -> int:
+        self.ops.append(op)
+        return len(self.ops) - 1
+
+    def compile(self, schema: tuple):
+        kind = schema[0]
+        if kind == "const":
+            self.emit(("lit", json.dumps(schema[1])))
+        elif kind == "enum":
+            self.emit(("choice", [(json.dumps(value), None) for value in schema[1]]))
+        elif kind == "string":
+            self.emit(("str",))
+        elif kind == "nullable_string":
+            self.emit(("str_or_null",))
+        elif kind == "object":
+            self.emit(("lit", "{"))
+            for i, (key, value) in enumerate(schema[1]):
+                separator = ", " if i > 0 else ""
+                self.emit(("lit", separator + json.dumps(key) + ": "))
+                self.compile(value)
+            self.emit(("lit", "}"))
+        elif kind == "array":
+            self.emit(("lit", "["))
+            start = len(self.ops)
+            self.compile(schema[1])
+            # Either another element or the end of the array
+            self.emit(("choice", [(", ", start), ("]", None)]))
+        elif kind == "branch":
+            # Choose one of the texts, then continue with its schema and jump to the end
+            choice_pc = self.emit(("choice", []))
+            options = []
+            jumps = []
+            for text, value in schema[1]:
+                options.append((text, len(self.ops)))
+                self.compile(value)
+                jumps.append(self.emit(("jump", None)))
+            for pc in jumps:
+                self.ops[pc] = ("jump", len(self.ops))
+            self.ops[choice_pc] = ("choice", options)
+        else:
+            raise ValueError(f"Unknown schema type: {kind}")
+
+    @staticmethod
+    def remove_empty_literals(ops: list) -> list:
+        # Remove empty literals by turning them into jumps to the next op
+        return [("jump", pc + 1) if op[0] == "lit" and op[1] == "" else op for pc, op in enumerate(ops)]
+
+    # ---------- stepping ----------
+
+    def normalize(self, state: tuple):
+        """
+        Follow the jumps until the next op that consumes characters.
+        """
+        pc, data = state
+        while pc < len(self.ops) and self.ops[pc][0] == "jump":
+            pc = self.ops[pc][1]
+        return (pc, data)
+
+    def is_done(self, state: tuple) -> bool:
+        return state[0] >= len(self.ops)
+
+    def in_string_body(self, state: tuple) -> bool:
+        pc, data = state
+        return pc < len(self.ops) and self.ops[pc][0] in ("str", "str_or_null") and data == 1
+
+    def step(self, state: tuple, char: str):
+        pc, data = state
+        if pc >= len(self.ops):
+            return None
+        op = self.ops[pc]
+        kind = op[0]
+
+        if kind == "lit":
+            text = op[1]
+            if text[data] != char:
+                return None
+            if data + 1 == len(text):
+                return self.normalize((pc + 1, 0))
+            return (pc, data + 1)
+
+        if kind == "choice":
+            consumed = (data if data != 0 else "") + char
+            alive = [(option, target) for option, target in op[1] if option.startswith(consumed)]
+            if len(alive) == 0:
+                return None
+            for option, target in alive:
+                if option == consumed:
+                    return self.normalize((pc + 1 if target is None else target, 0))
+            return (pc, consumed)
+
+        if kind in ("str", "str_or_null"):
+            if data == 0:
+                if char == '"':
+                    return (pc, 1)
+                if kind == "str_or_null" and char == "n":
+                    return (pc, "n")
+                return None
+            if data == 1:
+                if char == '"':
+                    return self.normalize((pc + 1, 0))
+                if char == "\\" or ord(char) < 0x20:
+                    return None
+                return (pc, 1)
+            # Matching the null literal
+            consumed = data + char
+            if not "null".startswith(consumed):
+                return None
+            if consumed == "null":
+                return self.normalize((pc + 1, 0))
+            return (pc, consumed)
+
+        return None
+
+    def feed(self, state: tuple, text: str):
+        for char in text:
+            state = self.step(state, char)
+            if state == None:
+                return None
+        return state
+
+    def shortest_completion(self, state: tuple) -> str:
+        """
+        Shortest text that brings the automaton from state to the end of the schema.
+        """
+        completion = ""
+        # Bound the walk in case of loops, choices always prefer the exit option
+        for _ in range(len(self.ops) * 4 + 4):
+            if self.is_done(state):
+                return completion
+            pc, data = state
+            op = self.ops[pc]
+            kind = op[0]
+            if kind == "lit":
+                text = op[1][data:]
+            elif kind == "choice":
+                consumed = data if data != 0 else ""
+                options = [option for option, _ in op[1] if option.startswith(consumed)]
+                # Prefer the options that leave the current op, then the shortest
+                exits = [option for option, target in op[1] if option.startswith(consumed) and (target is None or target > pc)]
+                text = min(exits if len(exits) > 0 else options, key=len)[len(consumed):]
+            elif data == 0:
+                text = '""'
+            elif data == 1:
+                text = '"'
+            else:
+                text = "null"[len(data):]
+            completion += text
+            state = self.feed(state, text)
+        return completion
@@ -0,0 +1,117 @@
+import json
+import threading
+from src.utils.logging import setup_logger
+
+DECODER = json.JSONDecoder()
+
+
+def salvage_json(text: str) -> tuple:
+    """
+    (value, prefix): the first complete JSON object or array of the text, ignoring the text
+    around it, and None for the prefix. When there is none, value is None and prefix is the
+    longest valid beginning of the first value (the whole rest of a truncated output, up to
+    the first invalid character otherwise), or None if the text has no JSON at all.
+    """
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if len(starts) == 0:
+        return None, None
+    start = min(starts)
+    try:
+        value, _ = DECODER.raw_decode(text, start)
+        return value, None
+    except json.JSONDecodeError as e:
+        return None, text[:e.pos]
+
+
+class JsonRecovery():
+    """
+    Parsing of the JSON outputs of a stage and the limits of its recovery: max_continuations
+    continuations of a truncated or invalid output from its longest valid prefix, then at
+    most max_retries generations from scratch. Counts the outputs parsed directly, salvaged
+    from the text around them, continued and lost, and the generated tokens thrown away.
+    Without salvage only outputs that are exactly a JSON value are accepted.
+    """
+    def __init__(self, name: str, max_retries: int = 3, max_continuations: int = 1, salvage: bool = True):
+        self.name = name
+        self.max_retries = max_retries
+        self.max_continuations = max_continuations
+        self.salvage = salvage
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+        self.parsed = 0
+        self.salvaged = 0
+        self.failed = 0
+        self.continuations = 0
+        self.retries = 0
+        self.wasted_tokens = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: dict, section: str):
+        """
+        Limits of the [section] of the configuration, max_retries defaults to the one of [General].
+        """
+        return cls(
+            section,
+            max_retries=cfg[section].getint("max_retries", fallback=cfg["General"].getint("max_retries", fallback=3)),
+            max_continuations=cfg[section].getint("max_continuations", fallback=1),
+            salvage=cfg[section].getboolean("salvage", fallback=True),
+        )
+
+    def split(self, text: str) -> tuple:
+        """
+        (value, prefix) of salvage_json, without counting the output.
+        """
+        if self.salvage:
+            return salvage_json(text)
+        try:
+            return json.loads(text), None
+        except json.JSONDecodeError:
+            return None, salvage_json(text)[1]
+
+    def parse(self, text: str):
+        """
+        The JSON value of an output, None if it has no complete one.
+        """
+        try:
+            value = json.loads(text)
+            with self.lock:
+                self.parsed += 1
+            return value
+        except json.JSONDecodeError as e:
+            value = salvage_json(text)[0] if self.salvage else None
+            with self.lock:
+                if value != None:
+                    self.salvaged += 1
+                else:
+                    self.failed += 1
+            if value == None:
+                self.logger.error(f"{self.name}: error parsing response as JSON: {e}")
+            return value
+
+    def record_continuation(self, dropped_tokens: int):
+        # A continuation keeps the valid prefix, only the tokens after it are generated again
+        with self.lock:
+            self.continuations += 1
+            self.wasted_tokens += dropped_tokens
+
+    def record_failure(self, generated_tokens: int):
+        # The whole output of a generation that could not be recovered is thrown away
+        with self.lock:
+            self.wasted_tokens += generated_tokens
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def stats(self) -> dict:
+        total = self.parsed + self.salvaged + self.failed
+        return {
+            "outputs": total,
+            "parsed": self.parsed,
+            "salvaged": self.salvaged,
+            "failed": self.failed,
+            "continuations": self.continuations,
+            "retries": self.retries,
+            "wasted_tokens": self.wasted_tokens,
+        }
@@ -48,6 +48,9 @@ def setup_logger(name, logging_level="DEBUG", color_debug="DEBUG_DEFAULT"):
     """
     logger = logging.getLogger(name)
     logger.setLevel(LOG_LEVELS[logging_level])
+    # Loggers are shared by name, do not print each message once per instance
+    if logger.handlers:
+        return logger
     handler = logging.StreamHandler()
 
     color_map = {
@@ -0,0 +1,97 @@
+import threading
+from collections import OrderedDict
+from src.utils.logging import setup_logger
+
+
+class PromptAssembler():
+    """
+    Fit the parts of the input of a component into its token budget.
+    The fixed parts are always kept: the static ones (template and system prompt) are
+    registered and counted once at construction, the dynamic ones (user input, dialogue
+    state) are counted at each call. The other parts are lists of items (history messages,
+    database rows) filled in priority order and shortened when the budget is exhausted.
+    The token counts of the parts are summed, so the total is approximate at their boundaries.
+    """
+    def __init__(self, tokenizer, budget: int, name: str, max_counts: int = 4096):
+        self.tokenizer = tokenizer
+        self.budget = budget
+        self.name = name
+        self.max_counts = max_counts
+        # text -> number of tokens, the same system prompts and messages are measured at every turn
+        self.token_counts = OrderedDict()
+        # name -> number of tokens of the registered static parts
+        self.static_counts = {}
+        # The components are shared by the sessions decoded concurrently
+        self.lock = threading.Lock()
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+    @classmethod
+    def from_config(cls, cfg: dict, component: str, tokenizer):
+        """
+        Budget given by max_prompt_tokens in the section of the component,
+        by default what is left of max_seq_length after max_new_tokens.
+        """
+        max_seq_length = cfg["General"].getint("max_seq_length")
+        max_new_tokens = cfg[component].getint("max_new_tokens", fallback=0)
+        budget = cfg[component].getint("max_prompt_tokens", fallback=max_seq_length - max_new_tokens)
+        return cls(tokenizer, budget, component)
+
+    def register(self, name: str, text: str):
+        """
+        Count once a static part of the prompt, given by name to assemble().
+        """
+        self.static_counts[name] = len(self.tokenizer(text, add_special_tokens=False).input_ids) if self.tokenizer != None else 0
+
+    def count_tokens(self, text: str) -> int:
+        with self.lock:
+            if text in self.token_counts:
+                self.token_counts.move_to_end(text)
+                return self.token_counts[text]
+        count = len(self.tokenizer(text, add_special_tokens=False).input_ids)
+        with self.lock:
+            self.token_counts[text] = count
+            while len(self.token_counts) > self.max_counts:
+                self.token_counts.popitem(last=False)
+        return count
+
+    def fit_items(self, items: list, budget: int, keep: str = "first", counts: list = None) -> list:
+        """
+        Longest run of items fitting in budget tokens, taken from the start of the list
+        (keep="first", e.g. ranked rows) or from its end (keep="last", e.g. recent messages).
+        counts, if given, are the token counts of the items, e.g. kept by the History.
+        """
+        counts = counts if counts != None else [self.count_tokens(item) for item in items]
+        ordered = list(zip(items, counts)) if keep == "first" else list(zip(items, counts))[::-1]
+        kept = []
+        used = 0
+        for item, count in ordered:
+            used += count
+            if used > budget:
+                break
+            kept.append((item, count))
+        return kept if keep == "first" else kept[::-1]
+
+    def assemble(self, static: list, dynamic: dict, parts: list) -> dict:
+        """
+        static: names of registered parts always included.
+        dynamic: name -> text always included, different at each call so not memoized.
+        parts: (name, items, keep) or (name, items, keep, counts) in priority order,
+        each one gets what the previous ones left.
+        Returns name -> kept items and logs the tokens used by each part.
+        """
+        usage = {name: self.static_counts[name] for name in static}
+        for name, text in dynamic.items():
+            usage[name] = len(self.tokenizer(text, add_special_tokens=False).input_ids)
+        remaining = self.budget - sum(usage.values())
+        if remaining < 0:
+            self.logger.warning(f"{self.name}: the fixed parts of the prompt use {-remaining} tokens more than the budget of {self.budget}")
+        fitted = {}
+        for name, items, keep, *counts in parts:
+            kept = self.fit_items(items, max(0, remaining), keep, counts[0] if len(counts) > 0 else None)
+            fitted[name] = [item for item, _ in kept]
+            usage[name] = sum(count for _, count in kept)
+            remaining -= usage[name]
+            if len(fitted[name]) < len(items):
+                self.logger.info(f"{self.name}: {name} truncated to {len(fitted[name])} of {len(items)} items")
+        self.logger.info(f"{self.name} prompt tokens: " + ", ".join(f"{name}={count}" for name, count in usage.items()) + f" (total {sum(usage.values())}/{self.budget})")
+        return fitted
@@ -0,0 +1,276 @@
+import time
+import threading
+from collections import deque
+from statistics import mean, quantiles
+import torch
+import torch.nn.functional as F
+from transformers import PreTrainedTokenizer, PreTrainedModel, DynamicCache
+from transformers import LogitsProcessorList, TemperatureLogitsWarper, TopKLogitsWarper, TopPLogitsWarper
+from src.utils.utils import JsonScanner
+from src.utils.json_grammar import JsonGrammar
+from src.utils.utils_model import JsonGrammarLogitsProcessor, get_eos_token_ids
+from src.utils.logging import setup_logger
+
+
+class GenerationRequest():
+    """
+    A prompt waiting in the scheduler, then decoded as one row of the running batch.
+    """
+    def __init__(self, input_ids: list, max_new_tokens: int, scanner: JsonScanner = None, grammar: JsonGrammarLogitsProcessor = None):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.scanner = scanner
+        self.grammar = grammar
+        self.generated = []
+        self.finished = False
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+        self.submitted = time.perf_counter()
+        self.started = None
+
+
+class BatchScheduler():
+    """
+    Continuous batching of the generations of all the components and sessions on one model.
+    A dedicated thread keeps a running batch with a left-padded KV cache: between two decode
+    steps the waiting prompts are prefilled and merged into the batch, and every row leaves
+    the batch as soon as it produces EOS, closes its JSON output or exhausts its budget.
+    The callers block in generate/generate_many until their rows are retired.
+    """
+    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer, max_seq_length: int, max_batch_size: int = 8, metrics_window: int = 1000):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.max_batch_size = max_batch_size
+        self.eos_token_ids = get_eos_token_ids(model, tokenizer)
+        self.warpers = self.get_warpers()
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+        self.pending = deque()
+        self.condition = threading.Condition()
+        # Running batch: requests, KV cache, attention mask (B, L) and last sampled tokens (B,)
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        self.last_tokens = None
+
+        # Metrics
+        self.generated_tokens = 0
+        self.busy_time = 0.0
+        self.steps = 0
+        self.queue_delays = deque(maxlen=metrics_window)
+        self.batch_sizes = deque(maxlen=metrics_window)
+
+        self.thread = threading.Thread(target=self.run, name="batch-scheduler", daemon=True)
+        self.thread.start()
+
+    def get_warpers(self) -> LogitsProcessorList:
+        # Same sampling as model.generate with the generation config of the model
+        config = self.model.generation_config
+        warpers = LogitsProcessorList()
+        if config.do_sample:
+            if config.temperature != None and config.temperature != 1.0:
+                warpers.append(TemperatureLogitsWarper(config.temperature))
+            if config.top_k != None and config.top_k != 0:
+                warpers.append(TopKLogitsWarper(config.top_k))
+            if config.top_p != None and config.top_p < 1.0:
+                warpers.append(TopPLogitsWarper(config.top_p))
+        return warpers
+
+    # ---------- callers ----------
+
+    def make_request(self, input_ids: list, max_new_tokens: int = None, stop_on_json: bool = False, grammar: JsonGrammar = None) -> GenerationRequest:
+        # Same budget as get_generation_kwargs
+        budget = self.max_seq_length - len(input_ids)
+        max_new_tokens = max(1, min(max_new_tokens, budget)) if max_new_tokens != None else max(1, budget)
+        processor = None
+        if grammar != None:
+            processor = JsonGrammarLogitsProcessor(self.tokenizer, [grammar], len(input_ids), max_new_tokens, self.eos_token_ids)
+        return GenerationRequest(input_ids, max_new_tokens, JsonScanner() if stop_on_json else None, processor)
+
+    def generate_many(self, requests: list) -> list:
+        """
+        Queue the requests, wait until all of them are decoded and return their texts.
+        """
+        with self.condition:
+            self.pending.extend(requests)
+            self.condition.notify()
+        for request in requests:
+            request.done.wait()
+            if request.error != None:
+                raise request.error
+        return [request.output for request in requests]
+
+    def generate(self, input_ids: list, max_new_tokens: int = None, stop_on_json: bool = False, grammar: JsonGrammar = None) -> str:
+        return self.generate_many([self.make_request(input_ids, max_new_tokens, stop_on_json, grammar)])[0]
+
+    def metrics(self) -> dict:
+        delays = list(self.queue_delays)
+        return {
+            "tokens_per_second": self.generated_tokens / self.busy_time if self.busy_time > 0 else 0.0,
+            "generated_tokens": self.generated_tokens,
+            "steps": self.steps,
+            "mean_batch_size": mean(self.batch_sizes) if len(self.batch_sizes) > 0 else 0.0,
+            "mean_queue_delay": mean(delays) if len(delays) > 0 else 0.0,
+            "p95_queue_delay": quantiles(delays, n=20)[18] if len(delays) > 1 else (delays[0] if len(delays) == 1 else 0.0),
+            "active": len(self.active),
+            "pending": len(self.pending),
+        }
+
+    # ---------- scheduling loop ----------
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.active) == 0 and len(self.pending) == 0:
+                    self.condition.wait()
+                new = []
+                while len(self.pending) > 0 and len(self.active) + len(new) < self.max_batch_size:
+                    new.append(self.pending.popleft())
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    if len(new) > 0:
+                        self.prefill(new)
+                    else:
+                        self.decode_step()
+                self.retire()
+            except Exception as e:
+                self.logger.error(f"Error in the running batch: {e}")
+                for request in self.active + new:
+                    if not request.done.is_set():
+                        request.error = e
+                        request.done.set()
+                self.active, self.cache, self.attention_mask, self.last_tokens = [], None, None, None
+            self.busy_time += time.perf_counter() - start
+            self.steps += 1
+
+    def prefill(self, requests: list):
+        now = time.perf_counter()
+        for request in requests:
+            request.started = now
+            self.queue_delays.append(now - request.submitted)
+        # Left padding, so that the last position of every row is its last prompt token
+        length = max(len(request.input_ids) for request in requests)
+        input_ids = torch.full((len(requests), length), self.tokenizer.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(requests), length), dtype=torch.long)
+        for row, request in enumerate(requests):
+            input_ids[row, length - len(request.input_ids):] = torch.tensor(request.input_ids)
+            attention_mask[row, length - len(request.input_ids):] = 1
+        input_ids, attention_mask = input_ids.to(self.model.device), attention_mask.to(self.model.device)
+        # Positions restart at 0 after the left padding of each row
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=DynamicCache(), use_cache=True)
+        tokens = self.select(requests, output.logits[:, -1, :])
+        self.merge(requests, output.past_key_values, attention_mask, tokens)
+
+    def decode_step(self):
+        self.batch_sizes.append(len(self.active))
+        input_ids = self.last_tokens[:, None]
+        # The position of the new token of each row is its number of real tokens
+        position_ids = self.attention_mask.sum(-1, keepdim=True)
+        attention_mask = torch.cat([self.attention_mask, torch.ones_like(self.attention_mask[:, :1])], dim=-1)
+        output = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids, past_key_values=self.cache, use_cache=True)
+        self.cache = output.past_key_values
+        self.attention_mask = attention_mask
+        self.last_tokens = self.select(self.active, output.logits[:, -1, :])
+
+    def select(self, requests: list, logits: torch.FloatTensor) -> torch.LongTensor:
+        """
+        Constrain, sample and record the next token of every row.
+        """
+        logits = logits.float()
+        for row, request in enumerate(requests):
+            if request.grammar != None:
+                logits[row] = request.grammar.mask_row(0, logits[row], request.max_new_tokens - len(request.generated))
+        if len(self.warpers) > 0:
+            probs = torch.softmax(self.warpers(None, logits), dim=-1)
+            tokens = torch.multinomial(probs, num_samples=1)[:, 0]
+        else:
+            tokens = logits.argmax(dim=-1)
+
+        for request, token_id in zip(requests, tokens.tolist()):
+            request.generated.append(token_id)
+            self.generated_tokens += 1
+            if request.grammar != None:
+                request.grammar.update(0, token_id)
+            if request.scanner != None and not request.scanner.closed:
+                request.scanner.feed(self.tokenizer.decode([token_id], skip_special_tokens=True))
+            request.finished = (
+                token_id in self.eos_token_ids
+                or len(request.generated) >= request.max_new_tokens
+                or len(request.input_ids) + len(request.generated) >= self.max_seq_length
+                or (request.scanner != None and request.scanner.closed)
+            )
+        return tokens
+
+    @staticmethod
+    def pad_left(tensor: torch.Tensor, length: int, dim: int) -> torch.Tensor:
+        missing = length - tensor.shape[dim]
+        if missing == 0:
+            return tensor
+        padding = [0, 0] * (tensor.dim() - dim - 1) + [missing, 0]
+        return F.pad(tensor, padding)
+
+    def merge(self, requests: list, cache: DynamicCache, attention_mask: torch.Tensor, tokens: torch.LongTensor):
+        # Add the prefilled rows to the running batch, left-padding the shorter cache
+        if self.cache == None:
+            self.active, self.cache, self.attention_mask, self.last_tokens = list(requests), cache, attention_mask, tokens
+            return
+        length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+        layers = []
+        for (key, value), (new_key, new_value) in zip(self.cache.to_legacy_cache(), cache.to_legacy_cache()):
+            layers.append((
+                torch.cat([self.pad_left(key, length, 2), self.pad_left(new_key, length, 2)]),
+                torch.cat([self.pad_left(value, length, 2), self.pad_left(new_value, length, 2)]),
+            ))
+        self.cache = DynamicCache.from_legacy_cache(tuple(layers))
+        self.attention_mask = torch.cat([self.pad_left(self.attention_mask, length, 1), self.pad_left(attention_mask, length, 1)])
+        self.last_tokens = torch.cat([self.last_tokens, tokens])
+        self.active += requests
+
+    def retire(self):
+        keep = []
+        for row, request in enumerate(self.active):
+            if not request.finished:
+                keep.append(row)
+                continue
+            request.output = self.tokenizer.decode(request.generated, skip_special_tokens=True)
+            request.done.set()
+        if len(keep) == len(self.active):
+            return
+        if len(keep) == 0:
+            self.active, self.cache, self.attention_mask, self.last_tokens = [], None, None, None
+            return
+
+        index = torch.tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask[index]
+        # Drop the leading columns that are padding in every remaining row
+        first = int(attention_mask.any(dim=0).nonzero()[0])
+        self.cache = DynamicCache.from_legacy_cache(tuple(
+            (key[index, :, first:], value[index, :, first:]) for key, value in self.cache.to_legacy_cache()
+        ))
+        self.attention_mask = attention_mask[:, first:]
+        self.last_tokens = self.last_tokens[index]
+        self.active = [self.active[row] for row in keep]
+
+
+# id of the model -> BatchScheduler shared by all the components
+schedulers = {}
+
+def get_scheduler(cfg: dict, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
+    """
+    Return the scheduler shared by all the components using the model,
+    or None if continuous_batching is disabled in [General].
+    """
+    if not cfg["General"].getboolean("continuous_batching", fallback=False) or model is None:
+        return None
+    if id(model) not in schedulers:
+        schedulers[id(model)] = BatchScheduler(
+            model,
+            tokenizer,
+            max_seq_length=cfg["General"].getint("max_seq_length"),
+            max_batch_size=cfg["General"].getint("max_batch_size", fallback=8),
+        )
+    return schedulers[id(model)]
@@ -0,0 +1,236 @@
+import re
+import time
+import threading
+from src.utils.logging import setup_logger
+
+# Fields of the inventory whose values are looked up in the messages
+GAZETTEER_FIELDS = ["brand", "model", "car_type", "fuel_type", "transmission"]
+
+# Other ways of writing the values of the inventory: phrase -> (field, value)
+SYNONYMS = {
+    "sports car": ("car_type", "Sport_car"),
+    "sports cars": ("car_type", "Sport_car"),
+    "gasoline": ("fuel_type", "Petrol"),
+    "gas": ("fuel_type", "Petrol"),
+    "ev": ("fuel_type", "Electric"),
+    "stick": ("transmission", "Manual"),
+}
+
+# Words of the get_car_info messages naming the requested information
+INFO_KEYWORDS = {
+    "where": "location", "located": "location", "location": "location",
+    "condition": "condition",
+    "seats": "seats", "seat": "seats",
+    "fuel": "fuel_type", "petrol": "fuel_type", "diesel": "fuel_type", "electric": "fuel_type",
+    "transmission": "transmission", "gearbox": "transmission", "automatic": "transmission", "manual": "transmission",
+    "price": "budget",
+}
+
+# Words before a number making it a budget, or after it
+BUDGET_CUES = {"under", "below", "budget", "max", "maximum", "around", "within", "less", "cheaper", "up"}
+CURRENCY_WORDS = {"euro", "euros", "eur", "€", "$", "dollars"}
+
+# Words that carry no slot value. A message made only of these and of resolved values is
+# answered without the LLM, any other word (a negation, a name, an unknown model...) is not.
+# The words referring to an earlier car (it, that one...) and the relative constraints
+# (newer, since...) are left out, the NLU resolves them with the history.
+FILLER_WORDS = set("""
+a an the and or of to for in on at about with from by is are be there
+i i'm i'd i'll i've me my we us our you your do does did can could would will should please
+want wants like need looking look search searching find show tell give get see have has any some
+something car cars vehicle vehicles maybe perhaps also just really interested
+what what's which how many much type kind model year engine transmission fuel budget
+hi hello hey thanks thank ok okay id details detail information info
+buy purchase order take negotiate offer propose pay paying
+than under below around max maximum within up
+""".split())
+
+# Lowercased words, numbers (25k, 25000) and currency symbols, with the thousands separators
+# and the possessive 's removed
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-'][a-z0-9]+)*|[€$]")
+
+def tokenize(text: str) -> list:
+    text = re.sub(r"(?<=\d)[,.](?=\d{3}\b)", "", text.lower())
+    text = re.sub(r"'s\b", "", text)
+    return TOKEN_PATTERN.findall(text)
+
+def parse_number(token: str):
+    match = re.fullmatch(r"(\d+)(k?)", token)
+    if match == None:
+        return None
+    return int(match.group(1)) * (1000 if match.group(2) == "k" else 1)
+
+
+class SlotExtractor():
+    """
+    Deterministic NLU of the simple messages, built from the values of the inventory:
+    a token trie over the brands, models, car types, fuel types and transmissions and
+    parsers of the budgets, years, car ids and prices. extract() gives the slots of
+    buying_car and of the intents referring to a car by its id, and whether every word
+    of the message was explained, in which case the LLM is not needed.
+    """
+    def __init__(self, values: dict, intent_slots: dict):
+        """
+        values: field -> distinct values of the inventory. intent_slots: intent -> slot names.
+        """
+        self.intent_slots = intent_slots
+        self.trie = {}
+        for field, field_values in values.items():
+            for value in field_values:
+                if isinstance(value, str):
+                    self.add(value.replace("_", " "), field, value)
+                    if field == "car_type":
+                        self.add(value.replace("_", " ") + "s", field, value)
+        for phrase, (field, value) in SYNONYMS.items():
+            if value in values.get(field, []):
+                self.add(phrase, field, value)
+        self.brands = {token for value in values.get("brand", []) if isinstance(value, str) for token in tokenize(value)}
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+        # Messages answered without the LLM, sent to the LLM, and the time spent extracting
+        self.hits = 0
+        self.misses = 0
+        self.extract_time = 0.0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_storage(cls, storage, intent_slots: dict):
+        return cls({field: storage.distinct_values(field) for field in GAZETTEER_FIELDS if field in storage.fields}, intent_slots)
+
+    def add(self, phrase: str, field: str, value: str):
+        node = self.trie
+        for token in tokenize(phrase):
+            node = node.setdefault(token, {})
+        # The key None marks the end of a phrase, the first value of a phrase is kept
+        node.setdefault(None, (field, value))
+
+    def match(self, tokens: list, start: int):
+        # Longest phrase of the trie starting at tokens[start]: (length, field, value) or None
+        node, best = self.trie, None
+        for i in range(start, len(tokens)):
+            node = node.get(tokens[i])
+            if node == None:
+                break
+            if None in node:
+                best = (i + 1 - start, *node[None])
+        return best
+
+    def parse_buying(self, tokens: list) -> tuple:
+        found, used = [], set()
+        i = 0
+        while i < len(tokens):
+            match = self.match(tokens, i)
+            # A numeric model (308, 500) is only a model right after its brand, otherwise a number
+            if match != None and not (tokens[i].isdigit() and (i == 0 or tokens[i - 1] not in self.brands)):
+                length, field, value = match
+                found.append((field, value))
+                used.update(range(i, i + length))
+                i += length
+                continue
+            number = parse_number(tokens[i])
+            if number != None:
+                before = set(tokens[max(0, i - 2):i])
+                after = tokens[i + 1] if i + 1 < len(tokens) else None
+                if len(before & BUDGET_CUES) > 0 or after in CURRENCY_WORDS or tokens[i].endswith("k") or (i > 0 and tokens[i - 1] in CURRENCY_WORDS):
+                    found.append(("budget", str(number)))
+                    used.add(i)
+                elif 1990 <= number <= 2035:
+                    found.append(("year", str(number)))
+                    used.add(i)
+            elif tokens[i] in CURRENCY_WORDS:
+                used.add(i)
+            i += 1
+        return found, used
+
+    def parse_car_reference(self, tokens: list, slots: dict) -> tuple:
+        price_slot = "proposed_price" if "proposed_price" in slots else ("price" if "price" in slots else None)
+        found, used = [], set()
+        for i, token in enumerate(tokens):
+            before = tokens[max(0, i - 2):i]
+            number = parse_number(token)
+            if number != None:
+                if before[-1:] == ["car"] or before == ["car", "id"]:
+                    found.append(("car_id", str(number)))
+                elif "id" in slots and (before[-1:] == ["id"] or before == ["id", "is"]):
+                    found.append(("id", str(number)))
+                elif price_slot != None and not (before[-1:] == ["id"] or before == ["id", "is"]):
+                    found.append((price_slot, str(number)))
+                else:
+                    continue
+                used.add(i)
+            elif "info_type" in slots and token in INFO_KEYWORDS:
+                found.append(("info_type", INFO_KEYWORDS[token]))
+                used.add(i)
+            elif price_slot != None and token == "price":
+                used.add(i)
+            elif token in CURRENCY_WORDS:
+                used.add(i)
+        return found, used
+
+    def extract(self, intent: str, text: str) -> tuple:
+        """
+        (slots, complete): the slots of the intent with the values found in the message
+        (None for the others), and True if no word of the message is left unexplained.
+        slots is None for the intents with free text slots (names, dates, comments).
+        """
+        start = time.perf_counter()
+        slots, complete = self.parse(intent, text)
+        with self.lock:
+            self.extract_time += time.perf_counter() - start
+            if complete:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return slots, complete
+
+    def parse(self, intent: str, text: str) -> tuple:
+        if intent not in self.intent_slots:
+            return None, False
+        slots = {slot: None for slot in self.intent_slots[intent]}
+        if len(slots) == 0:
+            return slots, True
+        tokens = tokenize(text)
+        if intent == "buying_car":
+            found, used = self.parse_buying(tokens)
+        elif "car_id" in slots:
+            found, used = self.parse_car_reference(tokens, slots)
+        else:
+            return None, False
+
+        complete = True
+        for slot, value in found:
+            if slot not in slots:
+                continue
+            # Two different values for a slot (e.g. "petrol or diesel") are left to the LLM
+            if slots[slot] != None and slots[slot] != value:
+                complete = False
+            slots[slot] = value
+        unexplained = [token for i, token in enumerate(tokens) if i not in used and token not in FILLER_WORDS]
+        if len(unexplained) > 0:
+            self.logger.debug(f"Not explained: {unexplained}")
+        # Without the car or without any constraint the message refers to the history
+        if "car_id" in slots and slots["car_id"] == None:
+            complete = False
+        if intent == "buying_car" and all(value == None for value in slots.values()):
+            complete = False
+        return slots, complete and len(unexplained) == 0
+
+    @staticmethod
+    def fill(response: dict, slots: dict) -> dict:
+        """
+        Complete the slots left null by the LLM with the extracted values.
+        """
+        if response == None or slots == None or not isinstance(response.get("slots"), dict):
+            return response
+        for slot, value in slots.items():
+            if value != None and response["slots"].get(slot) in (None, "null", ""):
+                response["slots"][slot] = value
+        return response
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "skipped": self.hits / total if total > 0 else 0.0,
+            "messages": total,
+            "mean_extract_latency": self.extract_time / total if total > 0 else 0.0,
+        }
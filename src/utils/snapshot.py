@@ -0,0 +1,34 @@
+import io
+import pickle
+import struct
+
+# Header of the snapshots: magic bytes and format version
+SNAPSHOT_MAGIC = b"HMDS"
+SNAPSHOT_VERSION = 2
+HEADER = struct.Struct("<4sH")
+
+
+class SnapshotUnpickler(pickle.Unpickler):
+    """
+    Unpickler refusing every class and function: a snapshot only holds tuples, lists,
+    dicts, strings, numbers and bytes, so loading one never runs code, even from another host.
+    """
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a snapshot")
+
+
+def dumps(state) -> bytes:
+    """
+    Binary snapshot of a state made of builtin types.
+    """
+    return HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION) + pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+def loads(data: bytes):
+    if len(data) < HEADER.size:
+        raise ValueError("Not a session snapshot")
+    magic, version = HEADER.unpack_from(data)
+    if magic != SNAPSHOT_MAGIC:
+        raise ValueError("Not a session snapshot")
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot version {version}")
+    return SnapshotUnpickler(io.BytesIO(memoryview(data)[HEADER.size:])).load()
@@ -0,0 +1,180 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.utils.logging import setup_logger
+from src.utils.tracing import tracer
+
+# Lanes of the stages: the model generates one stage at a time (or a few with continuous
+# batching), the database lookups and the bookkeeping run on a pool of CPU threads
+MODEL_LANE = "model"
+CPU_LANE = "cpu"
+
+
+class Stage():
+    """
+    A node of a StageGraph: function(results) with the results of the stages of deps by
+    name, started once all of them are done. kind groups the stages in the reports
+    (nlu, state, dm, database, nlg...).
+    """
+    def __init__(self, name: str, function, deps: list, lane: str, kind: str):
+        self.name = name
+        self.function = function
+        self.deps = deps
+        self.lane = lane
+        self.kind = kind
+        self.start = None
+        self.duration = None
+
+
+class StageGraph():
+    """
+    Work of one turn as a dependency graph. Stages are added after their dependencies,
+    so the order of addition is a topological order.
+    """
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name: str, function, deps: list = None, lane: str = CPU_LANE, kind: str = None) -> Stage:
+        deps = [dep for dep in (deps if deps != None else []) if dep != None]
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"Stage {name} depends on the unknown stage {dep}")
+        stage = Stage(name, function, deps, lane, kind if kind != None else name)
+        self.stages[name] = stage
+        return name
+
+    def critical_path(self) -> tuple:
+        """
+        (length, stage names) of the longest chain of dependent stages, by duration.
+        """
+        finish, previous = {}, {}
+        for name, stage in self.stages.items():
+            before = max(stage.deps, key=lambda dep: finish[dep], default=None)
+            finish[name] = stage.duration + (finish[before] if before != None else 0.0)
+            previous[name] = before
+        if len(finish) == 0:
+            return 0.0, []
+        name = max(finish, key=finish.get)
+        length, path = finish[name], []
+        while name != None:
+            path.append(name)
+            name = previous[name]
+        return length, path[::-1]
+
+
+class StageExecutor():
+    """
+    Runs the StageGraph of the turns: the model stages on a lane of model_workers threads,
+    the other stages on a pool of workers threads, so that the database lookups and the
+    bookkeeping of a segment overlap with the generations of the next one. Ready stages
+    are submitted in the order of the graph, and each stage is given only the results of its
+    dependencies, so the results do not depend on the timing. With workers=0 the stages run
+    one after the other in the calling thread.
+    Reports the wall-clock time of each turn against its critical path.
+    """
+    def __init__(self, workers: int = 2, model_workers: int = 1):
+        self.workers = workers
+        self.cpu_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage") if workers > 0 else None
+        self.model_pool = ThreadPoolExecutor(max_workers=model_workers, thread_name_prefix="stage-model") if workers > 0 else None
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+        # Totals over the turns: wall-clock, critical path and sum of the stage durations,
+        # and per kind of stage the time spent and the time on the critical path
+        self.turns = 0
+        self.wall_time = 0.0
+        self.critical_time = 0.0
+        self.stage_time = 0.0
+        self.kind_time = {}
+        self.kind_critical_time = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, cfg: dict):
+        """
+        Overlapped execution with stage_workers threads when overlap_stages is set ([General]).
+        The model lane has a thread per running sequence with continuous batching, otherwise one.
+        """
+        if not cfg["General"].getboolean("overlap_stages", fallback=False):
+            return cls(workers=0)
+        batching = cfg["General"].getboolean("continuous_batching", fallback=False)
+        return cls(
+            workers=cfg["General"].getint("stage_workers", fallback=2),
+            model_workers=cfg["General"].getint("max_batch_size", fallback=8) if batching else 1,
+        )
+
+    def run_stage(self, stage: Stage, results: dict, parent):
+        # The spans of the stage are nested in the span of the turn, opened in another thread
+        with tracer.attach(parent), tracer.span(f"stage.{stage.kind}", stage=stage.name):
+            stage.start = time.perf_counter()
+            try:
+                return stage.function(results)
+            finally:
+                stage.duration = time.perf_counter() - stage.start
+
+    def run(self, graph: StageGraph) -> dict:
+        """
+        Run the stages of the graph, returns their results by name. The first exception
+        raised by a stage is raised once the running stages are finished.
+        """
+        start = time.perf_counter()
+        results = {}
+        parent = tracer.current()
+        if self.cpu_pool == None:
+            for stage in graph.stages.values():
+                results[stage.name] = self.run_stage(stage, {dep: results[dep] for dep in stage.deps}, parent)
+        else:
+            pending = list(graph.stages.values())
+            running = {}
+            error = None
+            while len(pending) > 0 or len(running) > 0:
+                if error == None:
+                    for stage in [stage for stage in pending if all(dep in results for dep in stage.deps)]:
+                        pool = self.model_pool if stage.lane == MODEL_LANE else self.cpu_pool
+                        running[pool.submit(self.run_stage, stage, {dep: results[dep] for dep in stage.deps}, parent)] = stage
+                        pending.remove(stage)
+                else:
+                    pending = []
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    if future.exception() != None:
+                        error = error if error != None else future.exception()
+                    else:
+                        results[stage.name] = future.result()
+            if error != None:
+                raise error
+        self.record(graph, time.perf_counter() - start)
+        return results
+
+    def record(self, graph: StageGraph, wall: float):
+        critical, path = graph.critical_path()
+        serial = sum(stage.duration for stage in graph.stages.values())
+        tracer.current().set("stage_critical_path", critical)
+        tracer.current().set("stage_serial_time", serial)
+        with self.lock:
+            self.turns += 1
+            self.wall_time += wall
+            self.critical_time += critical
+            self.stage_time += serial
+            for stage in graph.stages.values():
+                self.kind_time[stage.kind] = self.kind_time.get(stage.kind, 0.0) + stage.duration
+                self.kind_critical_time.setdefault(stage.kind, 0.0)
+            for name in path:
+                stage = graph.stages[name]
+                self.kind_critical_time[stage.kind] += stage.duration
+        self.logger.debug(f"Turn of {len(graph.stages)} stages: {wall:.3f} s, critical path {critical:.3f} s ({' -> '.join(path)}), {serial:.3f} s of stages")
+
+    def stats(self) -> dict:
+        turns = max(self.turns, 1)
+        return {
+            "turns": self.turns,
+            "mean_wall_time": self.wall_time / turns,
+            "mean_critical_path": self.critical_time / turns,
+            "mean_stage_time": self.stage_time / turns,
+            # Stage time per second of wall-clock, above 1 when stages overlap
+            "overlap": self.stage_time / self.wall_time if self.wall_time > 0 else 0.0,
+            "stages": {
+                kind: {"mean_time": self.kind_time[kind] / turns, "mean_critical_time": self.kind_critical_time[kind] / turns}
+                for kind in self.kind_time
+            },
+        }
@@ -0,0 +1,357 @@
+import os
+import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+import numpy as np
+from src.utils.column_store import ColumnStore, canonical_records, load_columns, is_number
+
+# Slots that can be relaxed when a search has no result, from the least to the most important
+SLOTS_IMPORTANCE = ["transmission", "year", "fuel_type", "car_type", "model", "brand", "budget"]
+
+# Slots used to filter the cars, indexed by the SQLite storage
+FILTERABLE_SLOTS = ["brand", "model", "car_type", "fuel_type", "transmission", "year", "budget"]
+
+# A storage answers the queries of Database with the same matching rules: budget is a maximum,
+# year a minimum, the other fields are compared case-insensitively for strings. It provides:
+#   fields                                          -> canonical field names
+#   all_cars()                                      -> all the cars
+#   find_cars(slots)                                -> cars matching all the non-None slots
+#   find_cars_relaxed(slots, max_relaxed, top_k)    -> (cars, relaxed slots), see JsonStorage
+#   find_car(car_id)                                -> first car with car_id, None if there is none
+#   distinct_values(field)                          -> the distinct values of a field
+
+
+def parse_range(field: str, value):
+    # Target of the budget (maximum) and year (minimum) slots, None if it cannot be converted
+    try:
+        return float(value) if field == "budget" else int(value)
+    except (ValueError, TypeError):
+        return None
+
+
+def numeric_sql(field: str) -> str:
+    # The column holds a number or a text that is a decimal number, as float() accepts
+    # it in ColumnStore.numeric_view (a non-numeric text would CAST to 0)
+    column = f'trim("{field}")'
+    return (
+        f'(typeof("{field}") IN (\'integer\', \'real\') OR (typeof("{field}") = \'text\' '
+        f'AND {column} GLOB \'*[0-9]*\' AND {column} NOT GLOB \'*[^0-9.eE+-]*\'))'
+    )
+
+
+class JsonStorage():
+    """
+    Inventory read from a JSON file and queried through its column store,
+    memory-mapped from the columnar cache.
+    """
+    def __init__(self, source_path: str = None, columns_path: str = None, records: list = None, logger=None):
+        self.logger = logger
+        if records is not None:
+            self.store = ColumnStore(canonical_records(records))
+        else:
+            self.store = load_columns(source_path, columns_path, logger=logger)
+        self.fields = list(self.store.fields)
+
+    def warning(self, message: str):
+        if self.logger != None:
+            self.logger.warning(message)
+
+    def all_cars(self) -> list:
+        return self.store.rows(range(self.store.size))
+
+    def filter_cars(self, slots: dict) -> np.ndarray:
+        """
+        Sorted ids of the cars matching all the non-None slots.
+        Categorical slots are answered by intersecting the inverted indexes,
+        then budget and year are applied as boolean masks on the candidates.
+        """
+        candidates = None
+        ranges = {}
+        for field, value in slots.items():
+            if value is None:
+                continue  # Skip None values in slots
+            if field not in self.store.fields:
+                # No car has the field, so none of them can match
+                return np.empty(0, dtype=np.int64)
+            if field in ("budget", "year"):
+                ranges[field] = parse_range(field, value)
+                if ranges[field] == None:
+                    self.warning(f"Could not convert {field} target value: {value}")
+                    return np.empty(0, dtype=np.int64)
+                continue
+            ids = self.store.lookup(field, value)
+            candidates = ids if candidates is None else np.intersect1d(candidates, ids, assume_unique=True)
+            if len(candidates) == 0:
+                return candidates
+
+        if candidates is None:
+            candidates = np.arange(self.store.size)
+        mask = np.ones(len(candidates), dtype=bool)
+        if "budget" in ranges:
+            mask &= self.store.numeric_view("budget")[candidates] <= ranges["budget"]
+        if "year" in ranges:
+            # Assuming 'year' means car year should be >= target year
+            mask &= np.trunc(self.store.numeric_view("year")[candidates]) >= ranges["year"]
+        return candidates[mask]
+
+    def constraint_mask(self, field: str, value) -> np.ndarray:
+        """
+        Boolean mask of the cars satisfying a single slot, with the same rules as filter_cars.
+        """
+        mask = np.zeros(self.store.size, dtype=bool)
+        if field not in self.store.fields:
+            return mask
+        if field in ("budget", "year"):
+            target = parse_range(field, value)
+            if target == None:
+                self.warning(f"Could not convert {field} target value: {value}")
+                return mask
+            if field == "budget":
+                return self.store.numeric_view("budget") <= target
+            return np.trunc(self.store.numeric_view("year")) >= target
+        mask[self.store.lookup(field, value)] = True
+        return mask
+
+    def find_cars(self, slots: dict) -> list:
+        return self.store.rows(self.filter_cars(slots))
+
+    def find_cars_relaxed(self, slots: dict, max_relaxed: int, top_k: int):
+        """
+        Cars matching all the slots or, if there are none, the top_k nearest cars.
+        In a single pass each car gets a penalty with the weights 2**i of the slots it
+        violates, i being the position of the slot in SLOTS_IMPORTANCE, so a car violating
+        a slot always ranks after the cars violating only less important ones.
+        Cars violating more than max_relaxed slots, or any slot that cannot be relaxed, are excluded.
+        Returns the list of cars and the list of relaxed slots, from the least important.
+        """
+        ids = self.filter_cars(slots)
+        if len(ids) > 0:
+            return self.store.rows(ids), []
+
+        relaxable = [slot for slot in SLOTS_IMPORTANCE if slots.get(slot) != None]
+        # The other slots must always be satisfied
+        hard = {field: value for field, value in slots.items() if field not in relaxable}
+        candidates = self.filter_cars(hard)
+        if len(candidates) == 0 or len(relaxable) == 0:
+            return [], []
+
+        violated = np.empty((len(relaxable), len(candidates)), dtype=bool)
+        penalty = np.zeros(len(candidates), dtype=np.int64)
+        for i, slot in enumerate(relaxable):
+            violated[i] = ~self.constraint_mask(slot, slots[slot])[candidates]
+            penalty += violated[i] * (2 ** SLOTS_IMPORTANCE.index(slot))
+
+        keep = violated.sum(axis=0) <= max_relaxed
+        candidates, penalty, violated = candidates[keep], penalty[keep], violated[:, keep]
+        # Stable sort: cars with the same penalty stay in database order
+        best = np.argsort(penalty, kind="stable")[:top_k]
+        relaxed = [slot for i, slot in enumerate(relaxable) if violated[i, best].any()]
+        return self.store.rows(candidates[best]), relaxed
+
+    def find_car(self, car_id: int):
+        rows = self.store.lookup("car_id", car_id)
+        return self.store.row(int(rows[0])) if len(rows) > 0 else None
+
+    def distinct_values(self, field: str) -> list:
+        if field in self.store.categorical:
+            # The table of the codes already holds each value once
+            return list(self.store.categorical[field][1])
+        if field in self.store.fields:
+            return sorted({value for value in self.store.column_values(field) if value is not None})
+        return []
+
+
+class ConnectionPool():
+    """
+    Fixed set of SQLite connections shared by the threads of the sessions.
+    """
+    def __init__(self, path: str, size: int):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            connection = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+            # Readers do not block the writer (and the other way around) in WAL mode
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA busy_timeout=5000")
+            self.connections.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.connections.get()
+        try:
+            yield connection
+        finally:
+            self.connections.put(connection)
+
+
+class SQLiteStorage():
+    """
+    Inventory kept in a local SQLite file, so that it can be updated while the system runs.
+    Each field is a column (lists as JSON text, strings compared with NOCASE), the filterable
+    slots and car_id are indexed, and the full car is kept as JSON in the record column.
+    The queries are parameterized, so the sqlite3 statement cache of each pooled connection
+    reuses the compiled statement of each combination of slots.
+    """
+    def __init__(self, path: str, pool_size: int = 4, source_path: str = None, logger=None):
+        self.path = path
+        self.logger = logger
+        self.lock = threading.Lock()
+        if os.path.dirname(path) != "":
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.pool = ConnectionPool(path, pool_size)
+        self.fields = self.read_fields()
+        if len(self.fields) == 0 and source_path != None:
+            if self.logger != None:
+                self.logger.info(f"Importing {source_path} into {path}...")
+            with open(source_path) as f:
+                self.insert_cars(json.load(f))
+
+    def warning(self, message: str):
+        if self.logger != None:
+            self.logger.warning(message)
+
+    def read_fields(self) -> list:
+        with self.pool.connection() as connection:
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(cars)")]
+        return [column for column in columns if column != "record"]
+
+    def create_table(self, fields: list):
+        with self.pool.connection() as connection:
+            columns = ", ".join(f'"{field}" COLLATE NOCASE' for field in fields)
+            connection.execute(f"CREATE TABLE IF NOT EXISTS cars ({columns}, record TEXT)")
+            for field in ["car_id"] + FILTERABLE_SLOTS:
+                if field in fields:
+                    connection.execute(f'CREATE INDEX IF NOT EXISTS idx_{field} ON cars ("{field}")')
+            connection.commit()
+        self.fields = fields
+
+    @staticmethod
+    def column_value(value):
+        return json.dumps(value) if isinstance(value, (list, dict)) else value
+
+    def insert_cars(self, cars: list):
+        """
+        Add cars to the inventory, replacing the ones with the same car_id.
+        The fields missing from the table are only kept in the record column.
+        """
+        cars = canonical_records(cars)
+        with self.lock:
+            if len(self.fields) == 0:
+                self.create_table(list(dict.fromkeys(field for car in cars for field in car.keys())))
+            columns = ", ".join(f'"{field}"' for field in self.fields)
+            placeholders = ", ".join("?" for _ in range(len(self.fields) + 1))
+            rows = [[self.column_value(car.get(field)) for field in self.fields] + [json.dumps(car)] for car in cars]
+            with self.pool.connection() as connection:
+                if "car_id" in self.fields:
+                    connection.executemany("DELETE FROM cars WHERE car_id = ?", [(car.get("car_id"),) for car in cars])
+                connection.executemany(f"INSERT INTO cars ({columns}, record) VALUES ({placeholders})", rows)
+                connection.commit()
+
+    def remove_car(self, car_id: int):
+        with self.lock, self.pool.connection() as connection:
+            connection.execute("DELETE FROM cars WHERE car_id = ?", (car_id,))
+            connection.commit()
+
+    def query(self, sql: str, params: list) -> list:
+        with self.pool.connection() as connection:
+            return connection.execute(sql, params).fetchall()
+
+    def condition(self, field: str, value) -> tuple:
+        """
+        SQL condition and parameters of a single slot, false if it can never be satisfied.
+        """
+        if field not in self.fields:
+            return "0", []
+        if field in ("budget", "year"):
+            target = parse_range(field, value)
+            if target == None:
+                self.warning(f"Could not convert {field} target value: {value}")
+                return "0", []
+            if field == "budget":
+                return f'{numeric_sql("budget")} AND CAST("budget" AS REAL) <= ?', [target]
+            return f'{numeric_sql("year")} AND CAST(CAST("year" AS REAL) AS INTEGER) >= ?', [target]
+        if isinstance(value, (list, dict)):
+            return f'"{field}" = ?', [json.dumps(value)]
+        if not isinstance(value, str) and not is_number(value):
+            return "0", []
+        return f'"{field}" = ?', [value]
+
+    def where(self, slots: dict) -> tuple:
+        conditions, params = ["1"], []
+        for field, value in slots.items():
+            if value is None:
+                continue
+            condition, condition_params = self.condition(field, value)
+            conditions.append(f"({condition})")
+            params += condition_params
+        return " AND ".join(conditions), params
+
+    def all_cars(self) -> list:
+        return [json.loads(row[0]) for row in self.query("SELECT record FROM cars ORDER BY rowid", [])]
+
+    def find_cars(self, slots: dict) -> list:
+        where, params = self.where(slots)
+        return [json.loads(row[0]) for row in self.query(f"SELECT record FROM cars WHERE {where} ORDER BY rowid", params)]
+
+    def find_cars_relaxed(self, slots: dict, max_relaxed: int, top_k: int):
+        """
+        Same ranking as JsonStorage.find_cars_relaxed, computed by a single query.
+        """
+        cars = self.find_cars(slots)
+        if len(cars) > 0:
+            return cars, []
+
+        relaxable = [slot for slot in SLOTS_IMPORTANCE if slots.get(slot) != None]
+        hard = {field: value for field, value in slots.items() if field not in relaxable}
+        if len(relaxable) == 0:
+            return [], []
+
+        # v<i> is 1 when the car violates the i-th relaxable slot, a NULL condition counts as violated
+        violations, params = [], []
+        for i, slot in enumerate(relaxable):
+            condition, condition_params = self.condition(slot, slots[slot])
+            violations.append(f"(CASE WHEN {condition} THEN 0 ELSE 1 END) AS v{i}")
+            params += condition_params
+        where, where_params = self.where(hard)
+        flags = ", ".join(f"v{i}" for i in range(len(relaxable)))
+        violated = " + ".join(f"v{i}" for i in range(len(relaxable)))
+        penalty = " + ".join(f"v{i} * {2 ** SLOTS_IMPORTANCE.index(slot)}" for i, slot in enumerate(relaxable))
+        sql = (
+            f"SELECT record, {flags} FROM (SELECT rowid AS id, record, {', '.join(violations)} FROM cars WHERE {where}) "
+            f"WHERE {violated} <= ? ORDER BY {penalty}, id LIMIT ?"
+        )
+        rows = self.query(sql, params + where_params + [max_relaxed, top_k])
+        cars = [json.loads(row[0]) for row in rows]
+        relaxed = [slot for i, slot in enumerate(relaxable) if any(row[i + 1] for row in rows)]
+        return cars, relaxed
+
+    def distinct_values(self, field: str) -> list:
+        if field not in self.fields:
+            return []
+        return [row[0] for row in self.query(f'SELECT DISTINCT "{field}" FROM cars WHERE "{field}" IS NOT NULL', [])]
+
+    def find_car(self, car_id: int):
+        rows = self.query("SELECT record FROM cars WHERE car_id = ? ORDER BY rowid LIMIT 1", [car_id])
+        return json.loads(rows[0][0]) if len(rows) > 0 else None
+
+
+def get_storage(cfg: dict, records: list = None, logger=None):
+    """
+    Storage selected by backend in [DB]: json (default) or sqlite.
+    Records given directly are always kept in memory, e.g. by the benchmarks.
+    """
+    path = cfg["Settings"].get("path")
+    source_path = os.path.join(path, cfg["DB"].get("path"))
+    if records is not None:
+        return JsonStorage(records=records, logger=logger)
+    backend = cfg["DB"].get("backend", fallback="json")
+    match backend:
+        case "json":
+            columns_path = os.path.join(path, cfg["DB"].get("columns_path", fallback="cache/columns"), os.path.splitext(os.path.basename(source_path))[0])
+            return JsonStorage(source_path=source_path, columns_path=columns_path, logger=logger)
+        case "sqlite":
+            sqlite_path = os.path.join(path, cfg["DB"].get("sqlite_path", fallback="cache/inventory.sqlite"))
+            return SQLiteStorage(sqlite_path, pool_size=cfg["DB"].getint("pool_size", fallback=4), source_path=source_path, logger=logger)
+        case _:
+            raise ValueError(f"Unknown database backend: {backend}")
@@ -0,0 +1,78 @@
+import os
+import glob
+import torch
+from typing import Tuple
+from tokenizers import Tokenizer, models, pre_tokenizers, decoders, trainers
+from transformers import AutoModelForCausalLM, AutoTokenizer, LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast, PreTrainedModel, PreTrainedTokenizer
+
+# Special tokens of the llama3 template, kept whole by the stub tokenizer
+STUB_SPECIAL_TOKENS = ["<|begin_of_text|>", "<|start_header_id|>", "<|end_header_id|>", "<|eot_id|>"]
+
+
+def build_stub_tokenizer(texts: list, vocab_size: int = 2000) -> PreTrainedTokenizerFast:
+    """
+    Byte-level BPE tokenizer trained on texts (e.g. the prompts), built offline.
+    The same texts always give the same tokenizer.
+    """
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=vocab_size, special_tokens=STUB_SPECIAL_TOKENS, initial_alphabet=pre_tokenizers.ByteLevel.alphabet(), show_progress=False)
+    tokenizer.train_from_iterator(texts, trainer=trainer)
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|begin_of_text|>", eos_token="<|eot_id|>", additional_special_tokens=STUB_SPECIAL_TOKENS[1:3])
+    tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+
+def build_stub_model(tokenizer: PreTrainedTokenizer, seed: int = 0, hidden_size: int = 64, layers: int = 2, max_positions: int = 4096) -> PreTrainedModel:
+    """
+    Tiny randomly initialized llama model on the CPU, deterministic for a given seed.
+    It exercises the real tokenization, prefill, decoding and constrained decoding code,
+    its outputs are only meaningful when constrained by a grammar.
+    """
+    torch.manual_seed(seed)
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 2,
+        num_hidden_layers=layers,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=max_positions,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+    model = LlamaForCausalLM(config).eval()
+    model.generation_config.do_sample = False
+    model.generation_config.eos_token_id = tokenizer.eos_token_id
+    model.generation_config.pad_token_id = tokenizer.pad_token_id
+    return model
+
+
+def load_local_model(path: str) -> Tuple[PreTrainedModel, PreTrainedTokenizer]:
+    # A small causal LM saved on disk, loaded on the CPU without network access
+    model = AutoModelForCausalLM.from_pretrained(path, local_files_only=True, torch_dtype=torch.float32).eval()
+    tokenizer = AutoTokenizer.from_pretrained(path, local_files_only=True)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return model, tokenizer
+
+
+def get_stub_model(cfg: dict) -> Tuple[PreTrainedModel, PreTrainedTokenizer]:
+    """
+    Model of [BENCHMARK] model: "stub" for a random tiny llama with a tokenizer trained
+    on the prompt folders, or the path of a local model directory.
+    """
+    name = cfg["BENCHMARK"].get("model", fallback="stub")
+    if name != "stub":
+        return load_local_model(name)
+    path = cfg["Settings"].get("path")
+    texts = []
+    for file in sorted(glob.glob(os.path.join(path, "prompts_*", "*.txt"))):
+        with open(file, "r") as f:
+            texts.append(f.read())
+    tokenizer = build_stub_tokenizer(texts, vocab_size=cfg["BENCHMARK"].getint("stub_vocab_size", fallback=2000))
+    return build_stub_model(tokenizer, seed=cfg["BENCHMARK"].getint("seed", fallback=0)), tokenizer
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import uuid
+import threading
+import functools
+import contextlib
+from src.utils.logging import setup_logger
+
+
+class Span():
+    """
+    A timed operation with its attributes (prompt_tokens, generated_tokens, attempts, cache_hit...),
+    nested in the span that was open in the same thread when it started.
+    """
+    def __init__(self, tracer, name: str, parent=None, attributes: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.parent = parent
+        self.span_id = uuid.uuid4().hex[:16]
+        # The root span of a thread (usually a turn) gives the trace id to all its children
+        self.trace_id = parent.trace_id if parent != None else self.span_id
+        self.attributes = dict(attributes) if attributes != None else {}
+        if parent != None and "session_id" in parent.attributes:
+            self.attributes.setdefault("session_id", parent.attributes["session_id"])
+        self.thread_id = threading.get_ident()
+        # Wall clock start for the exports, perf_counter start for the duration
+        self.start = None
+        self.started = None
+        self.duration = None
+
+    def set(self, key: str, value):
+        self.attributes[key] = value
+
+    def add(self, key: str, value=1):
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def __enter__(self):
+        self.tracer.push(self)
+        self.start = time.time()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.duration = time.perf_counter() - self.started
+        if exc_type != None:
+            self.attributes["error"] = f"{exc_type.__name__}: {exc}"
+        self.tracer.pop(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent != None else None,
+            "start": self.start,
+            "duration": self.duration,
+            "thread_id": self.thread_id,
+            "attributes": self.attributes,
+        }
+
+    def to_chrome_event(self) -> dict:
+        # Complete event ("ph": "X") of the Chrome trace event format, times in microseconds
+        return {
+            "name": self.name,
+            "cat": self.name.split(".")[0],
+            "ph": "X",
+            "ts": self.start * 1e6,
+            "dur": self.duration * 1e6,
+            "pid": os.getpid(),
+            "tid": self.thread_id,
+            "args": {"trace_id": self.trace_id, **self.attributes},
+        }
+
+
+class NoSpan():
+    """
+    Span returned when tracing is disabled: every call does nothing.
+    """
+    def set(self, key: str, value):
+        pass
+
+    def add(self, key: str, value=1):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+
+class Tracer():
+    """
+    Spans of the calls to the components, the model and the database, grouped by turn.
+    The spans of a trace are written when its root span ends, as JSONL (one span per line)
+    and as Chrome trace events (JSON array format, open in chrome://tracing or Perfetto).
+    When disabled, span() and traced() cost one attribute check.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.jsonl_path = None
+        self.chrome_path = None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.logger = setup_logger(self.__class__.__name__, logging_level="INFO")
+
+    def configure(self, cfg: dict):
+        """
+        Enable tracing as set in the [TRACING] section of the configuration.
+        """
+        if not cfg.has_section("TRACING") or not cfg["TRACING"].getboolean("enabled", fallback=False):
+            self.enabled = False
+            return
+        path = cfg["Settings"].get("path")
+        jsonl_path = cfg["TRACING"].get("jsonl_path", fallback=None)
+        chrome_path = cfg["TRACING"].get("chrome_path", fallback=None)
+        self.jsonl_path = os.path.join(path, jsonl_path) if jsonl_path else None
+        self.chrome_path = os.path.join(path, chrome_path) if chrome_path else None
+        for file in [self.jsonl_path, self.chrome_path]:
+            if file != None and os.path.dirname(file) != "":
+                os.makedirs(os.path.dirname(file), exist_ok=True)
+        self.enabled = True
+        self.logger.info(f"Tracing to {self.jsonl_path} and {self.chrome_path}")
+
+    def stack(self) -> list:
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+            self.local.finished = []
+        return self.local.stack
+
+    def span(self, name: str, **attributes):
+        if not self.enabled:
+            return NO_SPAN
+        stack = self.stack()
+        return Span(self, name, stack[-1] if len(stack) > 0 else None, attributes)
+
+    def current(self):
+        """
+        The innermost open span of the thread, to add attributes to it.
+        """
+        if not self.enabled:
+            return NO_SPAN
+        stack = self.stack()
+        return stack[-1] if len(stack) > 0 else NO_SPAN
+
+    @contextlib.contextmanager
+    def attach(self, parent):
+        """
+        Nest the spans opened in this thread in parent, a span open in another thread (e.g. the
+        turn of a stage run by a worker thread). They are written when the block ends.
+        """
+        stack = self.stack() if self.enabled else None
+        if not self.enabled or not isinstance(parent, Span) or any(span is parent for span in stack):
+            yield
+            return
+        stack.append(parent)
+        try:
+            yield
+        finally:
+            stack.remove(parent)
+            if len(stack) == 0:
+                finished, self.local.finished = self.local.finished, []
+                self.write(finished)
+
+    def traced(self, name: str):
+        """
+        Decorator running the function in a span.
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.span(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def push(self, span: Span):
+        self.stack().append(span)
+
+    def pop(self, span: Span):
+        stack = self.stack()
+        if len(stack) > 0 and stack[-1] is span:
+            stack.pop()
+        self.local.finished.append(span)
+        if len(stack) == 0:
+            finished, self.local.finished = self.local.finished, []
+            self.write(finished)
+
+    def write(self, spans: list):
+        with self.lock:
+            if self.jsonl_path != None:
+                with open(self.jsonl_path, "a") as f:
+                    for span in spans:
+                        f.write(json.dumps(span.to_dict(), default=str) + "\n")
+            if self.chrome_path != None:
+                # The closing bracket of the array is optional in the trace event format,
+                # so that events can be appended to the file
+                new_file = not os.path.exists(self.chrome_path)
+                with open(self.chrome_path, "a") as f:
+                    if new_file:
+                        f.write("[\n")
+                    for span in spans:
+                        f.write(json.dumps(span.to_chrome_event(), default=str) + ",\n")
+
+
+# Tracer shared by the whole process, disabled until configured
+tracer = Tracer()
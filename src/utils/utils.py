@@ -5,3 +5,45 @@ def read_txt(path: str) -> str:
     data = myfile.read()
     myfile.close()
     return data
+
+
+class JsonScanner():
+    """
+    Incrementally scan text and track the nesting of JSON objects and arrays,
+    ignoring brackets inside strings, to detect when the first top-level value is closed.
+    """
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.closed = False
+        # Number of characters consumed so far, and the end of the value once closed
+        self.length = 0
+        self.end = None
+
+    def feed(self, text: str) -> bool:
+        """
+        Consume the next chunk of text. Returns True once the top-level value is closed.
+        """
+        for char in text:
+            if self.closed:
+                break
+            self.length += 1
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                # Strings only matter inside the top-level value
+                self.in_string = self.depth > 0
+            elif char in "{[":
+                self.depth += 1
+            elif char in "}]" and self.depth > 0:
+                self.depth -= 1
+                if self.depth == 0:
+                    self.closed = True
+                    self.end = self.length
+        return self.closed
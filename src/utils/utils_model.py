@@ -1,10 +1,22 @@
 import os
+import copy
+import time
+import threading
 import torch
+from torch.ao.quantization import quantize_dynamic
 from typing import Tuple
-from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, PreTrainedTokenizer, PreTrainedModel
+from transformers import AutoModelForCausalLM, AutoTokenizer, BatchEncoding, PreTrainedTokenizer, PreTrainedModel, DynamicCache
+from transformers import StoppingCriteria, StoppingCriteriaList, LogitsProcessor, LogitsProcessorList
+from src.utils.utils import JsonScanner
+from src.utils.json_grammar import JsonGrammar
+from src.utils.json_recovery import JsonRecovery
+from src.utils.logging import setup_logger
+from src.utils.tracing import tracer
 
+logger = setup_logger("Generate", logging_level="INFO")
 
-def get_model(config):
+
+def get_model(config, tokenizer=None):
     model_name = config["General"].get("model_name") # llama2 or llama3
     model_name = config["MODELS"].get(model_name) # meta-llama/Llama-2-7b-chat-hf or meta-llama/Meta-Llama-3-8B-Instruct
     dtype = config["General"].get("dtype") 
@@ -13,11 +25,19 @@ def get_model(config):
     model, tokenizer = load_model(
         model_name=model_name, 
         folder_model=folder_model, 
-        dtype=dtype
+        dtype=dtype,
+        device=config["General"].get("device", fallback="auto"),
+        quantization=config["General"].get("quantization", fallback="none"),
+        tokenizer=tokenizer,
         )
 
     return model, tokenizer
 
+def get_tokenizer(config) -> PreTrainedTokenizer:
+    # Only the tokenizer of the configured model, loaded in a fraction of the time of the weights
+    model_name = config["MODELS"].get(config["General"].get("model_name"))
+    return load_tokenizer(model_name, os.path.join(config["Settings"].get("path"), config["General"].get("folder_model")))
+
 def download_models(models, folder_model):
     for model_name in models.values():
         # triggers download of the models
@@ -31,36 +51,630 @@ def download_models(models, folder_model):
             model_name,
             cache_dir = folder_model)
 
-def load_model(model_name: str, folder_model: str, dtype) -> Tuple[PreTrainedModel, PreTrainedTokenizer]:
+def resolve_device(device: str = "auto") -> str:
+    # auto: the first accelerator available, otherwise the CPU
+    if device != "auto":
+        return device
+    if torch.cuda.is_available():
+        return "cuda"
+    if torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+def quantize_int8(model: PreTrainedModel) -> PreTrainedModel:
+    """
+    Dynamic int8 quantization of the linear layers for CPU inference: the weights are stored
+    in int8 and the activations are quantized on the fly. The decoder layers are converted
+    one at a time, so that only one of them is in fp32 at once, the other weights
+    (embeddings, norms) end up in fp32.
+    """
+    for layer in model.get_decoder().layers:
+        layer.float()
+        quantize_dynamic(layer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    head = model.get_output_embeddings()
+    if isinstance(head, torch.nn.Linear):
+        model.set_output_embeddings(quantize_dynamic(torch.nn.Sequential(head.float()), {torch.nn.Linear}, dtype=torch.qint8)[0])
+    for param in model.parameters():
+        param.data = param.data.float()
+    for buffer in model.buffers():
+        if buffer.is_floating_point():
+            buffer.data = buffer.data.float()
+    model.config.torch_dtype = torch.float32
+    return model
+
+def model_memory(model: PreTrainedModel) -> int:
+    # Bytes of the weights and buffers, packed int8 weights included
+    total = 0
+    for value in model.state_dict().values():
+        for tensor in (value if isinstance(value, tuple) else (value,)):
+            if torch.is_tensor(tensor):
+                total += tensor.numel() * tensor.element_size()
+    return total
+
+def load_tokenizer(model_name: str, folder_model: str) -> PreTrainedTokenizer:
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_name,
+        cache_dir = folder_model
+        )
+    # Batched generation needs left padding, llama tokenizers have no pad token
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer.padding_side = "left"
+    return tokenizer
+
+def load_model(model_name: str, folder_model: str, dtype, device: str = "auto", quantization: str = "none", tokenizer: PreTrainedTokenizer = None) -> Tuple[PreTrainedModel, PreTrainedTokenizer]:
+    """
+    dtype: bf16, fp16 or fp32. device: auto, cpu, cuda or mps.
+    quantization: none, or int8 for dynamic int8 linear layers on the CPU.
+    The tokenizer is loaded unless given.
+    """
+    device = resolve_device(device)
     torch_dtype = torch.float32
     if dtype == "bf16":
         torch_dtype = torch.bfloat16
+    elif dtype == "fp16":
+        torch_dtype = torch.float16
+    if quantization == "int8" and device != "cpu":
+        logger.warning(f"int8 quantization is only available on the CPU, loading the model on the CPU instead of {device}")
+        device = "cpu"
+    start = time.perf_counter()
     model = AutoModelForCausalLM.from_pretrained(
         model_name,
-        device_map="mps", #auto
-        torch_dtype=torch_dtype,
+        device_map=device,
+        # Loaded in bf16 and converted layer by layer, instead of a full fp32 copy
+        torch_dtype=torch.bfloat16 if quantization == "int8" else torch_dtype,
+        # The safetensors shards are memory-mapped and copied tensor by tensor into the
+        # model, without first allocating randomly initialized weights
+        low_cpu_mem_usage=True,
         cache_dir = folder_model
 
     )
-    tokenizer = AutoTokenizer.from_pretrained(
-        model_name,
-        cache_dir = folder_model
-        )
+    if quantization == "int8":
+        model = quantize_int8(model)
+    model.eval()
+    logger.info(f"Loaded {model_name} on {device} ({quantization if quantization == 'int8' else dtype}) in {time.perf_counter() - start:.1f} s, {model_memory(model) / 2**30:.2f} GiB of weights")
+    if tokenizer is None:
+        tokenizer = load_tokenizer(model_name, folder_model)
     return model, tokenizer
 
+class AssistedDecoding():
+    """
+    Assisted generation of a component: a small draft model sharing the tokenizer of the
+    main model proposes the next tokens and the main model verifies all of them in one
+    forward pass. The output is the one of the main model alone (identical with greedy
+    decoding). Counts the proposed and accepted draft tokens of the component.
+    """
+    def __init__(self, draft_model: PreTrainedModel, name: str):
+        self.draft_model = draft_model
+        self.name = name
+        self.calls = 0
+        self.generated_tokens = 0
+        # Forward passes of the main model and of the draft, each draft pass proposes a token
+        self.target_steps = 0
+        self.draft_tokens = 0
+        self.lock = threading.Lock()
+
+    def generate(self, model: PreTrainedModel, input_ids: torch.LongTensor, **kwargs) -> torch.LongTensor:
+        counts = {"target": 0, "draft": 0}
+        hooks = [
+            model.register_forward_hook(lambda *args: counts.__setitem__("target", counts["target"] + 1)),
+            self.draft_model.register_forward_hook(lambda *args: counts.__setitem__("draft", counts["draft"] + 1)),
+        ]
+        try:
+            with torch.no_grad():
+                output = model.generate(input_ids, assistant_model=self.draft_model, **kwargs)
+        finally:
+            for hook in hooks:
+                hook.remove()
+        generated = output.shape[1] - input_ids.shape[1]
+        with self.lock:
+            self.calls += 1
+            self.generated_tokens += generated
+            self.target_steps += counts["target"]
+            self.draft_tokens += counts["draft"]
+        # Every verification step gives the accepted draft tokens plus one token of the main model
+        tracer.current().set("draft_accepted", max(0, generated - counts["target"]))
+        tracer.current().set("draft_proposed", counts["draft"])
+        return output
+
+    def stats(self) -> dict:
+        accepted = max(0, self.generated_tokens - self.target_steps)
+        return {
+            "calls": self.calls,
+            "acceptance_rate": accepted / self.draft_tokens if self.draft_tokens > 0 else 0.0,
+            "tokens_per_step": self.generated_tokens / self.target_steps if self.target_steps > 0 else 0.0,
+        }
+
+
+# Draft model name -> draft model shared by the components
+draft_models = {}
+
+def get_assistant(config, component: str):
+    """
+    AssistedDecoding of a component with assisted_decoding=True in its section, using the
+    draft model <model_name>_draft of [MODELS], or None.
+    """
+    if not config[component].getboolean("assisted_decoding", fallback=False):
+        return None
+    draft_name = config["MODELS"].get(config["General"].get("model_name") + "_draft", fallback=None)
+    if draft_name == None:
+        logger.warning(f"{component}: assisted_decoding needs {config['General'].get('model_name')}_draft in [MODELS]")
+        return None
+    if draft_name not in draft_models:
+        draft_models[draft_name], _ = load_model(
+            model_name=draft_name,
+            folder_model=os.path.join(config["Settings"].get("path"), config["General"].get("folder_model")),
+            dtype=config["General"].get("dtype"),
+            device=config["General"].get("device", fallback="auto"),
+            quantization=config["General"].get("quantization", fallback="none"),
+        )
+    return AssistedDecoding(draft_models[draft_name], component)
+
+class PrefixCache():
+    """
+    Keeps the KV cache (past_key_values) of the static prefix of a component prompt,
+    i.e. the template header followed by the system prompt, so that each call only
+    has to prefill the dynamic suffix (history and user input).
+    """
+    def __init__(self, model: PreTrainedModel, tokenizer: PreTrainedTokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        # prefix text -> token ids of the prefix
+        self.prefixes = {}
+        # prefix text -> DynamicCache computed on the prefix
+        self.caches = {}
+
+    def add(self, prefix: str):
+        """
+        Register a static prompt prefix. The KV cache is computed on first use.
+        """
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = self.tokenizer(prefix, return_tensors="pt").input_ids[0]
+
+    def warmup(self):
+        """
+        Precompute the KV cache of every registered prefix.
+        """
+        for prefix in self.prefixes:
+            self.build(prefix)
+
+    def build(self, prefix: str) -> DynamicCache:
+        if prefix not in self.caches:
+            input_ids = self.prefixes[prefix].unsqueeze(0).to(self.model.device)
+            with torch.no_grad():
+                output = self.model(input_ids, past_key_values=DynamicCache(), use_cache=True)
+            self.caches[prefix] = output.past_key_values
+        return self.caches[prefix]
+
+    def lookup(self, input_ids: torch.Tensor) -> DynamicCache:
+        """
+        Return a copy of the cache of the registered prefix sharing the longest common
+        prefix with input_ids, cropped to that length, or None if nothing matches.
+        At least one token of input_ids is always left to be prefilled by generate.
+        """
+        ids = input_ids[0].cpu()
+        best_prefix, best_length = None, 0
+        for prefix, prefix_ids in self.prefixes.items():
+            n = min(len(prefix_ids), len(ids) - 1)
+            if n <= best_length:
+                continue
+            mismatch = (ids[:n] != prefix_ids[:n]).nonzero()
+            length = n if len(mismatch) == 0 else mismatch[0].item()
+            if length > best_length:
+                best_prefix, best_length = prefix, length
+
+        if best_prefix is None:
+            return None
+        # generate() appends to the cache in place, so work on a copy
+        cache = copy.deepcopy(self.build(best_prefix))
+        if cache.get_seq_length() > best_length:
+            cache.crop(best_length)
+        return cache
+
+
+class JsonStoppingCriteria(StoppingCriteria):
+    """
+    Stop decoding a sequence as soon as its first top-level JSON object or array is closed.
+    prefix is the text already generated before prompt_length, when continuing an output.
+    """
+    def __init__(self, tokenizer: PreTrainedTokenizer, prompt_length: int, batch_size: int = 1, prefix: str = ""):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.scanners = [JsonScanner() for _ in range(batch_size)]
+        for scanner in self.scanners:
+            scanner.feed(prefix)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        # Only the last token of each row is new since the previous call
+        is_done = []
+        for scanner, token_id in zip(self.scanners, input_ids[:, -1].tolist()):
+            if not scanner.closed and input_ids.shape[1] > self.prompt_length:
+                scanner.feed(self.tokenizer.decode([token_id], skip_special_tokens=True))
+            is_done.append(scanner.closed)
+        return torch.tensor(is_done, dtype=torch.bool, device=input_ids.device)
+
+
+class TokenVocabulary():
+    """
+    Decoded text of every token of a tokenizer, stored in a trie, and the tokens that
+    can appear inside a JSON string. Built once per tokenizer.
+    """
+    instances = {}
+
+    @classmethod
+    def get(cls, tokenizer: PreTrainedTokenizer):
+        if id(tokenizer) not in cls.instances:
+            cls.instances[id(tokenizer)] = cls(tokenizer)
+        return cls.instances[id(tokenizer)]
+
+    def __init__(self, tokenizer: PreTrainedTokenizer):
+        special_ids = set(tokenizer.all_special_ids)
+        # token id -> text, and trie nodes as (children, token ids ending at the node)
+        self.texts = {}
+        self.root = ({}, [])
+        string_safe = []
+        for token_id in range(len(tokenizer)):
+            if token_id in special_ids:
+                continue
+            text = tokenizer.decode([token_id])
+            # Skip empty tokens and partial UTF-8 sequences
+            if text == "" or "\ufffd" in text:
+                continue
+            self.texts[token_id] = text
+            node = self.root
+            for char in text:
+                node = node[0].setdefault(char, ({}, []))
+            node[1].append(token_id)
+            if '"' not in text and "\\" not in text and all(ord(char) >= 0x20 for char in text):
+                string_safe.append(token_id)
+        self.string_safe = torch.tensor(string_safe, dtype=torch.long)
+        # (grammar, state) -> tensor of the allowed token ids
+        self.allowed_cache = {}
+
+    def search(self, node: tuple, grammar: JsonGrammar, state: tuple) -> list:
+        """
+        Token ids below node whose text is accepted by the grammar from state.
+        """
+        token_ids = []
+        stack = [(node, state)]
+        while len(stack) > 0:
+            node, state = stack.pop()
+            for char, child in node[0].items():
+                next_state = grammar.step(state, char)
+                if next_state != None:
+                    token_ids.extend(child[1])
+                    stack.append((child, next_state))
+        return token_ids
+
+    def allowed(self, grammar: JsonGrammar, state: tuple) -> torch.Tensor:
+        key = (grammar, state)
+        if key not in self.allowed_cache:
+            if grammar.in_string_body(state):
+                # Searching the whole vocabulary inside a string is too slow: any token without
+                # quotes, backslashes or control characters is valid, plus the ones closing the string
+                quote = self.root[0].get('"')
+                closing = self.search(quote, grammar, grammar.step(state, '"')) if quote != None else []
+                closing += quote[1] if quote != None else []
+                allowed = torch.cat([self.string_safe, torch.tensor(closing, dtype=torch.long)])
+            else:
+                allowed = torch.tensor(self.search(self.root, grammar, state), dtype=torch.long)
+            self.allowed_cache[key] = allowed
+        return self.allowed_cache[key]
+
+    def longest_prefix(self, text: str) -> tuple:
+        """
+        Longest token that is a prefix of text, as (token id, length).
+        """
+        node = self.root
+        best = (None, 0)
+        for i, char in enumerate(text):
+            node = node[0].get(char)
+            if node == None:
+                break
+            if len(node[1]) > 0:
+                best = (node[1][0], i + 1)
+        return best
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Number of tokens needed to write text taking the longest token every time.
+        """
+        count = 0
+        while len(text) > 0:
+            _, length = self.longest_prefix(text)
+            if length == 0:
+                # Character missing from the vocabulary, it can never be forced
+                return count + len(text)
+            text = text[length:]
+            count += 1
+        return count
+
+
+class JsonGrammarLogitsProcessor(LogitsProcessor):
+    """
+    Mask the tokens that would make the output of each row leave its JsonGrammar,
+    so that the decoded text is valid JSON by construction. When the remaining budget
+    gets close to the tokens needed to close the JSON, the shortest completion is forced.
+    """
+    # Extra tokens kept before forcing, a choice (e.g. a new array element) can make the completion longer
+    FORCE_MARGIN = 16
+
+    def __init__(self, tokenizer: PreTrainedTokenizer, grammars: list, prompt_length: int, max_new_tokens: int, eos_token_ids: list):
+        self.vocabulary = TokenVocabulary.get(tokenizer)
+        self.grammars = grammars
+        self.states = [grammar.initial_state for grammar in grammars]
+        self.prompt_length = prompt_length
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_ids = torch.tensor(eos_token_ids, dtype=torch.long)
+
+    def update(self, row: int, token_id: int):
+        # Advance the grammar state of a row with its last generated token
+        if self.states[row] != None:
+            text = self.vocabulary.texts.get(token_id)
+            self.states[row] = self.grammars[row].feed(self.states[row], text) if text != None else None
+
+    def allowed(self, row: int, remaining: int, vocab_size: int) -> torch.Tensor:
+        state = self.states[row]
+        grammar = self.grammars[row]
+        if state == None or grammar.is_done(state):
+            allowed = self.eos_token_ids
+        else:
+            completion = grammar.shortest_completion(state)
+            token_id, _ = self.vocabulary.longest_prefix(completion)
+            if token_id != None and remaining <= self.vocabulary.count_tokens(completion) + self.FORCE_MARGIN:
+                allowed = torch.tensor([token_id], dtype=torch.long)
+            else:
+                allowed = self.vocabulary.allowed(grammar, state)
+        return allowed[allowed < vocab_size]
+
+    def mask_row(self, row: int, scores: torch.FloatTensor, remaining: int) -> torch.FloatTensor:
+        """
+        Scores of a single row (1D) with the tokens not allowed by its grammar set to -inf.
+        """
+        allowed = self.allowed(row, remaining, scores.shape[-1]).to(scores.device)
+        if len(allowed) == 0:
+            # Should not happen, leave the row unconstrained rather than masking every token
+            logger.warning(f"No token allowed by the grammar in state {self.states[row]}")
+            return scores
+        mask = torch.full_like(scores, float("-inf"))
+        mask[allowed] = 0
+        return scores + mask
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        generated = input_ids.shape[1] - self.prompt_length
+        remaining = self.max_new_tokens - generated
+        rows = []
+        for row in range(len(self.grammars)):
+            if generated > 0:
+                self.update(row, input_ids[row, -1].item())
+            rows.append(self.mask_row(row, scores[row], remaining))
+        return torch.stack(rows)
+
+
+class ContinuationLogitsProcessor(LogitsProcessor):
+    """
+    Continuation of an output from the valid prefix of its JSON. Greedy decoding would
+    repeat the same mistake, so the token that followed the prefix is banned at the first
+    step, and the end of sequence until the scanner sees the JSON closed.
+    """
+    def __init__(self, scanner: JsonScanner, prompt_length: int, banned_token_id: int, eos_token_ids: list):
+        self.scanner = scanner
+        self.prompt_length = prompt_length
+        self.banned_token_id = banned_token_id
+        self.eos_token_ids = eos_token_ids
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        if input_ids.shape[1] == self.prompt_length and self.banned_token_id != None:
+            scores[:, self.banned_token_id] = float("-inf")
+        if not self.scanner.closed:
+            scores[:, [token_id for token_id in self.eos_token_ids if token_id < scores.shape[-1]]] = float("-inf")
+        return scores
+
+
+def continue_json(
+    model: PreTrainedModel,
+    tokenizer: PreTrainedTokenizer,
+    output: torch.LongTensor,
+    cache: DynamicCache,
+    prompt_length: int,
+    max_seq_length: int,
+    max_new_tokens: int,
+    recovery: JsonRecovery,
+) -> torch.LongTensor:
+    """
+    Continue an output without a complete JSON value from the longest valid prefix of its JSON,
+    at most recovery.max_continuations times. The KV cache of the generation is cropped to the
+    prefix, so neither the prompt nor the kept tokens are computed again.
+    """
+    eos_token_ids = get_eos_token_ids(model, tokenizer)
+    for continuation in range(recovery.max_continuations + 1):
+        generated = output[0][prompt_length:].tolist()
+        # Nothing after the end of sequence belongs to the output
+        for i, token_id in enumerate(generated):
+            if token_id in eos_token_ids:
+                generated = generated[:i]
+                break
+        value, prefix = recovery.split(tokenizer.decode(generated, skip_special_tokens=True))
+        if value != None:
+            return output
+        if prefix == None or cache == None or continuation == recovery.max_continuations:
+            break
+        # Longest run of tokens decoding to a part of the valid prefix
+        kept = len(generated)
+        while kept > 0 and len(tokenizer.decode(generated[:kept], skip_special_tokens=True)) > len(prefix):
+            kept -= 1
+        budget = min(max_new_tokens if max_new_tokens != None else max_seq_length, max_seq_length - prompt_length - kept)
+        if budget <= 0:
+            break
+        input_ids = output[:, : prompt_length + kept]
+        cache.crop(prompt_length + kept - 1)
+        criteria = JsonStoppingCriteria(tokenizer, input_ids.shape[1], prefix=tokenizer.decode(generated[:kept], skip_special_tokens=True))
+        processor = ContinuationLogitsProcessor(criteria.scanners[0], input_ids.shape[1], generated[kept] if kept < len(generated) else None, eos_token_ids)
+        recovery.record_continuation(len(generated) - kept)
+        logger.info(f"Continuing from {kept} valid tokens out of {len(generated)}")
+        with torch.no_grad():
+            result = model.generate(
+                input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                pad_token_id=tokenizer.eos_token_id,
+                past_key_values=cache,
+                max_new_tokens=budget,
+                stopping_criteria=StoppingCriteriaList([criteria]),
+                logits_processor=LogitsProcessorList([processor]),
+                return_dict_in_generate=True,
+            )
+        output, cache = result.sequences, result.past_key_values
+    recovery.record_failure(output.shape[1] - prompt_length)
+    return output
+
+
+def get_eos_token_ids(model: PreTrainedModel, tokenizer: PreTrainedTokenizer) -> list:
+    eos_token_ids = model.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids]
+    if tokenizer.eos_token_id not in eos_token_ids:
+        eos_token_ids = eos_token_ids + [tokenizer.eos_token_id]
+    return eos_token_ids
+
+
+def get_generation_kwargs(
+    inputs: BatchEncoding,
+    tokenizer: PreTrainedTokenizer,
+    max_seq_length: int,
+    max_new_tokens: int = None,
+    stop_on_json: bool = False,
+    grammars: list = None,
+    model: PreTrainedModel = None,
+) -> dict:
+    """
+    Output budget, stopping criteria and grammar constraints shared by generate and generate_batch.
+    """
+    prompt_length = inputs.input_ids.shape[1]
+    kwargs = {}
+    if max_new_tokens != None:
+        kwargs["max_new_tokens"] = max(1, min(max_new_tokens, max_seq_length - prompt_length))
+    else:
+        kwargs["max_length"] = max_seq_length
+    if grammars != None:
+        kwargs["logits_processor"] = LogitsProcessorList([
+            JsonGrammarLogitsProcessor(tokenizer, grammars, prompt_length, kwargs.get("max_new_tokens", max_seq_length - prompt_length), get_eos_token_ids(model, tokenizer))
+        ])
+    if stop_on_json:
+        kwargs["stopping_criteria"] = StoppingCriteriaList([
+            JsonStoppingCriteria(tokenizer, prompt_length, batch_size=inputs.input_ids.shape[0])
+        ])
+    return kwargs
+
+
+def log_decode_steps(output: torch.Tensor, prompt_length: int, budget: int):
+    # A batch runs as many decode steps as its longest row
+    generated = output.shape[1] - prompt_length
+    logger.info(f"Generated {generated} new tokens, {budget - generated} decode steps saved out of {budget}")
+
+
+@tracer.traced("generate")
 def generate(
     model: PreTrainedModel,
     inputs: BatchEncoding,
     tokenizer: PreTrainedTokenizer,
     max_seq_length: int,
+    prefix_cache: PrefixCache = None,
+    max_new_tokens: int = None,
+    stop_on_json: bool = False,
+    grammar: JsonGrammar = None,
+    scheduler=None,
+    assistant=None,
+    recovery: JsonRecovery = None,
 ) -> str:
-    with torch.no_grad():
-        output = model.generate(
+    """
+    recovery: limits of the continuation of an unconstrained JSON output without a complete
+    value (stop_on_json without grammar), not used in the running batch of a scheduler.
+    """
+    span = tracer.current()
+    span.set("prompt_tokens", int(inputs.attention_mask[0].sum()))
+    if scheduler != None:
+        # Decoded in the running batch of the scheduler, the prefix cache is not used there
+        input_ids = inputs.input_ids[0][inputs.attention_mask[0].bool()].tolist()
+        request = scheduler.make_request(input_ids, max_new_tokens, stop_on_json, grammar)
+        output = scheduler.generate_many([request])[0]
+        span.set("generated_tokens", len(request.generated))
+        return output
+    past_key_values = prefix_cache.lookup(inputs.input_ids) if prefix_cache != None else None
+    grammars = [grammar] if grammar != None else None
+    kwargs = get_generation_kwargs(inputs, tokenizer, max_seq_length, max_new_tokens, stop_on_json, grammars, model)
+    # The draft proposes several tokens per step, the grammar and the JSON stopping criteria
+    # expect a single one
+    if assistant != None and grammar == None and not stop_on_json:
+        output = assistant.generate(
+            model,
             inputs.input_ids,
             attention_mask=inputs.attention_mask,
-            max_length=max_seq_length,
             pad_token_id=tokenizer.eos_token_id,
+            past_key_values=past_key_values,
+            **kwargs,
         )
+    else:
+        # The KV cache of the generation is kept to continue a broken JSON output
+        continuable = recovery != None and stop_on_json and grammar == None
+        with torch.no_grad():
+            output = model.generate(
+                inputs.input_ids,
+                attention_mask=inputs.attention_mask,
+                pad_token_id=tokenizer.eos_token_id,
+                past_key_values=past_key_values,
+                return_dict_in_generate=continuable,
+                **kwargs,
+            )
+        if continuable:
+            output = continue_json(model, tokenizer, output.sequences, output.past_key_values, len(inputs.input_ids[0]), max_seq_length, max_new_tokens, recovery)
+    if "max_new_tokens" in kwargs:
+        log_decode_steps(output, len(inputs.input_ids[0]), kwargs["max_new_tokens"])
+    span.set("generated_tokens", output.shape[1] - len(inputs.input_ids[0]))
+    span.set("prefix_cache_hit", past_key_values != None)
     return tokenizer.decode(
         output[0][len(inputs.input_ids[0]) :], skip_special_tokens=True
-    )
\ No newline at end of file
+    )
+
+@tracer.traced("generate_batch")
+def generate_batch(
+    model: PreTrainedModel,
+    inputs: BatchEncoding,
+    tokenizer: PreTrainedTokenizer,
+    max_seq_length: int,
+    max_new_tokens: int = None,
+    stop_on_json: bool = False,
+    grammars: list = None,
+    scheduler=None,
+) -> list:
+    """
+    Generate a response for every row of a left-padded batch with a single generate call.
+    grammars, if given, contains the JsonGrammar constraining each row.
+    With a scheduler the rows join its running batch instead.
+    """
+    span = tracer.current()
+    span.set("batch_size", inputs.input_ids.shape[0])
+    span.set("prompt_tokens", int(inputs.attention_mask.sum()))
+    if scheduler != None:
+        requests = [
+            scheduler.make_request(row[mask.bool()].tolist(), max_new_tokens, stop_on_json, grammars[i] if grammars != None else None)
+            for i, (row, mask) in enumerate(zip(inputs.input_ids, inputs.attention_mask))
+        ]
+        outputs = scheduler.generate_many(requests)
+        span.set("generated_tokens", sum(len(request.generated) for request in requests))
+        return outputs
+    kwargs = get_generation_kwargs(inputs, tokenizer, max_seq_length, max_new_tokens, stop_on_json, grammars, model)
+    with torch.no_grad():
+        output = model.generate(
+            inputs.input_ids,
+            attention_mask=inputs.attention_mask,
+            pad_token_id=tokenizer.pad_token_id,
+            **kwargs,
+        )
+    if "max_new_tokens" in kwargs:
+        log_decode_steps(output, inputs.input_ids.shape[1], kwargs["max_new_tokens"])
+    # Padded steps of the rows finished early are counted too
+    span.set("generated_tokens", (output.shape[1] - inputs.input_ids.shape[1]) * output.shape[0])
+    # With left padding every prompt ends at the same position
+    return tokenizer.batch_decode(
+        output[:, inputs.input_ids.shape[1] :], skip_special_tokens=True
+    )